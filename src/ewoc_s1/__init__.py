@@ -15,3 +15,4 @@ EWOC_S1_DEM_DOWNLOAD_ERROR = 2
 EWOC_S1_INPUT_DOWNLOAD_ERROR = 3
 EWOC_S1_PROCESSOR_ERROR = 4
 EWOC_S1_ARD_FORMAT_ERROR = 5
+EWOC_S1_WORK_PLAN_ERROR = 6
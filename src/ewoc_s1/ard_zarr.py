@@ -0,0 +1,175 @@
+from contextlib import ExitStack
+from datetime import datetime
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from ewoc_s1.ewoc_s1_ard import EWOC_S1_POLARISATIONS
+from ewoc_s1.utils import file_lock
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+# numpy, rasterio and zarr are imported by the functions which use them: zarr is an optional
+# dependency (pip install ewoc_s1[zarr]) only needed by the zarr sink.
+
+EWOC_S1_ARD_SINK_GEOTIFF = 'geotiff'
+EWOC_S1_ARD_SINK_ZARR = 'zarr'
+EWOC_S1_ARD_SINK_BOTH = 'both'
+EWOC_S1_ARD_SINKS = [EWOC_S1_ARD_SINK_GEOTIFF, EWOC_S1_ARD_SINK_ZARR, EWOC_S1_ARD_SINK_BOTH]
+
+EWOC_S1_ZARR_DIRNAME = 'ewoc_s1_ard_zarr'
+# Chunks (time, y, x): the time series of a pixel is read from a few chunks while the
+# append of a date rewrites only the chunks of one time slab
+EWOC_S1_ZARR_CHUNKS = (16, 256, 256)
+EWOC_S1_ZARR_NODATA = 65535
+
+class ArdZarrError(Exception):
+    """Exception raised when a date can not be appended to the Zarr store of a tile."""
+
+def is_geotiff_sink(ard_sink: str)-> bool:
+    return ard_sink in (EWOC_S1_ARD_SINK_GEOTIFF, EWOC_S1_ARD_SINK_BOTH)
+
+def is_zarr_sink(ard_sink: str)-> bool:
+    return ard_sink in (EWOC_S1_ARD_SINK_ZARR, EWOC_S1_ARD_SINK_BOTH)
+
+def check_ard_sink(ard_sink: str)-> None:
+    """ Raise ValueError if the sink is unknown or ImportError if zarr is not installed """
+    if ard_sink not in EWOC_S1_ARD_SINKS:
+        raise ValueError(f'Unknown ARD sink {ard_sink}, must be one of {EWOC_S1_ARD_SINKS}')
+    if is_zarr_sink(ard_sink):
+        import zarr  # pylint: disable=import-outside-toplevel,unused-import
+
+def get_ewoc_s1_zarr_dirpath(zarr_dirpath_root: Path, s2_tile_id: str)-> Path:
+    """ Path of the Zarr store of a S2 tile """
+    return zarr_dirpath_root / f'ewoc_s1_ard_{s2_tile_id}.zarr'
+
+def _create_arrays(root, shape: Tuple[int, int], transform, crs: str,
+                   chunks: Tuple[int, int, int])-> None:
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    from numcodecs import Blosc  # pylint: disable=import-outside-toplevel
+
+    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+    for pol in EWOC_S1_POLARISATIONS:
+        array = root.create(pol, shape=(0,) + shape, chunks=chunks, dtype='uint16',
+                            fill_value=EWOC_S1_ZARR_NODATA, compressor=compressor,
+                            overwrite=True)
+        array.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+    root.create('time', shape=(0,), chunks=(1024,), dtype='M8[s]', overwrite=True)
+    root['time'].attrs['_ARRAY_DIMENSIONS'] = ['time']
+    # Coordinates of the centers of the pixels
+    root.array('x', transform.c + transform.a * (np.arange(shape[1]) + 0.5), overwrite=True)
+    root['x'].attrs['_ARRAY_DIMENSIONS'] = ['x']
+    root.array('y', transform.f + transform.e * (np.arange(shape[0]) + 0.5), overwrite=True)
+    root['y'].attrs['_ARRAY_DIMENSIONS'] = ['y']
+    root.attrs.update({'crs': crs, 'transform': list(transform)[:6],
+                       'nodata': EWOC_S1_ZARR_NODATA, 'acquisitions': [], 'time_order': []})
+
+def _sort_by_time(acquisitions: List[Dict[str, str]])-> List[int]:
+    return sorted(range(len(acquisitions)),
+                  key=lambda time_idx: datetime.fromisoformat(acquisitions[time_idx]['time']))
+
+def get_acquisitions(zarr_dirpath: Path)-> List[Dict[str, str]]:
+    """ Id and time of the dates of the Zarr store, in the order of the time dimension """
+    import zarr  # pylint: disable=import-outside-toplevel
+
+    return zarr.open_group(str(zarr_dirpath), mode='r').attrs['acquisitions']
+
+def get_time_order(zarr_dirpath: Path)-> List[int]:
+    """ Indices in the time dimension of the dates of the Zarr store sorted by time """
+    import zarr  # pylint: disable=import-outside-toplevel
+
+    attrs = zarr.open_group(str(zarr_dirpath), mode='r').attrs
+    if 'time_order' not in attrs:
+        # Store written before the time order was recorded
+        return _sort_by_time(attrs['acquisitions'])
+    return attrs['time_order']
+
+def open_ewoc_s1_zarr(zarr_dirpath: Path):
+    """ Open the Zarr store of a tile as a xarray Dataset sorted by time
+
+    The dataset holds only the committed dates, in the order of the time_order attribute, so
+    its time coordinate is monotonic (e.g. for .sel(time=slice(start, end))). It needs xarray.
+    """
+    import xarray as xr  # pylint: disable=import-outside-toplevel
+
+    return xr.open_zarr(str(zarr_dirpath), consolidated=False).isel(
+        time=get_time_order(zarr_dirpath))
+
+def append_to_ewoc_s1_zarr(zarr_dirpath: Path, acquisition_id: str, acquisition_time: datetime,
+                           ewoc_filepaths: Dict[str, Path],
+                           chunks: Tuple[int, int, int]=EWOC_S1_ZARR_CHUNKS)-> int:
+    """ Append the EWoC ARD files of one date to the Zarr store of their S2 tile
+
+    The store holds one (time, y, x) uint16 array by polarisation, chunked by chunks and
+    compressed with zstd, with the time, y and x coordinates (xarray layout). The dates are in
+    the order of their append, the date of a product already in the store is replaced. So the
+    time coordinate is not sorted: the time_order attribute holds the indices of the dates
+    sorted by time, to be applied by the readers (see open_ewoc_s1_zarr).
+
+    The append is atomic: it is done under a lock shared by the processes and threads of the
+    node, and the date is committed by the update of the acquisitions and time_order
+    attributes once its arrays are written. The readers ignore the dates not listed in the
+    acquisitions (e.g. an interrupted append), the next append overwrites them.
+
+    Raises:
+        ArdZarrError: if the files do not have the grid of the store
+
+    Returns:
+        int: the index of the date in the time dimension
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import rasterio  # pylint: disable=import-outside-toplevel
+    from rasterio.windows import Window  # pylint: disable=import-outside-toplevel
+    import zarr  # pylint: disable=import-outside-toplevel
+
+    zarr_dirpath.parent.mkdir(exist_ok=True, parents=True)
+    with ExitStack() as stack:
+        datasets = {pol: stack.enter_context(rasterio.open(ewoc_filepaths[pol]))
+                    for pol in EWOC_S1_POLARISATIONS}
+        ref_dataset = datasets[EWOC_S1_POLARISATIONS[0]]
+        shape = (ref_dataset.height, ref_dataset.width)
+        stack.enter_context(file_lock(zarr_dirpath.with_name(zarr_dirpath.name + '.lock')))
+
+        root = zarr.open_group(str(zarr_dirpath), mode='a')
+        if 'acquisitions' not in root.attrs:
+            # The arrays of a store whose creation was interrupted are created again
+            _create_arrays(root, shape, ref_dataset.transform, ref_dataset.crs.to_wkt(), chunks)
+        if root[EWOC_S1_POLARISATIONS[0]].shape[1:] != shape or \
+           list(ref_dataset.transform)[:6] != root.attrs['transform']:
+            raise ArdZarrError(f'{acquisition_id} is not on the grid of {zarr_dirpath}')
+
+        acquisitions = root.attrs['acquisitions']
+        acquisition_ids = [acquisition['id'] for acquisition in acquisitions]
+        if acquisition_id in acquisition_ids:
+            time_idx = acquisition_ids.index(acquisition_id)
+            logger.info('%s already in %s, it is replaced', acquisition_id, zarr_dirpath)
+        else:
+            time_idx = len(acquisitions)
+            # The uncommitted dates of an interrupted append are dropped
+            for pol in EWOC_S1_POLARISATIONS:
+                root[pol].resize((time_idx + 1,) + shape)
+            root['time'].resize(time_idx + 1)
+
+        for pol, dataset in datasets.items():
+            # Written by slabs of one chunk row to bound the memory
+            for row_off in range(0, shape[0], chunks[1]):
+                window = Window(0, row_off, shape[1], min(chunks[1], shape[0] - row_off))
+                root[pol][time_idx, row_off:row_off + window.height, :] = \
+                    dataset.read(1, window=window)
+        root['time'][time_idx] = np.datetime64(acquisition_time, 's')
+
+        acquisition = {'id': acquisition_id, 'time': acquisition_time.isoformat()}
+        if time_idx < len(acquisitions):
+            acquisitions[time_idx] = acquisition
+        else:
+            acquisitions.append(acquisition)
+        # Commit: the attributes are written at once by a rename of the store
+        root.attrs.update({'acquisitions': acquisitions,
+                           'time_order': _sort_by_time(acquisitions)})
+
+    logger.info('%s appended to %s (date %s)', acquisition_id, zarr_dirpath, time_idx)
+    return time_idx
@@ -0,0 +1,294 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
+from typing import Callable, Dict, Iterator, List, Optional
+import zlib
+
+from ewoc_s1.utils import file_lock
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_DEM_CACHE_MAX_SIZE = 20 * 1024**3
+EWOC_S1_PRD_CACHE_MAX_SIZE = 100 * 1024**3
+# Number of lock files shared by the entries of a cache for their download
+EWOC_S1_CACHE_NB_KEY_LOCKS = 256
+
+def get_path_size(path: Path)-> int:
+    """ Return the size in bytes of a file or of all the files of a directory """
+    if path.is_file():
+        return path.stat().st_size
+    return sum(filepath.stat().st_size for filepath in path.rglob('*') if filepath.is_file())
+
+def link_path(src_path: Path, dst_path: Path)-> None:
+    """ Link a file or all the files of a directory to dst_path
+
+    Hard links are used when possible, otherwise (e.g. on another file system) the files are
+    copied: the linked files stay valid even if the source is removed.
+    """
+    if src_path.is_dir():
+        for src_filepath in src_path.rglob('*'):
+            if src_filepath.is_file():
+                link_path(src_filepath, dst_path / src_filepath.relative_to(src_path))
+        return
+
+    dst_path.parent.mkdir(exist_ok=True, parents=True)
+    if dst_path.exists() or dst_path.is_symlink():
+        dst_path.unlink()
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+
+class FileCache():
+    """ Size-bounded LRU cache of files and directories on the local disk
+
+    The cache can be shared by several processes of the same node: the accesses are protected
+    by a lock file. The modification time of an entry is its last access time. The entries are
+    provided to the processing through links (see link_path) so the eviction of an entry does
+    not break a running processing. The size of the entries is recorded in an index so the
+    size of the cache is known without walking the entries.
+    """
+
+    def __init__(self, cache_dirpath: Path, max_size: int) -> None:
+        self._cache_dirpath = cache_dirpath
+        self._data_dirpath = cache_dirpath / 'data'
+        self._tmp_dirpath_root = cache_dirpath / 'tmp'
+        self._lock_filepath = cache_dirpath / '.lock'
+        self._sizes_filepath = cache_dirpath / 'sizes.json'
+        self._max_size = max_size
+
+        self._data_dirpath.mkdir(exist_ok=True, parents=True)
+        self._tmp_dirpath_root.mkdir(exist_ok=True)
+
+    @property
+    def cache_dirpath(self)-> Path:
+        return self._cache_dirpath
+
+    @property
+    def max_size(self)-> int:
+        return self._max_size
+
+    def lock(self):
+        """ Context manager to lock the cache between processes and threads """
+        return file_lock(self._lock_filepath)
+
+    def _key_lock(self, key: str):
+        """ Lock of an entry held during its download so it is downloaded only once
+
+        The keys are hashed into EWOC_S1_CACHE_NB_KEY_LOCKS lock files, so the number of lock
+        files is bounded whatever the number of entries.
+        """
+        lock_idx = zlib.crc32(key.encode()) % EWOC_S1_CACHE_NB_KEY_LOCKS
+        return file_lock(self._tmp_dirpath_root / f'key_{lock_idx}.lock')
+
+    @contextmanager
+    def tmp_dirpath(self)-> Iterator[Path]:
+        """ Temporary directory on the same file system as the cache, removed at exit """
+        tmp_dirpath = Path(mkdtemp(dir=self._tmp_dirpath_root))
+        try:
+            yield tmp_dirpath
+        finally:
+            shutil.rmtree(tmp_dirpath, ignore_errors=True)
+
+    def size(self)-> int:
+        with self.lock():
+            return sum(self._read_sizes().values())
+
+    def _read_sizes(self)-> Dict[str, int]:
+        if not self._sizes_filepath.exists():
+            # Index created from the entries, e.g. for a cache of a previous version
+            return {entry_path.name: get_path_size(entry_path)
+                    for entry_path in self._data_dirpath.iterdir()}
+        with open(self._sizes_filepath, encoding='utf8') as sizes_file:
+            return json.load(sizes_file)
+
+    def _write_sizes(self, sizes: Dict[str, int])-> None:
+        tmp_sizes_filepath = self._sizes_filepath.with_suffix('.tmp')
+        with open(tmp_sizes_filepath, 'w', encoding='utf8') as sizes_file:
+            json.dump(sizes, sizes_file)
+        tmp_sizes_filepath.replace(self._sizes_filepath)
+
+    def get(self, key: str, dst_path: Path)-> bool:
+        """ Link the entry to dst_path if it is in the cache
+
+        Returns:
+            bool: True if the entry is in the cache
+        """
+        with self.lock():
+            return self._get(key, dst_path)
+
+    def put(self, key: str, src_path: Path, dst_path: Optional[Path]=None)-> None:
+        """ Move src_path in the cache and link it to dst_path if provided """
+        with self.lock():
+            self._put(key, src_path)
+            if dst_path is not None:
+                link_path(self._data_dirpath / key, dst_path)
+            self._evict(keep_keys=[key])
+
+    def _get(self, key: str, dst_path: Path)-> bool:
+        entry_path = self._data_dirpath / key
+        if not entry_path.exists():
+            return False
+        os.utime(entry_path)
+        link_path(entry_path, dst_path)
+        return True
+
+    def _put(self, key: str, src_path: Path)-> None:
+        entry_path = self._data_dirpath / key
+        if entry_path.exists():
+            # Already added by another process
+            os.utime(entry_path)
+            return
+        sizes = self._read_sizes()
+        shutil.move(str(src_path), str(entry_path))
+        os.utime(entry_path)
+        sizes[key] = get_path_size(entry_path)
+        self._write_sizes(sizes)
+
+    def _evict(self, keep_keys: List[str])-> None:
+        sizes = self._read_sizes()
+        cache_size = sum(sizes.values())
+        if cache_size <= self._max_size:
+            return
+        # The entries are walked only when the cache is full
+        entries = sorted((self._data_dirpath / key for key in sizes
+                          if (self._data_dirpath / key).exists()),
+                         key=lambda path: path.stat().st_mtime)
+        for entry_path in entries:
+            if cache_size <= self._max_size:
+                break
+            if entry_path.name in keep_keys:
+                continue
+            logger.info('Remove %s from the cache %s', entry_path.name, self._cache_dirpath)
+            cache_size -= sizes.pop(entry_path.name)
+            if entry_path.is_dir():
+                shutil.rmtree(entry_path)
+            else:
+                entry_path.unlink()
+        self._write_sizes({key: size for key, size in sizes.items()
+                           if (self._data_dirpath / key).exists()})
+
+class DEMCache(FileCache):
+    """ Cache of the DEM cells shared between the S2 tiles and the runs
+
+    The cells are keyed by the DEM type, the DEM source and the cell file name
+    (e.g. copdem_aws_N44E001.tif). The list of cells of a S2 tile is recorded at its first
+    download so the next requests of this tile do not need any download. The DEM of a S2 tile
+    requested concurrently by several jobs is downloaded only once: the other requests wait for
+    the download.
+    """
+
+    def __init__(self, cache_dirpath: Path, max_size: int=EWOC_S1_DEM_CACHE_MAX_SIZE) -> None:
+        super().__init__(cache_dirpath, max_size)
+        self._index_filepath = cache_dirpath / 'dem_tiles.json'
+
+    @staticmethod
+    def _cell_key(dem_type: str, dem_source: str, cell_relpath: str)-> str:
+        return '_'.join([dem_type, dem_source, cell_relpath.replace('/', '_')])
+
+    @staticmethod
+    def _tile_key(dem_type: str, dem_source: str, s2_tile_id: str)-> str:
+        return '/'.join([dem_type, dem_source, s2_tile_id])
+
+    def _read_index(self)-> Dict[str, List[str]]:
+        if not self._index_filepath.exists():
+            return {}
+        with open(self._index_filepath, encoding='utf8') as index_file:
+            return json.load(index_file)
+
+    def _write_index(self, index: Dict[str, List[str]])-> None:
+        tmp_index_filepath = self._index_filepath.with_suffix('.tmp')
+        with open(tmp_index_filepath, 'w', encoding='utf8') as index_file:
+            json.dump(index, index_file)
+        tmp_index_filepath.replace(self._index_filepath)
+
+    def get_dem(self, s2_tile_id: str, dem_type: str, dem_source: str,
+                download_fn: Callable[[str, Path], None], dem_dirpath: Path)-> None:
+        """ Provide in dem_dirpath the DEM cells of the S2 tile
+
+        Args:
+            s2_tile_id (str): Sentinel-2 MGRS ID
+            dem_type (str): Type of DEM (e.g. srtm or copdem)
+            dem_source (str): Source of the DEM
+            download_fn (Callable[[str, Path], None]): Function which download the DEM cells of
+                a S2 tile in a directory, called only if the cells are not in the cache
+            dem_dirpath (Path): Directory where the cells are linked
+        """
+        tile_key = self._tile_key(dem_type, dem_source, s2_tile_id)
+        with self._key_lock(tile_key.replace('/', '_')):
+            with self.lock():
+                cell_relpaths = self._read_index().get(tile_key)
+                if cell_relpaths is not None and \
+                    all((self._data_dirpath /
+                         self._cell_key(dem_type, dem_source, cell_relpath)).exists()
+                        for cell_relpath in cell_relpaths):
+                    for cell_relpath in cell_relpaths:
+                        self._get(self._cell_key(dem_type, dem_source, cell_relpath),
+                                  dem_dirpath / cell_relpath)
+                    logger.info('DEM of %s retrieved from the cache %s', s2_tile_id,
+                                self._cache_dirpath)
+                    return
+
+            with self.tmp_dirpath() as download_dirpath:
+                logger.info('DEM of %s not in the cache, download it from %s', s2_tile_id,
+                            dem_source)
+                download_fn(s2_tile_id, download_dirpath)
+                cell_relpaths = sorted(str(cell_filepath.relative_to(download_dirpath))
+                                       for cell_filepath in download_dirpath.rglob('*')
+                                       if cell_filepath.is_file())
+                cell_keys = [self._cell_key(dem_type, dem_source, cell_relpath)
+                             for cell_relpath in cell_relpaths]
+
+                with self.lock():
+                    for cell_key, cell_relpath in zip(cell_keys, cell_relpaths):
+                        self._put(cell_key, download_dirpath / cell_relpath)
+                        link_path(self._data_dirpath / cell_key, dem_dirpath / cell_relpath)
+                    if cell_relpaths:
+                        index = self._read_index()
+                        index[tile_key] = cell_relpaths
+                        self._write_index(index)
+                    self._evict(keep_keys=cell_keys)
+
+class S1ProductCache(FileCache):
+    """ Cache of the S1 products shared between the S2 tiles and the runs
+
+    The products are keyed by their product id without extension (.SAFE) and stored with the
+    layout of the input directory of S1Tiling. A product requested concurrently by several
+    tiles is downloaded only once: the other requests wait for the download.
+    """
+
+    def __init__(self, cache_dirpath: Path, max_size: int=EWOC_S1_PRD_CACHE_MAX_SIZE) -> None:
+        super().__init__(cache_dirpath, max_size)
+
+    def get_s1_prd(self, s1_prd_id: str, s1_input_dirpath: Path,
+                   download_fn: Callable[[str, Path], bool])-> bool:
+        """ Provide the S1 product in the input directory of S1Tiling
+
+        Args:
+            s1_prd_id (str): Sentinel-1 product ID, with or without .SAFE
+            s1_input_dirpath (Path): Input directory where the product is linked
+            download_fn (Callable[[str, Path], bool]): Function which download the product in an
+                input directory, called only if the product is not in the cache. It returns
+                False if the product is not available.
+
+        Returns:
+            bool: False if the product is not available
+        """
+        key = s1_prd_id.split('.')[0]
+        with self._key_lock(key):
+            if self.get(key, s1_input_dirpath / key):
+                logger.info('S1 prd %s retrieved from the cache %s', key, self._cache_dirpath)
+                return True
+            with self.tmp_dirpath() as download_dirpath:
+                if not download_fn(s1_prd_id, download_dirpath):
+                    return False
+                self.put(key, download_dirpath / key, s1_input_dirpath / key)
+        return True
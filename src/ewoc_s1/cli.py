@@ -1,20 +1,38 @@
 
 import argparse
+from collections import Counter
+from concurrent.futures import Future, as_completed
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
+import json
 import logging
+import os
 from pathlib import Path
 import sys
 import shutil
 from tempfile import gettempdir
-from typing import Optional, List, Tuple
-
-from ewoc_dag.srtm_dag import get_srtm_from_s2_tile_id, get_srtm_1s_default_provider
-from ewoc_dag.copdem_dag import get_copdem_from_s2_tile_id
-from ewoc_dag.s1_dag import get_s1_default_provider
-
-from ewoc_s1 import EWOC_S1_DEM_DOWNLOAD_ERROR, EWOC_S1_UNEXPECTED_ERROR, __version__
-from ewoc_s1.generate_s1_ard import S1ARDProcessorBaseError, generate_s1_ard
-from ewoc_s1.utils import EwocWorkPlanReader
+from typing import ContextManager, Dict, Optional, List, Tuple
+
+from ewoc_s1 import (EWOC_S1_DEM_DOWNLOAD_ERROR, EWOC_S1_UNEXPECTED_ERROR,
+                     EWOC_S1_WORK_PLAN_ERROR, __version__)
+from ewoc_s1.ard_zarr import (EWOC_S1_ARD_SINK_GEOTIFF, EWOC_S1_ARD_SINKS, EWOC_S1_ZARR_DIRNAME,
+                              check_ard_sink)
+from ewoc_s1.cache import (EWOC_S1_DEM_CACHE_MAX_SIZE, EWOC_S1_PRD_CACHE_MAX_SIZE, DEMCache,
+                           S1ProductCache, link_path)
+from ewoc_s1.generate_s1_ard import (EWOC_S1_NB_DOWNLOAD_WORKERS, S1ARDProcessorBaseError,
+                                     generate_s1_ard)
+from ewoc_s1.instrumentation import get_stage_recorder, stage, stage_recorder
+from ewoc_s1.jobs import (EWOC_S1_JOB_QUEUE_FILENAME, EWOC_S1_JOB_REPORT_FILENAME, Job, JobQueue,
+                          JobResult, run_jobs)
+from ewoc_s1.journal import WpJournal
+from ewoc_s1.planner import PlanCalibration, estimate_units, summarize_units, write_plan
+from ewoc_s1.scheduler import (EWOC_S1_PREFETCH_BUDGET, S1InputPrefetcher, WpUnitResult,
+                               get_wp_unit_executor, log_wp_unit_results, submit_wp_unit_group,
+                               to_wp_unit_error)
+from ewoc_s1.utils import (EWOC_S1_MAX_CPU_ENV, EWOC_S1_MAX_RAM_ENV, ClusterConfig,
+                           EwocWorkPlanReader, WpUnit, group_units_by_products)
+from ewoc_s1.workspace import WorkspaceBudget, estimate_unit_footprint
 
 __author__ = "Mickael Savinaud"
 __copyright__ = "Mickael Savinaud"
@@ -51,13 +69,124 @@ def _get_default_prod_id()->str:
     str_now=datetime.now().strftime("%Y%m%dT%H%M%S")
     return f"0000_000_{str_now}"
 
+def _get_s1_default_provider()-> str:
+    # ewoc_dag is loaded by the commands which need it, not at the start of the CLI
+    from ewoc_dag.s1_dag import get_s1_default_provider  # pylint: disable=import-outside-toplevel
+    return get_s1_default_provider()
+
+def _get_dem_default_provider()-> str:
+    from ewoc_dag.srtm_dag import (  # pylint: disable=import-outside-toplevel
+        get_srtm_1s_default_provider)
+    return get_srtm_1s_default_provider()
+
+def _get_copdem(s2_tile_id:str, dem_dirpath:Path, dem_source:str)->None:
+    from ewoc_dag.copdem_dag import (  # pylint: disable=import-outside-toplevel
+        get_copdem_from_s2_tile_id)
+    get_copdem_from_s2_tile_id(s2_tile_id, dem_dirpath, source=dem_source)
+    for dem_path in dem_dirpath.rglob('Copernicus_DSM_COG_10*.tif'):
+        # Convert the name to the requested one by db id
+        dem_filepath= dem_path.parent /(dem_path.stem.split('_')[4]+dem_path.stem.split('_')[6]+'.tif')
+        dem_path.rename(dem_filepath)
+
+def _get_dem(s2_tile_id:str, dem_dirpath:Path, dem_source:str, dem_type:str,
+             dem_cache: Optional[DEMCache]=None)->None:
+    """ Retrieve the DEM (srtm or copdem) of the S2 tile in dem_dirpath, through the cache if provided """
+    from ewoc_dag.srtm_dag import (  # pylint: disable=import-outside-toplevel
+        get_srtm_from_s2_tile_id)
+    if dem_type == 'copdem':
+        download_fn = partial(_get_copdem, dem_source=dem_source)
+    else:
+        download_fn = partial(get_srtm_from_s2_tile_id, source=dem_source)
+    with stage('dem', tile=s2_tile_id):
+        if dem_cache is None:
+            download_fn(s2_tile_id, dem_dirpath)
+        else:
+            dem_cache.get_dem(s2_tile_id, dem_type, dem_source, download_fn, dem_dirpath)
+
+def _get_wp_dem(s2_tile_id: str, wd_dirpath_tile: Path, dem_source: str,
+                dem_cache: Optional[DEMCache])-> Optional[Path]:
+    """ Get the DEM of a tile of the work plan, None if it is not available """
+    wd_dirpath_tile.mkdir(exist_ok=True, parents=True)
+    if Path(dem_source).is_dir():
+        logger.info('Use local directory for DEM!')
+        return Path(dem_source)
+
+    dem_dirpath = wd_dirpath_tile / 'dem'
+    dem_dirpath.mkdir(exist_ok=True, parents=True)
+    try:
+        _get_dem(s2_tile_id, dem_dirpath, dem_source, 'srtm', dem_cache=dem_cache)
+    except:
+        logger.critical('No elevation available for %s!', s2_tile_id)
+        return None
+    return dem_dirpath
+
 def generate_s1_ard_wp(work_plan_filepath:Path,
                        out_dirpath_root:Path=Path(gettempdir()),
                        working_dirpath_root=Path(gettempdir()),
                        clean:bool=True, upload_outputs:bool=True,
-                       data_source:str=get_s1_default_provider(),
-                       dem_source:str=get_srtm_1s_default_provider(),
-                       production_id: Optional[str]=None):
+                       data_source: Optional[str]=None,
+                       dem_source: Optional[str]=None,
+                       production_id: Optional[str]=None,
+                       nb_format_workers: Optional[int]=None,
+                       nb_download_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                       dem_cache: Optional[DEMCache]=None,
+                       nb_parallel_units: int=1,
+                       shard: Optional[Tuple[int, int]]=None,
+                       resume: bool=False,
+                       journal_filepath: Optional[Path]=None,
+                       nb_prefetch_units: int=1,
+                       prefetch_budget: int=EWOC_S1_PREFETCH_BUDGET,
+                       workspace: Optional[WorkspaceBudget]=None,
+                       s1_prd_cache: Optional[S1ProductCache]=None,
+                       multi_tile: bool=False,
+                       cog: bool=False,
+                       ard_sink: str=EWOC_S1_ARD_SINK_GEOTIFF,
+                       zarr_dirpath: Optional[Path]=None)->List[WpUnitResult]:
+    """ Generate SAR ARD data for all the units (S2 tile and date) of a EWoC work plan
+
+    The units are processed concurrently by nb_parallel_units processes (bounded by the node
+    resources), each one with a share of the node resources. The failure of a unit does not
+    stop the processing of the other units.
+
+    If shard is provided as (k, N), only the units of the shard k (from 0 to N-1) of the work
+    plan split into N balanced shards are processed.
+
+    The units are recorded with their outputs in a journal as soon as they are completed (by
+    default in the working directory root, kept by the clean step). With resume, the units
+    already completed in the journal are skipped.
+
+    When the units are processed one after another, the S1 products of the next
+    nb_prefetch_units units are downloaded while the current unit is processed, within
+    prefetch_budget bytes (see S1InputPrefetcher).
+
+    If workspace is provided, each unit waits until its estimated footprint fits in the
+    workspace budget shared by the jobs of the node (see WorkspaceBudget).
+
+    If s1_prd_cache is provided, the S1 products are shared between the tiles through the cache
+    and the tiles are processed in an order which maximises the cache hits.
+
+    With multi_tile, the units of different tiles with the same S1 products are processed with
+    one S1Tiling run (see run_wp_unit_group).
+
+    With cog, the EWoC ARD files are Cloud Optimized GeoTIFF with overviews and statistics.
+
+    With the zarr ard_sink, the dates of each tile are appended to its Zarr store in
+    zarr_dirpath (by default EWOC_S1_ZARR_DIRNAME in out_dirpath_root) as soon as their unit
+    is processed, the store is shared by the concurrent units of the tile.
+
+    By default, the S1 products and the DEM come from the default providers of ewoc_dag.
+
+    Returns:
+        List[WpUnitResult]: the result of each unit, in the order of the units
+    """
+    check_ard_sink(ard_sink)
+    if data_source is None:
+        data_source = _get_s1_default_provider()
+    if dem_source is None:
+        dem_source = _get_dem_default_provider()
+    if zarr_dirpath is None:
+        # Shared by the units, whose output directories are distinct when they are concurrent
+        zarr_dirpath = out_dirpath_root / EWOC_S1_ZARR_DIRNAME
 
     if production_id is None:
         logger.warning("Use computed production id but we must used the one in wp")
@@ -70,54 +199,174 @@ def generate_s1_ard_wp(work_plan_filepath:Path,
     logger.info('Work plan: %s', work_plan_filepath)
 
     wp_reader = EwocWorkPlanReader(work_plan_filepath)
-    logger.info('%s tiles will be process: %s!',
-                len(wp_reader.tile_ids), wp_reader.tile_ids)
+    if shard is None:
+        wp_units = wp_reader.get_units()
+    else:
+        wp_units = wp_reader.get_shard_units(*shard)
+        logger.info('Shard %s/%s of the work plan: %s units', shard[0], shard[1], len(wp_units))
+
+    if journal_filepath is None:
+        journal_filepath = working_dirpath_root / f'ewoc_s1_wp_{work_plan_filepath.stem}_journal.jsonl'
+    wp_journal = WpJournal(journal_filepath)
+    if resume:
+        wp_units_completed = [wp_unit for wp_unit in wp_units if wp_journal.is_completed(wp_unit)]
+        logger.info('Resume: %s units already completed are skipped: %s', len(wp_units_completed),
+                    [wp_unit.unit_id for wp_unit in wp_units_completed])
+        wp_units = [wp_unit for wp_unit in wp_units if not wp_journal.is_completed(wp_unit)]
+
+    if s1_prd_cache is not None:
+        tile_rank = {tile_id: rank
+                     for rank, tile_id in enumerate(wp_reader.get_tile_ids_by_shared_products())}
+        wp_units.sort(key=lambda wp_unit: tile_rank[wp_unit.s2_tile_id])
+
+    s2_tile_ids = list(dict.fromkeys(wp_unit.s2_tile_id for wp_unit in wp_units))
+    logger.info('%s tiles will be process: %s!', len(s2_tile_ids), s2_tile_ids)
+
+    if multi_tile:
+        wp_unit_groups = group_units_by_products(wp_units)
+        logger.info('%s units will be process with %s S1Tiling runs', len(wp_units),
+                    len(wp_unit_groups))
+    else:
+        wp_unit_groups = [[wp_unit] for wp_unit in wp_units]
 
-    for s2_tile_id in wp_reader.tile_ids:
-        logger.info('Generate %s ARD for the S2 tile: %s!', wp_reader.get_nb_s1_prd(s2_tile_id),
-                                                            s2_tile_id)
+    nb_parallel_units = ClusterConfig(1).compute_nb_parallel_units(nb_parallel_units)
+    if nb_parallel_units > 1:
+        # The concurrent units already overlap their downloads with the processing
+        nb_prefetch_units = 0
 
-        wd_dirpath_tile = working_dirpath / s2_tile_id
-        wd_dirpath_tile.mkdir(exist_ok=True, parents=True)
+    def get_group_working_dirpath(units: List[WpUnit])-> Path:
+        return working_dirpath / units[0].s2_tile_id / units[0].acquisition_key
 
-        if not Path(dem_source).is_dir():
-            dem_dirpath = wd_dirpath_tile / 'dem'
-            dem_dirpath.mkdir(exist_ok=True, parents=True)
-            try:
-                get_srtm_from_s2_tile_id(s2_tile_id, dem_dirpath, source=dem_source)
-            except:
-                logger.critical('No elevation available!')
-                return
-        else:
-            logger.info('Use local directory for DEM!')
-            dem_dirpath = Path(dem_source)
+    results = []
+    futures: Dict[Future, List[WpUnit]] = {}
+    dem_dirpaths: Dict[str, Optional[Path]] = {}
+    nb_remaining_units = Counter(wp_unit.s2_tile_id for wp_unit in wp_units)
 
-        for date_key, s1_prd_ids in wp_reader.get_s1_prd_ids_by_date(s2_tile_id).items():
-            logger.info('%s will be process for %s!', s1_prd_ids, date_key)
+    def on_units_done(units: List[WpUnit])-> None:
+        for unit in units:
+            nb_remaining_units[unit.s2_tile_id] -= 1
+            if clean and nb_remaining_units[unit.s2_tile_id] == 0:
+                shutil.rmtree(working_dirpath / unit.s2_tile_id, ignore_errors=True)
 
-            wd_dirpath_tile_date = wd_dirpath_tile / date_key
-            wd_dirpath_tile_date.mkdir(exist_ok=True)
+    def on_group_done(future: Future)-> None:
+        units = futures.pop(future)
+        try:
+            group_results = future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            # e.g. BrokenProcessPool when the process of the units is killed (out of memory)
+            group_results = [to_wp_unit_error(unit, exc) for unit in units]
+        for result in group_results:
+            results.append(result)
+            get_stage_recorder().add(result.stage_records or [])
+            if result.succeeded:
+                wp_journal.record(result.unit, result.ard_checksums or {},
+                                  result.s1_ard_s3path)
+        on_units_done(units)
 
-            generate_s1_ard(s1_prd_ids, s2_tile_id, out_dirpath_root,
-                            dem_dirpath, wd_dirpath_tile_date,
-                            clean=clean, upload_outputs=upload_outputs,
-                            data_source=data_source)
+    try:
+        with get_wp_unit_executor(nb_parallel_units) as executor, \
+             S1InputPrefetcher([(units[0], get_group_working_dirpath(units))
+                                for units in wp_unit_groups],
+                               data_source, nb_download_workers=nb_download_workers,
+                               nb_units_ahead=nb_prefetch_units,
+                               disk_budget=prefetch_budget,
+                               s1_prd_cache=s1_prd_cache) as prefetcher:
+            for units in wp_unit_groups:
+                for s2_tile_id in dict.fromkeys(unit.s2_tile_id for unit in units):
+                    if s2_tile_id not in dem_dirpaths:
+                        logger.info('Generate %s ARD for the S2 tile: %s!',
+                                    nb_remaining_units[s2_tile_id], s2_tile_id)
+                        dem_dirpaths[s2_tile_id] = _get_wp_dem(s2_tile_id,
+                                                               working_dirpath / s2_tile_id,
+                                                               dem_source, dem_cache)
+
+                # The prefetch is recorded with the stages of the units it serves
+                prefetch_records = prefetcher.wait(units[0])
+                units_without_dem = [unit for unit in units
+                                     if dem_dirpaths[unit.s2_tile_id] is None]
+                results += [WpUnitResult(unit, EWOC_S1_DEM_DOWNLOAD_ERROR,
+                                         f'No elevation for {unit.s2_tile_id} from {dem_source}')
+                            for unit in units_without_dem]
+                on_units_done(units_without_dem)
+                group_s2_tile_ids = {unit.s2_tile_id for unit in units}
+                group_dem_dirpaths: Dict[str, Path] = {
+                    s2_tile_id: dem_dirpath for s2_tile_id, dem_dirpath in dem_dirpaths.items()
+                    if s2_tile_id in group_s2_tile_ids and dem_dirpath is not None}
+                units = [unit for unit in units if unit.s2_tile_id in group_dem_dirpaths]
+                if not units:
+                    get_stage_recorder().add(prefetch_records)
+                    continue
+
+                group_working_dirpath = get_group_working_dirpath(units)
+                dem_dirpath = group_dem_dirpaths[units[0].s2_tile_id]
+                if len(units) > 1 and not Path(dem_source).is_dir():
+                    # S1Tiling reads the DEM of all the tiles of the group in one directory
+                    dem_dirpath = group_working_dirpath / 'dem'
+                    for unit in units:
+                        link_path(group_dem_dirpaths[unit.s2_tile_id], dem_dirpath)
+
+                # Each unit uploads and cleans its own output directory
+                unit_out_dirpath_root = out_dirpath_root
+                if nb_parallel_units > 1:
+                    unit_out_dirpath_root = out_dirpath_root / units[0].unit_id
+                try:
+                    future = submit_wp_unit_group(executor, units, unit_out_dirpath_root,
+                                                  dem_dirpath, group_working_dirpath,
+                                                  clean=clean, upload_outputs=upload_outputs,
+                                                  data_source=data_source,
+                                                  production_id=production_id,
+                                                  nb_format_workers=nb_format_workers,
+                                                  nb_download_workers=nb_download_workers,
+                                                  nb_parallel_units=nb_parallel_units,
+                                                  workspace=workspace,
+                                                  prefetch_records=prefetch_records,
+                                                  s1_prd_cache=s1_prd_cache, cog=cog,
+                                                  ard_sink=ard_sink, zarr_dirpath=zarr_dirpath)
+                except Exception as exc:  # pylint: disable=broad-except
+                    # The pool is broken by a killed unit process, the units are reported failed
+                    future = Future()
+                    future.set_exception(exc)
+                futures[future] = units
+
+                # The completed units are recorded in the journal right away, so a work plan
+                # interrupted later resumes after them
+                for future in [future for future in futures if future.done()]:
+                    on_group_done(future)
+
+            for future in as_completed(list(futures)):
+                on_group_done(future)
+    finally:
+        # The units completed before an interruption, e.g. the previous unit whose uploads were
+        # waited in background, are recorded in the journal
+        for future in [future for future in futures if future.done()]:
+            on_group_done(future)
 
-            if clean:
-                shutil.rmtree(wd_dirpath_tile_date)
-        if clean:
-            shutil.rmtree(wd_dirpath_tile)
     if clean:
         shutil.rmtree(working_dirpath)
 
+    # The results of the concurrent units are sorted so the exit code of the work plan is the
+    # one of its first failed unit whatever the completion order
+    unit_ranks = {unit.unit_id: rank for rank, unit in enumerate(wp_units)}
+    results.sort(key=lambda result: unit_ranks[result.unit.unit_id])
+    log_wp_unit_results(results)
+    return results
+
 
 def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
                         out_dirpath_root:Path=Path(gettempdir()),
                         working_dirpath_root:Path=Path(gettempdir()),
                         clean:bool=True, upload_outputs:bool=True,
-                        data_source:str=get_s1_default_provider(),
-                        dem_source:str=get_srtm_1s_default_provider(),
-                        production_id: Optional[str]=None)->Tuple[int, str]:
+                        data_source: Optional[str]=None,
+                        dem_source: Optional[str]=None,
+                        production_id: Optional[str]=None,
+                        nb_format_workers: Optional[int]=None,
+                        nb_download_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                        dem_cache: Optional[DEMCache]=None,
+                        workspace: Optional[WorkspaceBudget]=None,
+                        s1_prd_cache: Optional[S1ProductCache]=None,
+                        cog: bool=False,
+                        ard_sink: str=EWOC_S1_ARD_SINK_GEOTIFF,
+                        zarr_dirpath: Optional[Path]=None)->Tuple[int, str]:
     """ Generate SAR ARD data from Sentinel-1 GRD products
 
     Args:
@@ -127,9 +376,17 @@ def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
         working_dirpath_root (Path, optional): Path where to write temporary data. Defaults to Path(gettempdir()).
         clean (bool, optional): Flag to indicate if you want clean directory or not. Defaults to True.
         upload_outputs (bool, optional): Flag to indicate if you want upload or not the products. Defaults to True.
-        data_source (str, optional): Provide the source of Sentinel-1 GRD products. Defaults to get_s1_default_provider().
-        dem_source (str, optional): Provide the source of DEM. Defaults to get_srtm_1s_default_provider().
+        data_source (str, optional): Provide the source of Sentinel-1 GRD products. Defaults to None (default provider of ewoc_dag).
+        dem_source (str, optional): Provide the source of DEM. Defaults to None (default SRTM provider of ewoc_dag).
         production_id (str, optional): Production ID. Defaults to None.
+        nb_format_workers (int, optional): Number of workers used to format the polarisations. Defaults to None (one per polarisation).
+        nb_download_workers (int, optional): Number of concurrent downloads of S1 products. Defaults to EWOC_S1_NB_DOWNLOAD_WORKERS.
+        dem_cache (DEMCache, optional): Persistent cache of the DEM cells. Defaults to None (no cache).
+        workspace (WorkspaceBudget, optional): Workspace budget shared by the jobs of the node. Defaults to None (no admission control).
+        s1_prd_cache (S1ProductCache, optional): Persistent cache of the S1 products. Defaults to None (no cache).
+        cog (bool, optional): Write the EWoC ARD files as Cloud Optimized GeoTIFF with overviews and statistics. Defaults to False.
+        ard_sink (str, optional): Output of the S1 ARD: geotiff (EWoC ARD files), zarr (Zarr store of the tile) or both. Defaults to geotiff.
+        zarr_dirpath (Path, optional): Directory of the Zarr stores of the tiles. Defaults to None (EWOC_S1_ZARR_DIRNAME in out_dirpath_root).
 
     Raises:
         S1DEMProcessorError: When error raise with the DEM retrieval
@@ -138,6 +395,10 @@ def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
     Returns:
         Tuple[int, str]: return the number of files uploaded and the s3 path
     """
+    if data_source is None:
+        data_source = _get_s1_default_provider()
+    if dem_source is None:
+        dem_source = _get_dem_default_provider()
     if production_id is None:
         production_id=_get_default_prod_id()
         logger.debug('production id: %s', production_id)
@@ -149,11 +410,7 @@ def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
         dem_dirpath = working_dirpath / 'dem' / s2_tile_id
         dem_dirpath.mkdir(exist_ok=True, parents=True)
         try:
-            get_copdem_from_s2_tile_id(s2_tile_id, dem_dirpath, source=dem_source)
-            for dem_path in dem_dirpath.rglob('Copernicus_DSM_COG_10*.tif'):
-                # Convert the name to the requested one by db id
-                dem_filepath= dem_path.parent /(dem_path.stem.split('_')[4]+dem_path.stem.split('_')[6]+'.tif')
-                dem_path.rename(dem_filepath)
+            _get_dem(s2_tile_id, dem_dirpath, dem_source, 'copdem', dem_cache=dem_cache)
         except:
             logger.error('No elevation available!')
             raise S1DEMProcessorError(f'No elevation for {s2_tile_id} from {dem_source}')
@@ -161,11 +418,21 @@ def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
         logger.info('Use local directory for DEM!')
         dem_dirpath = Path(dem_source)
 
+    reservation: ContextManager[None] = nullcontext()
+    if workspace is not None:
+        reservation = workspace.reserve(f'{s2_tile_id}_pid',
+            estimate_unit_footprint(len(s1_prd_ids)))
+
     try:
-        nb_s1_ard_files, s1_ard_s3path = generate_s1_ard(s1_prd_ids, s2_tile_id, out_dirpath_root,
-                        dem_dirpath, working_dirpath,
-                        clean=clean, upload_outputs=upload_outputs,
-                        data_source=data_source, production_id=production_id)
+        with reservation:
+            nb_s1_ard_files, s1_ard_s3path = generate_s1_ard(s1_prd_ids, s2_tile_id,
+                            out_dirpath_root, dem_dirpath, working_dirpath,
+                            clean=clean, upload_outputs=upload_outputs,
+                            data_source=data_source, production_id=production_id,
+                            nb_format_workers=nb_format_workers,
+                            nb_download_workers=nb_download_workers,
+                            s1_prd_cache=s1_prd_cache, cog=cog, ard_sink=ard_sink,
+                            zarr_dirpath=zarr_dirpath)
     except S1ARDProcessorBaseError as exc:
         logger.error(exc)
         raise S1ARDProcessorError(s2_tile_id, s1_prd_ids, data_source, exc.exit_code) from exc
@@ -179,12 +446,127 @@ def generate_s1_ard_from_pids(s1_prd_ids:List[str], s2_tile_id:str,
 
     return nb_s1_ard_files, s1_ard_s3path
 
+def generate_s1_ard_worker(job_queue: JobQueue,
+                           out_dirpath_root:Path=Path(gettempdir()),
+                           working_dirpath_root:Path=Path(gettempdir()),
+                           idle_timeout: Optional[float]=None,
+                           max_jobs: Optional[int]=None,
+                           clean:bool=True, **kwargs)->Tuple[int, int]:
+    """ Process the jobs of the queue as the prd_ids sub command in a resident process
+
+    The libraries (S1Tiling, OTB, GDAL) are loaded once and the caches (dem_cache,
+    s1_prd_cache) are shared by the jobs. Each job has its own output and working directories
+    so several workers can consume the same queue. The Zarr stores of the tiles are shared by
+    the jobs (by default in out_dirpath_root). The stages of each job are recorded apart and
+    written to the EWOC_S1_JOB_REPORT_FILENAME report of its output directory. The other
+    arguments are the ones of generate_s1_ard_from_pids. See run_jobs for idle_timeout and
+    max_jobs.
+
+    Returns:
+        Tuple[int, int]: the number of jobs processed and the number of jobs failed
+    """
+    if kwargs.get('zarr_dirpath') is None:
+        kwargs['zarr_dirpath'] = out_dirpath_root / EWOC_S1_ZARR_DIRNAME
+
+    def process_job(job: Job)-> JobResult:
+        job_out_dirpath_root = out_dirpath_root / f'ewoc_s1_job_{job.job_id}'
+        with stage_recorder() as recorder:
+            try:
+                return _process_job(job, job_out_dirpath_root)
+            finally:
+                recorder.write_report(job_out_dirpath_root / EWOC_S1_JOB_REPORT_FILENAME)
+
+    def _process_job(job: Job, job_out_dirpath_root: Path)-> JobResult:
+        job_working_dirpath_root = working_dirpath_root / f'ewoc_s1_job_{job.job_id}'
+        job_working_dirpath_root.mkdir(exist_ok=True, parents=True)
+        job_out_dirpath_root.mkdir(exist_ok=True, parents=True)
+        try:
+            with stage('job', tile=job.s2_tile_id):
+                nb_s1_ard_files, s1_ard_s3path = generate_s1_ard_from_pids(
+                    list(job.s1_prd_ids), job.s2_tile_id, job_out_dirpath_root,
+                    job_working_dirpath_root, clean=clean, production_id=job.production_id,
+                    **kwargs)
+        except S1DEMProcessorError as exc:
+            return JobResult(EWOC_S1_DEM_DOWNLOAD_ERROR, str(exc))
+        except S1ARDProcessorError as exc:
+            return JobResult(exc.exit_code, str(exc))
+        except BaseException as exc:
+            # generate_s1_ard_from_pids wraps the unexpected errors into BaseException
+            if isinstance(exc.__cause__, Exception):
+                return JobResult(EWOC_S1_UNEXPECTED_ERROR, repr(exc.__cause__))
+            raise
+        finally:
+            if clean:
+                shutil.rmtree(job_working_dirpath_root, ignore_errors=True)
+                # The output directory is kept only if it contains the files not uploaded
+                if not any(path.is_file() for path in job_out_dirpath_root.rglob('*')):
+                    shutil.rmtree(job_out_dirpath_root, ignore_errors=True)
+        return JobResult(0, '', nb_s1_ard_files, s1_ard_s3path)
+
+    nb_jobs, nb_failed = run_jobs(job_queue, process_job, idle_timeout=idle_timeout,
+                                  max_jobs=max_jobs)
+    logger.info('%s / %s jobs processed successfully!', nb_jobs - nb_failed, nb_jobs)
+    return nb_jobs, nb_failed
+
+def shard_wp(work_plan_filepath:Path, nb_shards:int, out_dirpath:Path)->List[Path]:
+    """ Split a EWoC work plan into nb_shards balanced work plans
+
+    Returns:
+        List[Path]: the path of the work plan of each shard
+    """
+    wp_reader = EwocWorkPlanReader(work_plan_filepath)
+    out_dirpath.mkdir(exist_ok=True, parents=True)
+    shard_filepaths = []
+    for shard_idx, shard_units in enumerate(wp_reader.shard_units(nb_shards)):
+        shard_filepath = out_dirpath / f'{work_plan_filepath.stem}_shard_{shard_idx}_of_{nb_shards}.json'
+        with open(shard_filepath, 'w', encoding='utf8') as shard_file:
+            json.dump(wp_reader.to_work_plan(shard_units), shard_file, indent=2)
+        logger.info('Shard %s/%s: %s units, %s products written to %s', shard_idx, nb_shards,
+                    len(shard_units), sum(len(unit.s1_prd_ids) for unit in shard_units),
+                    shard_filepath)
+        shard_filepaths.append(shard_filepath)
+    return shard_filepaths
+
+def plan_wp(work_plan_filepath: Path, plan_filepath: Path,
+            report_filepaths: Optional[List[Path]]=None, nb_parallel_units: int=1)-> Dict:
+    """ Estimate the costs of a EWoC work plan without processing it
+
+    The costs are calibrated with the stage reports of past runs if provided. The estimates of
+    the units are written to plan_filepath (CSV if its suffix is .csv, JSON otherwise).
+
+    Returns:
+        Dict: the summary of the plan
+    """
+    calibration = PlanCalibration()
+    if report_filepaths:
+        calibration = PlanCalibration.from_reports(report_filepaths)
+    unit_estimates = estimate_units(work_plan_filepath, calibration,
+                                    nb_parallel_units=nb_parallel_units)
+    write_plan(unit_estimates, plan_filepath, calibration)
+    plan_summary = summarize_units(unit_estimates, calibration)
+    logger.info('Plan of %s: %s units, %s products, %.1f GB to download, %.1f GB of ARD, '
+                '%.1f CPU hours, %.1f hours with %s parallel units', work_plan_filepath,
+                plan_summary['nb_units'], plan_summary['nb_products'],
+                plan_summary['download_bytes'] / 1024**3, plan_summary['output_bytes'] / 1024**3,
+                plan_summary['cpu_hours'], plan_summary['duration_hours'], nb_parallel_units)
+    return plan_summary
+
 # ---- CLI ----
 # The functions defined in this section are wrappers around the main Python
 # API allowing them to be called directly from the terminal as a CLI
 # executable/script.
 
 
+def _shard_arg(shard:str)->Tuple[int, int]:
+    """ Parse a shard argument k/N """
+    try:
+        shard_idx, nb_shards = [int(elt) for elt in shard.split('/')]
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f'Shard must be provided as k/N: {shard}') from exc
+    if not 0 <= shard_idx < nb_shards:
+        raise argparse.ArgumentTypeError(f'Shard index must be in [0, N-1]: {shard}')
+    return shard_idx, nb_shards
+
 def parse_args(args_cli:List[str]):
     """Parse command line parameters
 
@@ -222,12 +604,75 @@ def parse_args(args_cli:List[str]):
         help="Production ID that will be used to upload to s3 bucket, \
             by default it is computed internally")
 
-    parser.add_argument("--data-source", dest="data_source", help= 'Source of the S1 input data',
-                        type=str,
-                        default=get_s1_default_provider())
-    parser.add_argument("--dem-source", dest="dem_source", help= 'Source of the DEM data',
-                        type=str,
-                        default=get_srtm_1s_default_provider())
+    parser.add_argument("--cog",
+        action='store_true',
+        help= 'Write the EWoC ARD files as Cloud Optimized GeoTIFF with internal overviews \
+            and band statistics')
+
+    parser.add_argument("--ard-sink", dest="ard_sink",
+        help= 'Output of the S1 ARD: the EWoC ARD files (geotiff), the append of each date to \
+            a chunked and compressed Zarr store (time, y, x) by S2 tile (zarr) or both',
+        choices=EWOC_S1_ARD_SINKS,
+        default=EWOC_S1_ARD_SINK_GEOTIFF)
+    parser.add_argument("--zarr-dir", dest="zarr_dirpath",
+        help= f'Directory of the Zarr stores of the S2 tiles, \
+            by default {EWOC_S1_ZARR_DIRNAME} in the output dirpath',
+        type=Path)
+
+    parser.add_argument("--format-workers", dest="nb_format_workers",
+        help= 'Number of workers used to format the polarisations to EWoC ARD, \
+            by default one per polarisation bounded by the number of cores',
+        type=int)
+
+    parser.add_argument("--download-workers", dest="nb_download_workers",
+        help= 'Number of concurrent downloads of S1 products',
+        type=int,
+        default=EWOC_S1_NB_DOWNLOAD_WORKERS)
+
+    parser.add_argument("--dem-cache", dest="dem_cache_dirpath",
+        help= 'Directory of the persistent DEM cache shared between the runs and the tiles',
+        type=Path)
+    parser.add_argument("--dem-cache-size", dest="dem_cache_size",
+        help= 'Maximum size of the DEM cache in GB',
+        type=float,
+        default=EWOC_S1_DEM_CACHE_MAX_SIZE / 1024**3)
+
+    parser.add_argument("--s1-cache", dest="s1_prd_cache_dirpath",
+        help= 'Directory of the persistent cache of the S1 products shared between the runs and the tiles',
+        type=Path)
+    parser.add_argument("--s1-cache-size", dest="s1_prd_cache_size",
+        help= 'Maximum size of the S1 product cache in GB',
+        type=float,
+        default=EWOC_S1_PRD_CACHE_MAX_SIZE / 1024**3)
+
+    parser.add_argument("--workspace-budget", dest="workspace_budget",
+        help= 'Disk space in GB of the working dirpath shared by the jobs of the node: \
+            a unit waits until its estimated footprint fits in the budget',
+        type=float)
+
+    parser.add_argument("--max-cpu", dest="max_cpu",
+        help= 'Maximum number of cores used on the node, by default the limit of the cgroup',
+        type=int)
+    parser.add_argument("--max-ram", dest="max_ram",
+        help= 'Maximum RAM in MB used on the node, by default the limit of the cgroup',
+        type=int)
+
+    parser.add_argument("--report", dest="report_filepath",
+        help= 'JSON report of the resources used by each stage, \
+            by default ewoc_s1_report_<date>.json in the output dirpath',
+        type=Path)
+    parser.add_argument("--prometheus-textfile", dest="prometheus_filepath",
+        help= 'Write the resources used by each stage as Prometheus metrics in this file \
+            (textfile collector of node-exporter)',
+        type=Path)
+
+    parser.add_argument("--data-source", dest="data_source", help= 'Source of the S1 input data or directory of a '
+                        'S1 archive (only the files read by S1Tiling are copied from it), '
+                        'by default the default provider of ewoc_dag',
+                        type=str)
+    parser.add_argument("--dem-source", dest="dem_source", help= 'Source of the DEM data, by '
+                        'default the default SRTM provider of ewoc_dag',
+                        type=str)
     parser.add_argument(
         "-v",
         "--verbose",
@@ -257,6 +702,80 @@ def parse_args(args_cli:List[str]):
     parser_wp.add_argument(dest="work_plan",
         help="EWoC workplan in json format",
         type=Path)
+    parser_wp.add_argument("--parallel-units", dest="nb_parallel_units",
+        help="Number of units (S2 tile and date) processed concurrently on the node, \
+            bounded by the node resources",
+        type=int,
+        default=1)
+    parser_wp.add_argument("--shard", dest="shard",
+        help="Process only the shard k (from 0 to N-1) of the workplan split into N balanced shards",
+        type=_shard_arg,
+        metavar='k/N')
+    parser_wp.add_argument("--resume",
+        action='store_true',
+        help="Skip the units already completed in the journal of a previous run")
+    parser_wp.add_argument("--journal", dest="journal_filepath",
+        help="Journal of the completed units, by default in the working dirpath",
+        type=Path)
+
+    parser_wp.add_argument("--prefetch-units", dest="nb_prefetch_units",
+        help="Number of next units whose S1 products are downloaded during the processing \
+            of the current unit (when the units are not processed concurrently)",
+        type=int,
+        default=1)
+    parser_wp.add_argument("--prefetch-budget", dest="prefetch_budget",
+        help="Maximum size in GB of the S1 products prefetched",
+        type=float,
+        default=EWOC_S1_PREFETCH_BUDGET / 1024**3)
+    parser_wp.add_argument("--multi-tile", dest="multi_tile",
+        action='store_true',
+        help="Process the units of different tiles with the same S1 products with one \
+            S1Tiling run")
+
+    parser_shard = subparsers.add_parser('shard',
+        help='Split EWoC workplan into N balanced workplans')
+    parser_shard.add_argument(dest="work_plan",
+        help="EWoC workplan in json format",
+        type=Path)
+    parser_shard.add_argument(dest="nb_shards", help="Number of shards", type=int)
+
+    parser_plan = subparsers.add_parser('plan',
+        help='Validate EWoC workplan and estimate its costs without processing it')
+    parser_plan.add_argument(dest="work_plan",
+        help="EWoC workplan in json format",
+        type=Path)
+    parser_plan.add_argument("--calibration-reports", dest="report_filepaths",
+        help="Stage reports of past runs used to calibrate the costs",
+        type=Path,
+        nargs='+')
+    parser_plan.add_argument("--plan-format", dest="plan_format",
+        help="Format of the plan written in the output dirpath",
+        choices=['json', 'csv'],
+        default='json')
+    parser_plan.add_argument("--parallel-units", dest="nb_parallel_units",
+        help="Number of units processed concurrently in the schedule",
+        type=int,
+        default=1)
+
+    parser_submit = subparsers.add_parser('submit',
+        help='Submit a job (as prd_ids) to the queue of the worker sub command')
+    parser_submit.add_argument(dest="s2_tile_id", help="Sentinel-2 Tile ID", type=str)
+    parser_submit.add_argument(dest="s1_prd_ids", help="Sentinel-1 Product ids", nargs='+')
+    parser_submit.add_argument("--queue", dest="queue_filepath",
+        help=f"Job queue, by default {EWOC_S1_JOB_QUEUE_FILENAME} in the working dirpath",
+        type=Path)
+
+    parser_worker = subparsers.add_parser('worker',
+        help='Process the jobs of the queue in a resident process')
+    parser_worker.add_argument("--queue", dest="queue_filepath",
+        help=f"Job queue, by default {EWOC_S1_JOB_QUEUE_FILENAME} in the working dirpath",
+        type=Path)
+    parser_worker.add_argument("--idle-timeout", dest="idle_timeout",
+        help="Stop after this number of seconds without job, by default the worker never stops",
+        type=float)
+    parser_worker.add_argument("--max-jobs", dest="max_jobs",
+        help="Stop after this number of jobs",
+        type=int)
 
     args = parser.parse_args(args_cli)
 
@@ -278,19 +797,20 @@ def setup_logging(loglevel):
     )
 
 
-def main(args_cli:List[str]):
-    """Wrapper allowing :func:`generate_s1_ard` to be called with string arguments in a CLI fashion
+def _get_job_queue(args: argparse.Namespace)-> JobQueue:
+    if args.queue_filepath is None:
+        return JobQueue(args.working_dirpath / EWOC_S1_JOB_QUEUE_FILENAME)
+    return JobQueue(args.queue_filepath)
 
-    Instead of returning the value from :func:`fib`, it prints the result to the
-    ``stdout`` in a nicely formatted message.
-
-    Args:
-      args_cli (List[str]): command line parameters as list of strings
-          (for example  ``["--verbose", "42"]``).
-    """
-    args = parse_args(args_cli)
-    setup_logging(args.loglevel)
-    logger.debug(args)
+def _run_ard_subcommand(args: argparse.Namespace, dem_cache: Optional[DEMCache])-> None:
+    """ Run the prd_ids, wp or worker sub command, exit with the exit code of the error if any """
+    workspace = None
+    if args.workspace_budget is not None:
+        workspace = WorkspaceBudget(args.working_dirpath, int(args.workspace_budget * 1024**3))
+    s1_prd_cache = None
+    if args.s1_prd_cache_dirpath is not None:
+        s1_prd_cache = S1ProductCache(args.s1_prd_cache_dirpath,
+                                      int(args.s1_prd_cache_size * 1024**3))
 
     if args.subparser_name == "prd_ids":
 
@@ -302,7 +822,11 @@ def main(args_cli:List[str]):
                 args.s1_prd_ids, args.s2_tile_id,
                 args.out_dirpath, working_dirpath_root=args.working_dirpath,
                 clean=args.no_clean, upload_outputs=args.no_upload,
-                data_source=args.data_source, dem_source=args.dem_source, production_id=args.prod_id)
+                data_source=args.data_source, dem_source=args.dem_source, production_id=args.prod_id,
+                nb_format_workers=args.nb_format_workers,
+                nb_download_workers=args.nb_download_workers, dem_cache=dem_cache,
+                workspace=workspace, s1_prd_cache=s1_prd_cache, cog=args.cog,
+                ard_sink=args.ard_sink, zarr_dirpath=args.zarr_dirpath)
         except S1DEMProcessorError as exc:
             logger.critical(exc)
             sys.exit(EWOC_S1_DEM_DOWNLOAD_ERROR)
@@ -322,12 +846,86 @@ def main(args_cli:List[str]):
 
     elif args.subparser_name == "wp":
         logger.debug("Starting Generate S1 ARD for the workplan %s ...", args.work_plan)
-        generate_s1_ard_wp(args.work_plan, args.out_dirpath,
+        wp_results = generate_s1_ard_wp(args.work_plan, args.out_dirpath,
             args.working_dirpath,
             clean=args.no_clean, upload_outputs=args.no_upload,
             data_source=args.data_source, dem_source=args.dem_source,
-            production_id=args.prod_id)
+            production_id=args.prod_id, nb_format_workers=args.nb_format_workers,
+            nb_download_workers=args.nb_download_workers, dem_cache=dem_cache,
+            nb_parallel_units=args.nb_parallel_units, shard=args.shard,
+            resume=args.resume, journal_filepath=args.journal_filepath,
+            nb_prefetch_units=args.nb_prefetch_units,
+            prefetch_budget=int(args.prefetch_budget * 1024**3), workspace=workspace,
+            s1_prd_cache=s1_prd_cache, multi_tile=args.multi_tile, cog=args.cog,
+            ard_sink=args.ard_sink, zarr_dirpath=args.zarr_dirpath)
         logger.info("Generation of the EWoC workplan %s for S1 part is ended!", args.work_plan)
+        wp_errors = [wp_result for wp_result in wp_results if not wp_result.succeeded]
+        if wp_errors:
+            # The exit code of the first failed unit of the work plan
+            sys.exit(wp_errors[0].exit_code)
+
+    elif args.subparser_name == "worker":
+        generate_s1_ard_worker(_get_job_queue(args), args.out_dirpath, args.working_dirpath,
+            idle_timeout=args.idle_timeout, max_jobs=args.max_jobs,
+            clean=args.no_clean, upload_outputs=args.no_upload,
+            data_source=args.data_source, dem_source=args.dem_source,
+            nb_format_workers=args.nb_format_workers,
+            nb_download_workers=args.nb_download_workers, dem_cache=dem_cache,
+            workspace=workspace, s1_prd_cache=s1_prd_cache, cog=args.cog,
+            ard_sink=args.ard_sink, zarr_dirpath=args.zarr_dirpath)
+
+
+def main(args_cli:List[str]):
+    """Wrapper allowing :func:`generate_s1_ard` to be called with string arguments in a CLI fashion
+
+    Instead of returning the value from :func:`fib`, it prints the result to the
+    ``stdout`` in a nicely formatted message.
+
+    Args:
+      args_cli (List[str]): command line parameters as list of strings
+          (for example  ``["--verbose", "42"]``).
+    """
+    args = parse_args(args_cli)
+    setup_logging(args.loglevel)
+    logger.debug(args)
+
+    # Set through the environment to be inherited by the processes of the parallel units
+    if args.max_cpu is not None:
+        os.environ[EWOC_S1_MAX_CPU_ENV] = str(args.max_cpu)
+    if args.max_ram is not None:
+        os.environ[EWOC_S1_MAX_RAM_ENV] = str(args.max_ram)
+
+    dem_cache = None
+    if args.dem_cache_dirpath is not None:
+        dem_cache = DEMCache(args.dem_cache_dirpath, int(args.dem_cache_size * 1024**3))
+
+    if args.subparser_name in ["prd_ids", "wp", "worker"]:
+        report_filepath = args.report_filepath
+        if report_filepath is None:
+            report_filepath = args.out_dirpath / \
+                f'ewoc_s1_report_{datetime.now().strftime("%Y%m%dT%H%M%S")}.json'
+        try:
+            with stage('run', subcommand=args.subparser_name):
+                _run_ard_subcommand(args, dem_cache)
+        finally:
+            get_stage_recorder().write_report(report_filepath)
+            if args.prometheus_filepath is not None:
+                get_stage_recorder().write_prometheus_textfile(args.prometheus_filepath)
+
+    elif args.subparser_name == "submit":
+        job_id = _get_job_queue(args).submit(args.s2_tile_id, args.s1_prd_ids, args.prod_id)
+        logger.info('Job %s submitted for %s over %s', job_id, args.s1_prd_ids, args.s2_tile_id)
+        print(job_id)
+
+    elif args.subparser_name == "shard":
+        shard_wp(args.work_plan, args.nb_shards, args.out_dirpath)
+
+    elif args.subparser_name == "plan":
+        plan_summary = plan_wp(args.work_plan,
+            args.out_dirpath / f'{args.work_plan.stem}_plan.{args.plan_format}',
+            report_filepaths=args.report_filepaths, nb_parallel_units=args.nb_parallel_units)
+        if plan_summary['nb_invalid_products']:
+            sys.exit(EWOC_S1_WORK_PLAN_ERROR)
 
 
 def run():
@@ -1,12 +1,16 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
 import os
 import logging
-
-import rasterio
-import otbApplication as otb
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from xml.etree import ElementTree
 
 from ewoc_s1 import __version__
+from ewoc_s1.instrumentation import stage, submit_in_context
 from ewoc_s1.s1_prd_id import S1PrdIdInfo
 
 __author__ = "Mickael Savinaud"
@@ -15,22 +19,54 @@ __license__ = "Apache v2"
 
 logger = logging.getLogger(__name__)
 
+# numpy and rasterio are imported by the functions which use them: the modules which only need
+# the constants of this module (and the CLI) do not load GDAL.
+
+EWOC_S1_POLARISATIONS = ['VV', 'VH']
+# Number of buckets of the histogram written with the statistics of the COG outputs
+EWOC_S1_HISTOGRAM_NB_BUCKETS = 256
+
+def get_ewoc_ard_tile_relpath(s2_tile_id):
+    """ Path of the EWoC ARD of a S2 tile relative to the ARD output directory """
+    return Path('SAR') / s2_tile_id[:2] / s2_tile_id[2] / s2_tile_id[3:]
+
 def to_ewoc_s1_ard(s1_process_output_dirpath,
                    out_dirpath,
                    s1_prd_info,
                    s2_tile_id,
                    rename_only=False,
-                   clean_input_file=False):
+                   clean_input_file=False,
+                   s1_process_noized_output_dirpath=None,
+                   nb_workers=None,
+                   on_written=None,
+                   cog=False):
+    """ Convert the S1Tiling outputs of one product to the EWoC ARD format
+
+    The output of each polarisation is formatted concurrently by a pool of nb_workers threads
+    (by default one thread per polarisation).
+
+    If on_written is provided, it is called with the path of each EWoC ARD file as soon as the
+    file is written (from the thread which wrote it).
+
+    With clean_input_file, the S1Tiling outputs of a polarisation are removed as soon as it is
+    formatted.
+
+    With cog, the EWoC ARD files are Cloud Optimized GeoTIFF (see to_ewoc_s1_raster).
+
+    Returns the list of the EWoC ARD files.
+    """
+    import rasterio  # pylint: disable=import-outside-toplevel
 
     # TODO retrieve from GDAL MTD of the output s1_process file or from mtd of the input product
     relative_orbit= 'TODO'
     # TODO provide a more strict regex
-    s1_process_output_filepath_vv = sorted(s1_process_output_dirpath.glob('*vv*.tif'))[0]
-    s1_process_output_filepath_vh = sorted(s1_process_output_dirpath.glob('*vh*.tif'))[0]
+    s1_process_output_filepaths = {
+        pol: sorted(s1_process_output_dirpath.glob(f'*{pol.lower()}*.tif'))[0]
+        for pol in EWOC_S1_POLARISATIONS}
 
     # Retrieve orbit drection from the metadata of the file generated by S1 Tiling
     orbit_direction = 'DES'
-    with rasterio.open(s1_process_output_filepath_vv) as dataset_vv:
+    with rasterio.open(s1_process_output_filepaths['VV']) as dataset_vv:
         orbit_direction = dataset_vv.get_tag_item('ORBIT_DIRECTION')
 
     ewoc_output_dirname_elt = [s1_prd_info.mission_id,
@@ -40,7 +76,7 @@ def to_ewoc_s1_ard(s1_process_output_dirpath,
                                 s1_prd_info.absolute_orbit_number+s1_prd_info.mission_datatake_id+s1_prd_info.product_unique_id,
                                 s2_tile_id]
     ewoc_output_dirname= '_'.join(ewoc_output_dirname_elt)
-    ewoc_output_dirpath = out_dirpath / 'SAR' / s2_tile_id[:2] / s2_tile_id[2] / s2_tile_id[3:] / \
+    ewoc_output_dirpath = out_dirpath / get_ewoc_ard_tile_relpath(s2_tile_id) / \
         str(s1_prd_info.start_time.year) / s1_prd_info.start_time.date().strftime('%Y%m%d') / ewoc_output_dirname
     logger.debug('Create output directory: %s', ewoc_output_dirpath)
     ewoc_output_dirpath.mkdir(exist_ok=True, parents=True)
@@ -49,16 +85,17 @@ def to_ewoc_s1_ard(s1_process_output_dirpath,
     calibration_type = 'SIGMA0'
     output_file_ext= '.tif'
     ewoc_output_filename_elt = ewoc_output_dirname_elt + [calibration_type]
-    ewoc_output_filename_vv = '_'.join(ewoc_output_filename_elt + ['VV']) + output_file_ext
-    ewoc_output_filepath_vv = ewoc_output_dirpath / ewoc_output_filename_vv
-    logger.debug('Output VV filepath: %s', ewoc_output_filepath_vv)
-    ewoc_output_filename_vh = '_'.join(ewoc_output_filename_elt + ['VH']) + output_file_ext
-    ewoc_output_filepath_vh = ewoc_output_dirpath / ewoc_output_filename_vh
-    logger.debug('Output VH filepath: %s', ewoc_output_filepath_vh)
+    ewoc_output_filepaths = {}
+    for pol in EWOC_S1_POLARISATIONS:
+        ewoc_output_filepaths[pol] = ewoc_output_dirpath / \
+            ('_'.join(ewoc_output_filename_elt + [pol]) + output_file_ext)
+        logger.debug('Output %s filepath: %s', pol, ewoc_output_filepaths[pol])
 
     if rename_only:
-        s1_process_output_filepath_vv.rename(ewoc_output_filepath_vv)
-        s1_process_output_filepath_vh.rename(ewoc_output_filepath_vh)
+        for pol in EWOC_S1_POLARISATIONS:
+            s1_process_output_filepaths[pol].rename(ewoc_output_filepaths[pol])
+            if on_written is not None:
+                on_written(ewoc_output_filepaths[pol])
     else:
         # TODO manage the difference between 0 values and no data value (currently set to 0)
         ewoc_gdal_blocksize_20m = [512, 512]
@@ -66,60 +103,259 @@ def to_ewoc_s1_ard(s1_process_output_dirpath,
         ewoc_gdal_dtype = 'uint16'
         ewoc_nodata = 0
 
-        to_ewoc_s1_raster(s1_process_output_filepath_vv, ewoc_output_filepath_vv,
-            nodata_in=65535, nodata_out=65535)
-        to_ewoc_s1_raster(s1_process_output_filepath_vh, ewoc_output_filepath_vh,
-            nodata_in=65535, nodata_out=65535)
+        if nb_workers is None:
+            nb_workers = len(EWOC_S1_POLARISATIONS)
+        logger.debug('Format %s outputs with %s workers', len(EWOC_S1_POLARISATIONS), nb_workers)
+
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            futures = []
+            for pol in EWOC_S1_POLARISATIONS:
+                s1_process_noized_filepath = None
+                if s1_process_noized_output_dirpath is not None:
+                    s1_process_noized_filepath = \
+                        s1_process_noized_output_dirpath / s1_process_output_filepaths[pol].name
+                futures.append(submit_in_context(executor, _to_ewoc_s1_raster, pol,
+                    s1_process_output_filepaths[pol], ewoc_output_filepaths[pol],
+                    nodata_in=65535, nodata_out=65535,
+                    s1_process_noized_filepath=s1_process_noized_filepath,
+                    on_written=on_written, clean_input_file=clean_input_file, cog=cog))
+            for future in futures:
+                future.result()
+
+    return [ewoc_output_filepaths[pol] for pol in EWOC_S1_POLARISATIONS]
+
+def _to_ewoc_s1_raster(pol, s1_process_filepath, ewoc_filepath, on_written=None,
+                       clean_input_file=False, **kwargs):
+    """ Format the output of one polarisation as a recorded stage """
+    with stage('format', polarisation=pol):
+        to_ewoc_s1_raster(s1_process_filepath, ewoc_filepath, **kwargs)
+    if clean_input_file:
+        s1_process_filepath.unlink()
+        if kwargs.get('s1_process_noized_filepath') is not None:
+            kwargs['s1_process_noized_filepath'].unlink()
+    if on_written is not None:
+        on_written(ewoc_filepath)
+
+def to_ewoc_dn(sigma0, sigma0_noized=None, nodata_out=0):
+    """ Convert a block of S1Tiling sigma0 values to the EWoC ARD digital numbers
+
+    If the output without thermal noise removal is provided, its 0 values are the no data pixels
+    and it replaces the values clipped by the thermal noise removal. Otherwise the 0 values of
+    the denoised output are the no data pixels.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    if sigma0_noized is not None:
+        nodata_mask = sigma0_noized == 0
+        sigma0 = np.where(sigma0 < 1.01e-7, sigma0_noized, sigma0)
+    else:
+        nodata_mask = sigma0 == 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dn_values = 10. ** ((10. * np.log10(sigma0, dtype=np.float64) + 83.) / 20.)
+    dn_values = np.clip(np.nan_to_num(dn_values), 0, np.iinfo(np.uint16).max)
+    dn_values[nodata_mask] = nodata_out
+    dn_values[sigma0 == nodata_out] = nodata_out
+
+    return dn_values.astype(np.uint16)
+
+def get_overview_factors(width: int, height: int, blocksize: int)-> List[int]:
+    """ Decimation factors of the overviews, down to the first one which fits in a block
+
+    The factors divide the block size, so each block of the raster gives whole overview pixels.
+    """
+    factors = []
+    factor = 2
+    while -(-max(width, height) // (factor // 2)) > blocksize and blocksize % factor == 0:
+        factors.append(factor)
+        factor *= 2
+    return factors
 
-        if clean_input_file:
-            s1_process_output_filepath_vv.unlink()
-            s1_process_output_filepath_vh.unlink()
+def to_overview(dn_values, factor: int, nodata: int):
+    """ Average of the valid values of each factor x factor pixels, nodata if there is none """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    height, width = dn_values.shape
+    padded = np.full((-(-height // factor) * factor, -(-width // factor) * factor), nodata,
+                     dtype=np.uint16)
+    padded[:height, :width] = dn_values
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    valid = blocks != nodata
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.uint64)
+    overview = np.full(counts.shape, nodata, dtype=np.uint16)
+    overview[counts > 0] = (sums[counts > 0] + counts[counts > 0] // 2) // counts[counts > 0]
+    return overview
+
+class RasterStatistics():
+    """ Statistics and histogram of the valid values of an uint16 raster, updated block by block
+
+    The statistics are written as the STATISTICS_* band metadata of GDAL, the histogram with the
+    STATISTICS_HISTO* items used by GDAL for the Erdas Imagine format.
+    """
+
+    def __init__(self, nodata: int) -> None:
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        self._nodata = nodata
+        self._counts = np.zeros(np.iinfo(np.uint16).max + 1, dtype=np.int64)
+        self._nb_pixels = 0
+
+    def update(self, dn_values)-> None:
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        self._nb_pixels += dn_values.size
+        self._counts += np.bincount(dn_values[dn_values != self._nodata].ravel(),
+                                    minlength=self._counts.size)
+
+    def to_tags(self, nb_buckets: int=EWOC_S1_HISTOGRAM_NB_BUCKETS)-> Dict[str, str]:
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        nb_valid = int(self._counts.sum())
+        tags = {'STATISTICS_VALID_PERCENT': str(100. * nb_valid / max(self._nb_pixels, 1))}
+        if nb_valid == 0:
+            return tags
+        values = np.arange(self._counts.size, dtype=np.float64)
+        mean = float(np.dot(self._counts, values)) / nb_valid
+        variance = float(np.dot(self._counts, (values - mean) ** 2)) / nb_valid
+        valid_values = np.flatnonzero(self._counts)
+        min_value, max_value = int(valid_values[0]), int(valid_values[-1])
+        # Buckets of the same width between min - 0.5 and max + 0.5, as GDAL for integer values
+        bucket_idx = (np.arange(max_value - min_value + 1) * nb_buckets) // \
+            (max_value - min_value + 1)
+        histogram = np.bincount(bucket_idx, weights=self._counts[min_value:max_value + 1],
+                                minlength=nb_buckets).astype(np.int64)
+        tags.update({'STATISTICS_MINIMUM': str(min_value),
+                     'STATISTICS_MAXIMUM': str(max_value),
+                     'STATISTICS_MEAN': str(mean),
+                     'STATISTICS_STDDEV': str(variance ** 0.5),
+                     'STATISTICS_HISTOMIN': str(min_value - 0.5),
+                     'STATISTICS_HISTOMAX': str(max_value + 0.5),
+                     'STATISTICS_HISTONUMBINS': str(nb_buckets),
+                     'STATISTICS_HISTOBINVALUES': '|'.join(str(count) for count in histogram)})
+        return tags
+
+def _write_cog(raster_filepath: Path, overviews: Dict, cog_filepath: Path, compress: bool)-> None:
+    """ Write a COG from a raster and its overviews computed by decimation factor
+
+    The overviews are given to the COG driver through a VRT, so they are not computed again.
+    """
+    import rasterio  # pylint: disable=import-outside-toplevel
+    from rasterio.shutil import copy as rio_copy  # pylint: disable=import-outside-toplevel
+
+    with rasterio.open(raster_filepath) as dataset:
+        profile = dataset.profile
+    vrt_filepath = raster_filepath.with_suffix('.vrt')
+    rio_copy(raster_filepath, vrt_filepath, driver='VRT')
+    vrt = ElementTree.parse(vrt_filepath)
+    band = vrt.getroot().find('VRTRasterBand')
+    if band is None:
+        raise ValueError(f'No VRTRasterBand in the VRT {vrt_filepath} of {raster_filepath}')
+    for factor, overview in sorted(overviews.items()):
+        overview_filepath = raster_filepath.with_name(f'overview_{factor}.tif')
+        with rasterio.open(overview_filepath, 'w', driver='GTiff', width=overview.shape[1],
+                           height=overview.shape[0], count=1, dtype=overview.dtype,
+                           nodata=profile['nodata'], crs=profile['crs'],
+                           transform=profile['transform'] * rasterio.Affine.scale(factor),
+                           tiled=True,
+                           blockxsize=profile['blockxsize'],
+                           blockysize=profile['blockysize']) as dataset:
+            dataset.write(overview, 1)
+        overview_elt = ElementTree.SubElement(band, 'Overview')
+        ElementTree.SubElement(overview_elt, 'SourceFilename',
+                               relativeToVRT='1').text = overview_filepath.name
+        ElementTree.SubElement(overview_elt, 'SourceBand').text = '1'
+    vrt.write(vrt_filepath)
+
+    cog_options = {'BLOCKSIZE': profile['blockxsize'], 'OVERVIEWS': 'FORCE_USE_EXISTING'}
+    if compress:
+        cog_options['COMPRESS'] = 'DEFLATE'
+    rio_copy(vrt_filepath, cog_filepath, driver='COG', **cog_options)
 
 def to_ewoc_s1_raster(s1_process_filepath, ewoc_filepath,
                       blocksize=512,
-                      nodata_in=0, nodata_out=0, compress=True):
+                      nodata_in=0, nodata_out=0, compress=True,
+                      s1_process_noized_filepath=None,
+                      cog=False):
+    """ Format a S1Tiling output to the EWoC ARD raster in a single pass
 
-    s1_process_noized_dirpath = os.path.abspath(os.path.join(os.path.dirname(s1_process_filepath),"../../s1process_noized/"))
-    s1_process_noized_filepath = os.path.join(s1_process_noized_dirpath, os.path.basename(os.path.dirname(s1_process_filepath)))
-    s1_process_noized_filepath = os.path.join(s1_process_noized_filepath, os.path.basename(s1_process_filepath))
+    The inputs are read block by block with the output tiling, masked and scaled in memory and
+    written directly to the tiled uint16 output with the EWoC metadata.
 
-    msk = otb.Registry.CreateApplication("BandMath")
-    msk.SetParameterStringList("il", [str(s1_process_filepath), str(s1_process_noized_filepath)])
-    msk.SetParameterString("out", str(s1_process_filepath))
-    mask_exp = "im2b1==0?" + str(nodata_out) + ":(im1b1<1.01e-7?im2b1:im1b1)"
-    msk.SetParameterString("exp", mask_exp)
-    msk.ExecuteAndWriteOutput()
+    With cog, the output is a Cloud Optimized GeoTIFF with overviews (average of the valid
+    values) and the statistics and histogram of the band (see RasterStatistics). They are
+    computed from the blocks of the same pass, the raster is then written as COG from a
+    temporary uncompressed file.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import rasterio  # pylint: disable=import-outside-toplevel
 
-    app = otb.Registry.CreateApplication("BandMath")
-    app.SetParameterStringList("il", [str(s1_process_filepath)])
-    ewoc_output_filepath_vv_otb = str(ewoc_filepath) + '?'
-    #    if nodata_in != nodata_out:
-    ewoc_output_filepath_vv_otb += "&nodata="+ str(nodata_out)
+    with ExitStack() as stack:
+        dataset_in = stack.enter_context(rasterio.open(s1_process_filepath))
+        dataset_noized = None
+        if s1_process_noized_filepath is not None:
+            dataset_noized = stack.enter_context(rasterio.open(s1_process_noized_filepath))
 
-    ewoc_output_filepath_vv_otb += "&gdal:co:TILED=YES" + \
-        "&gdal:co:BLOCKXSIZE=" + str(blocksize) + \
-            "&gdal:co:BLOCKYSIZE=" + str(blocksize)
+        profile = {'driver': 'GTiff',
+                   'width': dataset_in.width,
+                   'height': dataset_in.height,
+                   'count': 1,
+                   'dtype': 'uint16',
+                   'crs': dataset_in.crs,
+                   'transform': dataset_in.transform,
+                   'nodata': nodata_out,
+                   'tiled': True,
+                   'blockxsize': blocksize,
+                   'blockysize': blocksize}
+        raster_filepath = ewoc_filepath
+        if cog:
+            tmp_dirpath = stack.enter_context(
+                TemporaryDirectory(prefix='.ewoc_s1_cog_', dir=ewoc_filepath.parent))
+            raster_filepath = Path(tmp_dirpath) / ewoc_filepath.name
+            statistics = RasterStatistics(nodata_out)
+            overviews = {factor: np.full((-(-dataset_in.height // factor),
+                                          -(-dataset_in.width // factor)),
+                                         nodata_out, dtype=np.uint16)
+                         for factor in get_overview_factors(dataset_in.width, dataset_in.height,
+                                                            blocksize)}
+        elif compress:
+            profile['compress'] = 'deflate'
+        logger.debug(profile)
 
-    if compress:
-        ewoc_output_filepath_vv_otb +="&gdal:co:COMPRESS=DEFLATE"
-
-    logger.debug(ewoc_output_filepath_vv_otb)
-    app.SetParameterString("out", str(ewoc_output_filepath_vv_otb))
-    app.SetParameterOutputImagePixelType("out", otb.ImagePixelType_uint16)
-    otb_exp = "im1b1==0?0:im1b1==" + str(nodata_out) + "?" + str(nodata_out) + ":10.^((10.*log10(im1b1)+83.)/20.)"
-    logger.debug(otb_exp)
-    app.SetParameterString("exp", otb_exp)
-
-    app.ExecuteAndWriteOutput()
-
-    # Modify output metadata
-    with rasterio.open(ewoc_filepath, 'r+') as dataset:
-        acq_date = dataset.get_tag_item('ACQUISITION_DATETIME').split(' ')[0]
-        dataset.update_tags(ACQUISITION_DATETIME=acq_date)
-        dataset.update_tags(TIFFTAG_DATETIME=str(datetime.now()))
-        dataset.update_tags(TIFFTAG_IMAGEDESCRIPTION='EWoC Sentinel-1 ARD')
+        tags = dataset_in.tags()
+        acq_datetime = tags.get('ACQUISITION_DATETIME')
+        if acq_datetime is not None:
+            tags['ACQUISITION_DATETIME'] = acq_datetime.split(' ')[0]
+        tags['TIFFTAG_DATETIME'] = str(datetime.now())
+        tags['TIFFTAG_IMAGEDESCRIPTION'] = 'EWoC Sentinel-1 ARD'
         processor_docker_version = os.getenv('EWOC_S1_DOCKER_VERSION')
         if processor_docker_version is None:
-            dataset.update_tags(TIFFTAG_SOFTWARE='EWoC S1 Processor '+ str(__version__))
+            tags['TIFFTAG_SOFTWARE'] = 'EWoC S1 Processor '+ str(__version__)
         else:
-            dataset.update_tags(TIFFTAG_SOFTWARE='EWoC S1 Processor '+ str(__version__) + ' / ' + processor_docker_version)
+            tags['TIFFTAG_SOFTWARE'] = 'EWoC S1 Processor '+ str(__version__) + ' / ' + processor_docker_version
+
+        with rasterio.open(raster_filepath, 'w', **profile) as dataset_out:
+            dataset_out.update_tags(**tags)
+
+            for _, window in dataset_out.block_windows(1):
+                sigma0_noized = None
+                if dataset_noized is not None:
+                    sigma0_noized = dataset_noized.read(1, window=window)
+                dn_values = to_ewoc_dn(dataset_in.read(1, window=window),
+                                       sigma0_noized, nodata_out=nodata_out)
+                dataset_out.write(dn_values, 1, window=window)
+                if cog:
+                    statistics.update(dn_values)
+                    for factor, overview in overviews.items():
+                        overview_values = to_overview(dn_values, factor, nodata_out)
+                        overview[window.row_off // factor:
+                                 window.row_off // factor + overview_values.shape[0],
+                                 window.col_off // factor:
+                                 window.col_off // factor + overview_values.shape[1]] = \
+                            overview_values
+
+            if cog:
+                dataset_out.update_tags(1, **statistics.to_tags())
+
+        if cog:
+            _write_cog(raster_filepath, overviews, ewoc_filepath, compress)
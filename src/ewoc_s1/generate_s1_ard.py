@@ -1,16 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 import logging
 from pathlib import Path
 import shutil
-from typing import Optional, List, Tuple
-
-from ewoc_dag.bucket.ewoc import EWOCARDBucket
-from ewoc_dag.s1_dag import get_s1_product, S1DagError
-from s1tiling.S1Processor import s1_process
+from typing import Callable, Dict, Optional, List, Tuple
 
 from ewoc_s1 import EWOC_S1_INPUT_DOWNLOAD_ERROR, EWOC_S1_PROCESSOR_ERROR, EWOC_S1_ARD_FORMAT_ERROR, __version__
+from ewoc_s1.ard_zarr import (EWOC_S1_ARD_SINK_GEOTIFF, EWOC_S1_ZARR_DIRNAME,
+                              append_to_ewoc_s1_zarr, check_ard_sink, get_ewoc_s1_zarr_dirpath,
+                              is_geotiff_sink, is_zarr_sink)
+from ewoc_s1.cache import S1ProductCache, link_path
 from ewoc_s1.s1_prd_id import S1PrdIdInfo
-from ewoc_s1.ewoc_s1_ard import to_ewoc_s1_ard
-from ewoc_s1.utils import ClusterConfig, to_s1tiling_configfile
+from ewoc_s1.ewoc_s1_ard import EWOC_S1_POLARISATIONS, get_ewoc_ard_tile_relpath, to_ewoc_s1_ard
+from ewoc_s1.instrumentation import stage
+from ewoc_s1.safe import LocalSafeStore, SafeStoreError, download_safe, open_zipped_safes
+from ewoc_s1.upload import ArdUploadError, ArdUploadQueue
+from ewoc_s1.utils import ClusterConfig, compute_sha256, to_s1tiling_configfile
 
 __author__ = "Mickael Savinaud"
 __copyright__ = "Mickael Savinaud"
@@ -18,6 +24,14 @@ __license__ = "MIT"
 
 logger = logging.getLogger(__name__)
 
+EWOC_S1_NB_DOWNLOAD_WORKERS = 3
+
+def get_s1_product(s1_prd_id: str, **kwargs)-> None:
+    """ Download a S1 product with ewoc_dag, which is loaded by the first download """
+    from ewoc_dag.s1_dag import (  # pylint: disable=import-outside-toplevel
+        get_s1_product as get_dag_s1_product)
+    get_dag_s1_product(s1_prd_id, **kwargs)
+
 class S1ARDProcessorBaseError(Exception):
     """ Base Error"""
     def __init__(self, exit_code, s1_prd_ids):
@@ -59,68 +73,270 @@ class S1ARDFormatError(S1ARDProcessorBaseError):
         return f"{self._message} Failed to convert EWoC ARD format!"
 
 
+def _get_s1_prd(s1_prd_id: str, s1_input_dir: Path, data_source: str)-> bool:
+    """ Download the S1 product in the input directory with the layout expected by S1Tiling
+
+    If data_source is a directory (e.g. the EO data archive mounted on the node), only the files
+    of the product read by S1Tiling are copied from it (see download_safe). If the product is
+    only available as a zip file, the zip file is linked in the input directory and opened
+    before the processing (see open_zipped_safes). The zip files delivered by the other sources
+    are opened in the same way instead of being extracted.
+
+    Returns:
+        bool: False if the product could not be downloaded
+    """
+    if len(s1_prd_id.split('.'))==1:
+        s1_prd_id = s1_prd_id + '.SAFE'
+    s1_prd_safe_dirpath = s1_input_dir / s1_prd_id
+    s1_prd_wsafe_dirpath =  s1_input_dir / s1_prd_safe_dirpath.stem
+    if s1_prd_wsafe_dirpath.exists():
+        logger.info('S1 prd %s is already available on disk', s1_prd_id)
+        return True
+
+    if Path(data_source).is_dir():
+        safe_store = LocalSafeStore(Path(data_source))
+        tmp_dirpath = s1_input_dir / f'.{s1_prd_wsafe_dirpath.name}.tmp'
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        try:
+            download_safe(safe_store, s1_prd_id, tmp_dirpath / s1_prd_id)
+        except SafeStoreError as exc:
+            zip_filepath = safe_store.get_zip_filepath(s1_prd_id)
+            if zip_filepath is not None:
+                link_path(zip_filepath, tmp_dirpath / f'{s1_prd_wsafe_dirpath.name}.zip')
+                tmp_dirpath.rename(s1_prd_wsafe_dirpath)
+                return True
+            logger.warning(exc)
+            logger.warning('No product download for %s from %s', s1_prd_id, data_source)
+            shutil.rmtree(tmp_dirpath, ignore_errors=True)
+            return False
+        tmp_dirpath.rename(s1_prd_wsafe_dirpath)
+        return True
+
+    from ewoc_dag.s1_dag import S1DagError  # pylint: disable=import-outside-toplevel
+    try:
+        get_s1_product(s1_prd_id,
+            out_root_dirpath=s1_input_dir,
+            source=data_source, safe_format=True)
+    except S1DagError as exc:
+        logger.warning(exc)
+        logger.warning('No product download for %s from %s', s1_prd_id, data_source)
+        # Clean empty dir to avoid confusion from s1tiling
+        if s1_prd_safe_dirpath.exists():
+            s1_prd_safe_dirpath.rmdir()
+        if s1_prd_wsafe_dirpath.exists():
+            s1_prd_wsafe_dirpath.rmdir()
+        return False
+
+    zip_filename = f'{s1_prd_wsafe_dirpath.name}.zip'
+    for zip_filepath in [s1_input_dir / zip_filename, s1_input_dir / f'{s1_prd_id}.zip',
+                         s1_prd_wsafe_dirpath / f'{s1_prd_id}.zip']:
+        if zip_filepath.is_file():
+            s1_prd_wsafe_dirpath.mkdir(exist_ok=True)
+            zip_filepath.rename(s1_prd_wsafe_dirpath / zip_filename)
+    if (s1_prd_wsafe_dirpath / zip_filename).is_file():
+        return True
+
+    if data_source == 'eodag':
+        s1_prd_safe_dirpath.rename(s1_prd_wsafe_dirpath)
+    else:
+        s1_prd_wsafe_dirpath.mkdir()
+        s1_prd_safe_dirpath.rename(s1_prd_wsafe_dirpath/s1_prd_safe_dirpath.name)
+    return True
+
+def get_s1_input_dirpath(working_dirpath: Path, s2_tile_id: str)-> Path:
+    """ Input directory of S1Tiling in the working directory of generate_s1_ard """
+    return working_dirpath / 'input' / s2_tile_id
+
+def get_s1_prds(s1_prd_ids: List[str], s1_input_dir: Path, data_source: str,
+                nb_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                s1_prd_cache: Optional[S1ProductCache]=None)-> List[str]:
+    """ Download the S1 products in the input directory with a pool of nb_workers threads
+
+    Args:
+        s1_prd_ids (List[str]): List of Sentinel-1 products ID
+        s1_input_dir (Path): Input directory read by S1Tiling
+        data_source (str): Source of the Sentinel-1 GRD products
+        nb_workers (int, optional): Maximum number of concurrent downloads.
+            Defaults to EWOC_S1_NB_DOWNLOAD_WORKERS.
+        s1_prd_cache (S1ProductCache, optional): Cache of the products shared between the
+            tiles and the runs. Defaults to None (no cache).
+
+    Returns:
+        List[str]: the products ID (without extension) which are not valid or not downloaded
+    """
+    s1_prd_ids_error=[]
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        futures = {}
+        for s1_prd_id in s1_prd_ids:
+            if s1_prd_id in futures:
+                continue
+            if not S1PrdIdInfo.is_valid(s1_prd_id):
+                logger.warning('S1 prd id %s is not valid!', s1_prd_id)
+            elif s1_prd_cache is not None:
+                futures[s1_prd_id] = executor.submit(s1_prd_cache.get_s1_prd, s1_prd_id,
+                    s1_input_dir, partial(_get_s1_prd, data_source=data_source))
+            else:
+                futures[s1_prd_id] = executor.submit(_get_s1_prd, s1_prd_id,
+                                                     s1_input_dir, data_source)
+
+        for s1_prd_id in s1_prd_ids:
+            if s1_prd_id not in futures or not futures[s1_prd_id].result():
+                # Clean the products which generated the error
+                s1_prd_ids_error.append(s1_prd_id.split('.')[0])
+
+    return s1_prd_ids_error
+
+def _free_s1process_tmp(s1process_dirpath_root: Path, s2_tile_ids: List[str])-> None:
+    """ Remove the temporary files of a S1Tiling run, only its outputs over the tiles are kept """
+    for path in s1process_dirpath_root.iterdir():
+        if path.is_dir() and path.name not in s2_tile_ids:
+            shutil.rmtree(path)
+
 def generate_s1_ard(s1_prd_ids: List[str], s2_tile_id: str, out_dirpath_root: Path,
                     dem_dirpath: Path, working_dirpath: Path,
                     clean: bool=True, upload_outputs: bool=True, data_source:str='creodias',
-                    production_id: Optional[str]=None)-> Tuple[int, str]:
+                    production_id: Optional[str]=None,
+                    nb_format_workers: Optional[int]=None,
+                    nb_download_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                    nb_parallel_units: int=1,
+                    ard_checksums: Optional[Dict[str, str]]=None,
+                    s1_prd_cache: Optional[S1ProductCache]=None,
+                    cog: bool=False,
+                    ard_sink: str=EWOC_S1_ARD_SINK_GEOTIFF,
+                    zarr_dirpath: Optional[Path]=None)-> Tuple[int, str]:
 
     """ Generate S1 ARD from the products identified by their product id for the S2 tile id
+
+    By default S1Tiling is run twice over the inputs: with and without thermal noise removal.
+    The output without thermal noise removal is used to identify the no data pixels and to
+    replace the values clipped by the denoising (SNAP convention).
+
+    The polarisations are formatted to the EWoC ARD format concurrently with nb_format_workers
+    threads, by default one per polarisation bounded by the number of cores.
+
+    The input products are downloaded concurrently with nb_download_workers threads. The
+    products already available in the input directory (e.g. prefetched) are not downloaded.
+    If s1_prd_cache is provided, the products are linked from the cache shared between the
+    tiles and the runs, and downloaded only if they are not in the cache.
+
+    When nb_parallel_units units are processed concurrently on the node, the resources given to
+    S1Tiling and to the formatting are a share of the node resources (see ClusterConfig).
+
+    With clean, the intermediate files are removed as soon as they are consumed: the inputs
+    after the last S1Tiling pass, the temporary files of S1Tiling after each pass and the
+    S1Tiling outputs of a polarisation once formatted.
+
+    If ard_checksums is provided, it is filled with the sha256 of each EWoC ARD file, keyed by
+    its path relative to the ARD output directory.
+
+    With upload_outputs, each EWoC ARD file is uploaded as soon as it is written (see
+    ArdUploadQueue), while the next ones are formatted. The uploads are waited once at the end
+    of the processing. The local copy of a file is removed once uploaded if clean.
+
+    With cog, the EWoC ARD files are Cloud Optimized GeoTIFF with overviews and statistics (see
+    to_ewoc_s1_raster).
+
+    ard_sink selects the outputs: the EWoC ARD files (geotiff), the append of the date to the
+    Zarr store of the tile in zarr_dirpath (zarr, see append_to_ewoc_s1_zarr) or both. By
+    default zarr_dirpath is EWOC_S1_ZARR_DIRNAME in out_dirpath_root. The Zarr stores are not
+    uploaded to the bucket and the EWoC ARD files are neither uploaded nor kept with zarr only.
+
+    The resources used by each stage are recorded (see ewoc_s1.instrumentation).
+
+    See generate_s1_ard_tiles to process several S2 tiles with the same S1Tiling run.
+    """
+
+    return generate_s1_ard_tiles(s1_prd_ids, [s2_tile_id], out_dirpath_root, dem_dirpath,
+                                 working_dirpath, clean=clean, upload_outputs=upload_outputs,
+                                 data_source=data_source, production_id=production_id,
+                                 nb_format_workers=nb_format_workers,
+                                 nb_download_workers=nb_download_workers,
+                                 nb_parallel_units=nb_parallel_units,
+                                 ard_checksums=ard_checksums,
+                                 s1_prd_cache=s1_prd_cache, cog=cog, ard_sink=ard_sink,
+                                 zarr_dirpath=zarr_dirpath)[s2_tile_id]
+
+def generate_s1_ard_tiles(s1_prd_ids: List[str], s2_tile_ids: List[str], out_dirpath_root: Path,
+                          dem_dirpath: Path, working_dirpath: Path,
+                          **kwargs)-> Dict[str, Tuple[int, str]]:
+    """ Generate S1 ARD from the products identified by their product id for several S2 tiles
+
+    S1Tiling is run once (per pass) over all the tiles, so the calibration of the products is
+    shared by the tiles. Its output over each tile is then formatted and uploaded as with
+    generate_s1_ard, whose other arguments are the same. dem_dirpath must cover all the tiles.
+
+    If tile_errors is provided, the errors raised by the formatting or the upload of a tile are
+    recorded by tile and the next tiles are processed, otherwise the error is raised. With
+    clean, the partial outputs of a failed tile are removed.
+
+    See start_s1_ard_tiles to wait for the uploads later.
+
+    Returns:
+        Dict[str, Tuple[int, str]]: the number of files uploaded and the s3 path by tile
+    """
+    return start_s1_ard_tiles(s1_prd_ids, s2_tile_ids, out_dirpath_root, dem_dirpath,
+                              working_dirpath, **kwargs)()
+
+def start_s1_ard_tiles(s1_prd_ids: List[str], s2_tile_ids: List[str], out_dirpath_root: Path,
+                       dem_dirpath: Path, working_dirpath: Path,
+                       clean: bool=True, upload_outputs: bool=True,
+                       data_source:str='creodias',
+                       production_id: Optional[str]=None,
+                       nb_format_workers: Optional[int]=None,
+                       nb_download_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                       nb_parallel_units: int=1,
+                       ard_checksums: Optional[Dict[str, str]]=None,
+                       s1_prd_cache: Optional[S1ProductCache]=None,
+                       tile_errors: Optional[Dict[str, Exception]]=None,
+                       cog: bool=False,
+                       ard_sink: str=EWOC_S1_ARD_SINK_GEOTIFF,
+                       zarr_dirpath: Optional[Path]=None
+                       )-> Callable[[], Dict[str, Tuple[int, str]]]:
+    """ Generate S1 ARD for several S2 tiles as generate_s1_ard_tiles up to the upload wait
+
+    The EWoC ARD files of the tiles are formatted and queued for upload. The function returned
+    waits for their upload and returns the results of generate_s1_ard_tiles, whose arguments
+    are the same. It can be called from another thread, e.g. while the next products are
+    processed.
+
+    Returns:
+        Callable[[], Dict[str, Tuple[int, str]]]: the function waiting for the uploads
     """
+    # S1Tiling loads the OTB applications, it is imported only when it is run
+    from s1tiling.S1Processor import s1_process  # pylint: disable=import-outside-toplevel
+
+    # Fail before the processing if the sink is not available
+    check_ard_sink(ard_sink)
+    if is_zarr_sink(ard_sink) and zarr_dirpath is None:
+        zarr_dirpath = out_dirpath_root / EWOC_S1_ZARR_DIRNAME
 
     out_dirpath = out_dirpath_root / 'ewoc_s1_ard'
     out_dirpath.mkdir(exist_ok=True)
+    s2_tile_label = ','.join(s2_tile_ids)
 
     logger.info('Product ids: %s', s1_prd_ids)
-    logger.info('s2_tile_id: %s', s2_tile_id)
+    logger.info('s2_tile_ids: %s', s2_tile_ids)
     logger.info('out_dirpath: %s', out_dirpath)
     logger.info('dem_dirpath: %s', dem_dirpath)
     logger.info('working_dirpath: %s', working_dirpath)
 
-    s1_input_dir = working_dirpath / 'input' / s2_tile_id
+    s1_input_dir = get_s1_input_dirpath(working_dirpath, s2_tile_ids[0])
     s1_input_dir.mkdir(exist_ok=True, parents=True)
 
     wd_s1process_dirpath_root = working_dirpath / 's1process'
     wd_s1process_dirpath_root.mkdir(exist_ok=True)
-    output_s1process_dirpath = wd_s1process_dirpath_root / s2_tile_id
 
     wd_s1process_noized_dirpath_root = working_dirpath / 's1process_noized'
     wd_s1process_noized_dirpath_root.mkdir(exist_ok=True)
-    output_s1process_noized_dirpath = wd_s1process_noized_dirpath_root / s2_tile_id
 
-    s1_prd_ids_error=[]
-    for s1_prd_id in s1_prd_ids:
-        if S1PrdIdInfo.is_valid(s1_prd_id):
-            if len(s1_prd_id.split('.'))==1:
-                s1_prd_id = s1_prd_id + '.SAFE'
-            s1_prd_safe_dirpath = s1_input_dir / s1_prd_id
-            s1_prd_wsafe_dirpath =  s1_input_dir / s1_prd_safe_dirpath.stem
-            if not s1_prd_wsafe_dirpath.exists():
-                try:
-                    get_s1_product(s1_prd_id,
-                        out_root_dirpath=s1_input_dir,
-                        source=data_source, safe_format=True)
-                except S1DagError as exc:
-                    logger.warning(exc)
-                    logger.warning('No product download for %s from %s', s1_prd_id, data_source)
-                    # Clean the products which generated the error
-                    s1_prd_ids_error.append(s1_prd_id.split('.')[0])
-                    # Clean empty dir to avoid confusion from s1tiling
-                    if s1_prd_safe_dirpath.exists():
-                        s1_prd_safe_dirpath.rmdir()
-                    if s1_prd_wsafe_dirpath.exists():
-                        s1_prd_wsafe_dirpath.rmdir()
-
-                else:
-                    if data_source == 'eodag':
-                        s1_prd_safe_dirpath.rename(s1_prd_wsafe_dirpath)
-                    else:
-                        s1_prd_wsafe_dirpath.mkdir()
-                        s1_prd_safe_dirpath.rename(s1_prd_wsafe_dirpath/s1_prd_safe_dirpath.name)
-            else:
-                logger.info('S1 prd %s is already available on disk', s1_prd_id)
-        else:
-            logger.warning('S1 prd id %s is not valid!', s1_prd_id)
-            s1_prd_ids_error.append(s1_prd_id.split('.')[0])
+    with stage('download', tile=s2_tile_label, nb_products=str(len(s1_prd_ids))):
+        s1_prd_ids_error = get_s1_prds(s1_prd_ids, s1_input_dir, data_source,
+                                       nb_workers=nb_download_workers,
+                                       s1_prd_cache=s1_prd_cache)
+        for s1_prd_id_error in open_zipped_safes(s1_input_dir):
+            shutil.rmtree(s1_input_dir / s1_prd_id_error)
+            if s1_prd_id_error in s1_prd_ids:
+                s1_prd_ids_error.append(s1_prd_id_error)
 
     if not any(s1_input_dir.iterdir()):
         s1_input_dir.rmdir()
@@ -136,65 +352,189 @@ def generate_s1_ard(s1_prd_ids: List[str], s2_tile_id: str, out_dirpath_root: Pa
                             s1_prd_id_error)
             s1_prd_ids.remove(s1_prd_id_error)
 
+    cluster_config = ClusterConfig(len(s1_prd_ids), nb_parallel_units)
+
     try:
-        s1_process(str(to_s1tiling_configfile(wd_s1process_dirpath_root,
-                                            s1_input_dir,
-                                            dem_dirpath,
-                                            wd_s1process_dirpath_root,
-                                            s2_tile_id, ClusterConfig(len(s1_prd_ids)))))
+        with stage('s1_process', tile=s2_tile_label, nb_products=str(len(s1_prd_ids))):
+            s1_process(str(to_s1tiling_configfile(wd_s1process_dirpath_root,
+                                                  s1_input_dir,
+                                                  dem_dirpath,
+                                                  wd_s1process_dirpath_root,
+                                                  s2_tile_ids, cluster_config)))
         logger.info('S1 process with thermal noise removal done!')
+        if clean:
+            _free_s1process_tmp(wd_s1process_dirpath_root, s2_tile_ids)
     except:
         if clean:
             shutil.rmtree(s1_input_dir)
-        raise S1ProcessorError(s1_prd_ids, s2_tile_id)
+        raise S1ProcessorError(s1_prd_ids, s2_tile_label)
 
     try:
-        s1_process(str(to_s1tiling_configfile(wd_s1process_noized_dirpath_root,
-                                            s1_input_dir,
-                                            dem_dirpath,
-                                            wd_s1process_noized_dirpath_root,
-                                            s2_tile_id,
-                                            ClusterConfig(len(s1_prd_ids)),
-                                            remove_thermal_noise=False)))
+        with stage('s1_process_noized', tile=s2_tile_label,
+                   nb_products=str(len(s1_prd_ids))):
+            s1_process(str(to_s1tiling_configfile(wd_s1process_noized_dirpath_root,
+                                                  s1_input_dir,
+                                                  dem_dirpath,
+                                                  wd_s1process_noized_dirpath_root,
+                                                  s2_tile_ids,
+                                                  cluster_config,
+                                                  remove_thermal_noise=False)))
         logger.info('S1 process without thermal noise removal done!')
+        if clean:
+            _free_s1process_tmp(wd_s1process_noized_dirpath_root, s2_tile_ids)
     except:
-        raise S1ProcessorError(s1_prd_ids, s2_tile_id, with_thermal_noise_removal=False)
+        raise S1ProcessorError(s1_prd_ids, s2_tile_label, with_thermal_noise_removal=False)
     finally:
         if clean:
             shutil.rmtree(s1_input_dir)
 
+    def on_tile_error(s2_tile_id: str, exc: Exception)-> None:
+        if tile_errors is None:
+            raise exc
+        logger.error('Generation of the S1 ARD of %s failed: %s', s2_tile_id, exc)
+        tile_errors[s2_tile_id] = exc
+        if clean:
+            shutil.rmtree(out_dirpath / get_ewoc_ard_tile_relpath(s2_tile_id), ignore_errors=True)
+
+    # The EWoC ARD files of all the tiles are uploaded while the next ones are formatted, the
+    # upload queue is closed once its uploads are waited
+    exit_stack = ExitStack()
+    upload_queue = None
+    if upload_outputs and is_geotiff_sink(ard_sink):
+        logger.info('Push the EWoC ARD files of %s to EWoC ARD bucket once written',
+                    s2_tile_label)
+        upload_queue = exit_stack.enter_context(
+            ArdUploadQueue(out_dirpath, production_id, delete_uploaded=clean))
+
+    try:
+        for s2_tile_id in s2_tile_ids:
+            try:
+                _to_ewoc_s1_ard_tile(s1_prd_ids, s2_tile_id,
+                    wd_s1process_dirpath_root / s2_tile_id,
+                    wd_s1process_noized_dirpath_root / s2_tile_id,
+                    out_dirpath, clean=clean,
+                    nb_workers=cluster_config.compute_nb_workers(len(EWOC_S1_POLARISATIONS),
+                                                                 nb_format_workers),
+                    ard_checksums=ard_checksums, upload_queue=upload_queue, cog=cog,
+                    ard_sink=ard_sink, zarr_dirpath=zarr_dirpath)
+            except Exception as exc:
+                on_tile_error(s2_tile_id, exc)
+    except BaseException:
+        exit_stack.close()
+        raise
+    finally:
+        if clean:
+            shutil.rmtree(wd_s1process_dirpath_root)
+            shutil.rmtree(wd_s1process_noized_dirpath_root)
+
+    def join_uploads()-> Dict[str, Tuple[int, str]]:
+        tile_results = {}
+        with exit_stack:
+            for s2_tile_id in s2_tile_ids:
+                if tile_errors is not None and s2_tile_id in tile_errors:
+                    continue
+                try:
+                    tile_results[s2_tile_id] = _join_ard_tile_uploads(upload_queue, out_dirpath,
+                                                                      s2_tile_id)
+                except Exception as exc:
+                    on_tile_error(s2_tile_id, exc)
+
+        # if sucess remove from disk the data pushed to the bucket
+        if clean and not tile_errors:
+            shutil.rmtree(out_dirpath)
+
+        return tile_results
+
+    return join_uploads
+
+def _to_ewoc_s1_ard_tile(s1_prd_ids: List[str], s2_tile_id: str,
+                         output_s1process_dirpath: Path,
+                         output_s1process_noized_dirpath: Path,
+                         out_dirpath: Path, clean: bool, nb_workers: int,
+                         ard_checksums: Optional[Dict[str, str]],
+                         upload_queue: Optional[ArdUploadQueue]=None,
+                         cog: bool=False,
+                         ard_sink: str=EWOC_S1_ARD_SINK_GEOTIFF,
+                         zarr_dirpath: Optional[Path]=None)-> None:
+    """ Format the S1Tiling outputs over a tile to EWoC ARD and queue their upload
+
+    Each EWoC ARD file is queued to upload_queue as soon as it is written. With the zarr sink,
+    the EWoC ARD files are appended to the Zarr store of the tile before their upload (geotiff
+    and zarr sinks) or their removal (zarr sink only). They are uploaded even if the append
+    fails, they are removed only once appended.
+
+    Raises:
+        ValueError: if zarr_dirpath is not provided with the zarr sink
+    """
+    if is_zarr_sink(ard_sink) and zarr_dirpath is None:
+        raise ValueError(f'No directory for the Zarr store of {s2_tile_id} with the '
+                         f'{ard_sink} sink')
+
+    def _on_ard_written(ard_filepath: Path)-> None:
+        # The checksum is computed before the local copy is removed by the upload
+        if ard_checksums is not None and is_geotiff_sink(ard_sink):
+            with stage('checksum', tile=s2_tile_id):
+                ard_checksums[str(ard_filepath.relative_to(out_dirpath))] = \
+                    compute_sha256(ard_filepath)
+        if upload_queue is not None and not is_zarr_sink(ard_sink):
+            upload_queue.submit(ard_filepath)
+
+    s1_prd_info = S1PrdIdInfo.parse(s1_prd_ids[0])
     try:
-        to_ewoc_s1_ard( output_s1process_dirpath, out_dirpath,
-                        S1PrdIdInfo(s1_prd_ids[0]), s2_tile_id,
-                        rename_only=False, clean_input_file=clean)
+        with stage('ard_format', tile=s2_tile_id):
+            ewoc_filepaths = to_ewoc_s1_ard(output_s1process_dirpath, out_dirpath,
+                s1_prd_info, s2_tile_id,
+                rename_only=False, clean_input_file=clean,
+                s1_process_noized_output_dirpath=output_s1process_noized_dirpath,
+                nb_workers=nb_workers,
+                on_written=_on_ard_written, cog=cog)
         logger.info('Successful convertion to EWoC ARD format!')
         print('Successful convertion to EWoC ARD format!')
     except:
         raise S1ARDFormatError(s1_prd_ids)
+
+    if not is_zarr_sink(ard_sink) or zarr_dirpath is None:
+        return
+
+    try:
+        with stage('zarr_append', tile=s2_tile_id):
+            append_to_ewoc_s1_zarr(get_ewoc_s1_zarr_dirpath(zarr_dirpath, s2_tile_id),
+                                   ewoc_filepaths[0].parent.name,
+                                   s1_prd_info.start_time,
+                                   dict(zip(EWOC_S1_POLARISATIONS, ewoc_filepaths)))
+    except:
+        raise S1ARDFormatError(s1_prd_ids)
     finally:
-        if clean:
-            shutil.rmtree(wd_s1process_dirpath_root)
+        # The files are read by the append, they are uploaded once appended or if it failed
+        if upload_queue is not None:
+            for ewoc_filepath in ewoc_filepaths:
+                upload_queue.submit(ewoc_filepath)
 
-    nb_s1_ard_file= 0
-    s1_ard_s3path=''
-    if upload_outputs:
-        try:
-            logger.info('Try to push %s to EWoC ARD bucket', out_dirpath)
-            nb_s1_ard_file, __unused, s1_ard_s3path = \
-                EWOCARDBucket().upload_ard_prd(out_dirpath, production_id)
-            logger.info("Succeed to upload %s S1 ARD files to %s",
-                nb_s1_ard_file, s1_ard_s3path)
-            print(f"INFO Succeed to upload {nb_s1_ard_file} S1 ARD files to {s1_ard_s3path}")
-        except:
-            logger.error('Push to EWoC ARD bucket failed!')
-            print('ERROR: Push to EWoC ARD bucket failed!')
-            raise RuntimeError("Generate S1 ARD failed during the upload of ARD data to bucket")
-    else:
+    if clean and not is_geotiff_sink(ard_sink):
+        for ewoc_filepath in ewoc_filepaths:
+            ewoc_filepath.unlink()
+
+def _join_ard_tile_uploads(upload_queue: Optional[ArdUploadQueue], out_dirpath: Path,
+                           s2_tile_id: str)-> Tuple[int, str]:
+    """ Wait for the uploads of the EWoC ARD files of a tile
+
+    Returns:
+        Tuple[int, str]: the number of files uploaded and the s3 path
+    """
+    if upload_queue is None:
         logger.info('No upload to bucket!')
         print('INFO: No upload to bucket!')
+        return 0, ''
 
-    # if sucess remove from disk the data pushed to the bucket
-    if clean:
-        shutil.rmtree(out_dirpath)
-
+    try:
+        with stage('upload_wait', tile=s2_tile_id):
+            nb_s1_ard_file, s1_ard_s3path = upload_queue.join(
+                out_dirpath / get_ewoc_ard_tile_relpath(s2_tile_id))
+        logger.info("Succeed to upload %s S1 ARD files to %s",
+            nb_s1_ard_file, s1_ard_s3path)
+        print(f"INFO Succeed to upload {nb_s1_ard_file} S1 ARD files to {s1_ard_s3path}")
+    except ArdUploadError as exc:
+        logger.error('Push to EWoC ARD bucket failed: %s', exc)
+        print('ERROR: Push to EWoC ARD bucket failed!')
+        raise RuntimeError("Generate S1 ARD failed during the upload of ARD data to bucket") from exc
     return nb_s1_ard_file, s1_ard_s3path
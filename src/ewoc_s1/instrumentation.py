@@ -0,0 +1,174 @@
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import resource
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import psutil
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_PROMETHEUS_PREFIX = 'ewoc_s1_stage'
+
+class StageRecord(NamedTuple):
+    """ Resources used by a stage of the processing
+
+    The CPU time is the time of all the threads of the process and of the child processes
+    waited during the stage (e.g. S1Tiling and OTB). The bytes read and written are counted for
+    the whole process and the peak RSS is the high-water mark of the process and its children at
+    the end of the stage. So they include the activity of the stages run concurrently (e.g. the
+    formatting of the other polarisation, the uploads or the prefetch of the next unit): the
+    costs of overlapping stages are not additive.
+    """
+    name: str
+    labels: Dict[str, str]
+    start: str
+    wall_time: float
+    cpu_time: float
+    peak_rss: int
+    read_bytes: int
+    write_bytes: int
+    succeeded: bool = True
+
+def _cpu_time()-> float:
+    # The stages run their work in other threads (OTB, downloads, formatting of the
+    # polarisations), so the usage of the whole process is measured
+    cpu_time = 0.
+    for usage in [resource.getrusage(resource.RUSAGE_SELF),
+                  resource.getrusage(resource.RUSAGE_CHILDREN)]:
+        cpu_time += usage.ru_utime + usage.ru_stime
+    return cpu_time
+
+def _peak_rss()-> int:
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def _io_bytes()-> List[int]:
+    try:
+        io_counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return [0, 0]
+    return [io_counters.read_bytes, io_counters.write_bytes]
+
+class StageRecorder():
+    """ Thread safe list of the stage records of a run """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._records: List[StageRecord] = []
+
+    @property
+    def records(self)-> List[StageRecord]:
+        with self._lock:
+            return list(self._records)
+
+    def add(self, records: List[StageRecord])-> None:
+        with self._lock:
+            self._records.extend(records)
+
+    def to_report(self)-> Dict[str, Any]:
+        return {'created': datetime.now().isoformat(),
+                'pid': os.getpid(),
+                'stages': [record._asdict() for record in self.records]}
+
+    def write_report(self, report_filepath: Path)-> None:
+        """ Write the stage records as a JSON report """
+        report_filepath.parent.mkdir(exist_ok=True, parents=True)
+        with open(report_filepath, 'w', encoding='utf8') as report_file:
+            json.dump(self.to_report(), report_file, indent=2)
+        logger.info('Stage report written to %s', report_filepath)
+
+    def write_prometheus_textfile(self, textfile_filepath: Path)-> None:
+        """ Write the stage records aggregated by stage as Prometheus metrics
+
+        The file is written atomically to be read by the textfile collector of node-exporter.
+        """
+        aggregates: Dict[str, Dict[str, float]] = {}
+        for record in self.records:
+            aggregate = aggregates.setdefault(record.name, {'count': 0, 'failed': 0,
+                'wall_seconds': 0., 'cpu_seconds': 0., 'peak_rss_bytes': 0,
+                'read_bytes': 0, 'write_bytes': 0})
+            aggregate['count'] += 1
+            aggregate['failed'] += not record.succeeded
+            aggregate['wall_seconds'] += record.wall_time
+            aggregate['cpu_seconds'] += record.cpu_time
+            aggregate['peak_rss_bytes'] = max(aggregate['peak_rss_bytes'], record.peak_rss)
+            aggregate['read_bytes'] += record.read_bytes
+            aggregate['write_bytes'] += record.write_bytes
+
+        lines = []
+        for metric in ['count', 'failed', 'wall_seconds', 'cpu_seconds', 'peak_rss_bytes',
+                       'read_bytes', 'write_bytes']:
+            lines.append(f'# TYPE {EWOC_S1_PROMETHEUS_PREFIX}_{metric} gauge')
+            for stage_name, aggregate in sorted(aggregates.items()):
+                lines.append(f'{EWOC_S1_PROMETHEUS_PREFIX}_{metric}{{stage="{stage_name}"}} '
+                             f'{aggregate[metric]}')
+
+        textfile_filepath.parent.mkdir(exist_ok=True, parents=True)
+        tmp_filepath = textfile_filepath.with_name(f'.{textfile_filepath.name}.{os.getpid()}')
+        tmp_filepath.write_text('\n'.join(lines) + '\n', encoding='utf8')
+        tmp_filepath.replace(textfile_filepath)
+        logger.info('Prometheus metrics written to %s', textfile_filepath)
+
+_process_recorder = StageRecorder()
+_recorder: ContextVar[StageRecorder] = ContextVar('ewoc_s1_stage_recorder')
+
+def get_stage_recorder()-> StageRecorder:
+    """ Recorder of the stages of the current context, by default the one of the process """
+    return _recorder.get(_process_recorder)
+
+@contextmanager
+def stage_recorder()-> Iterator[StageRecorder]:
+    """ Record the stages in a new recorder until the end of the context
+
+    It isolates the stages of a work plan unit, which are then merged in the recorder of the
+    main process with the result of the unit. The recorder is bound to the context of the
+    caller, so the units run concurrently in threads have their own recorder. The stages run in
+    a thread pool are recorded in it if they are submitted with submit_in_context.
+    """
+    recorder = StageRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+def submit_in_context(executor: Executor, func: Callable, *args: Any, **kwargs: Any)-> Future:
+    """ Submit func to the executor to be run in a copy of the context of the caller """
+    return executor.submit(copy_context().run, func, *args, **kwargs)
+
+@contextmanager
+def stage(name: str, **labels: str)-> Iterator[None]:
+    """ Record the wall time, CPU time, peak RSS and bytes read and written of a stage """
+    start = datetime.now().isoformat()
+    wall_time_start = time.perf_counter()
+    cpu_time_start = _cpu_time()
+    read_bytes_start, write_bytes_start = _io_bytes()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        read_bytes_end, write_bytes_end = _io_bytes()
+        record = StageRecord(name, labels, start,
+                             time.perf_counter() - wall_time_start,
+                             _cpu_time() - cpu_time_start,
+                             _peak_rss(),
+                             read_bytes_end - read_bytes_start,
+                             write_bytes_end - write_bytes_start,
+                             succeeded)
+        logger.debug('Stage %s %s: %.1f s wall, %.1f s CPU, %s MB peak RSS', name, labels,
+                     record.wall_time, record.cpu_time, record.peak_rss // (1024 * 1024))
+        get_stage_recorder().add([record])
@@ -0,0 +1,213 @@
+from contextlib import closing
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import psutil
+
+from ewoc_s1 import EWOC_S1_UNEXPECTED_ERROR
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_JOB_QUEUE_FILENAME = 'ewoc_s1_jobs.sqlite'
+EWOC_S1_JOB_REPORT_FILENAME = 'ewoc_s1_job_report.json'
+EWOC_S1_JOB_MAX_ATTEMPTS = 3
+EWOC_S1_WORKER_POLL_INTERVAL = 5.
+
+EWOC_S1_JOB_PENDING = 'pending'
+EWOC_S1_JOB_RUNNING = 'running'
+EWOC_S1_JOB_DONE = 'done'
+EWOC_S1_JOB_FAILED = 'failed'
+
+class Job(NamedTuple):
+    """ Generation of the S1 ARD of a S2 tile from S1 products (as the prd_ids sub command) """
+    job_id: int
+    s2_tile_id: str
+    s1_prd_ids: List[str]
+    production_id: Optional[str]=None
+
+class JobResult(NamedTuple):
+    """ Result of a job, the exit code is the one of the prd_ids sub command """
+    exit_code: int
+    message: str = ''
+    nb_s1_ard_files: int = 0
+    s1_ard_s3path: str = ''
+
+    @property
+    def succeeded(self)-> bool:
+        return self.exit_code == 0
+
+JobFn = Callable[[Job], JobResult]
+
+class JobQueue():
+    """ Queue of jobs in a SQLite database on the local disk
+
+    The jobs are submitted and consumed by the processes of the node without any other service.
+    A job is claimed by one worker process, its result is recorded with the job. The jobs claimed
+    by dead processes are pending again, up to EWOC_S1_JOB_MAX_ATTEMPTS attempts.
+    """
+
+    def __init__(self, db_filepath: Path, max_attempts: int=EWOC_S1_JOB_MAX_ATTEMPTS) -> None:
+        self._db_filepath = db_filepath
+        self._max_attempts = max_attempts
+        db_filepath.parent.mkdir(exist_ok=True, parents=True)
+        with closing(self._connect()) as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id INTEGER PRIMARY KEY AUTOINCREMENT, s2_tile_id TEXT NOT NULL, '
+                's1_prd_ids TEXT NOT NULL, production_id TEXT, status TEXT NOT NULL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, pid INTEGER, submitted TEXT, '
+                'started TEXT, ended TEXT, exit_code INTEGER, message TEXT, '
+                'nb_s1_ard_files INTEGER, s1_ard_s3path TEXT)')
+
+    def _connect(self)-> sqlite3.Connection:
+        # Autocommit mode: the transactions are explicit
+        connection = sqlite3.connect(self._db_filepath, timeout=60., isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def submit(self, s2_tile_id: str, s1_prd_ids: List[str],
+               production_id: Optional[str]=None)-> int:
+        """ Add a job to the queue and return its id """
+        with closing(self._connect()) as connection:
+            cursor = connection.execute(
+                'INSERT INTO jobs (s2_tile_id, s1_prd_ids, production_id, status, submitted) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (s2_tile_id, json.dumps(s1_prd_ids), production_id, EWOC_S1_JOB_PENDING,
+                 datetime.now().isoformat()))
+            if cursor.lastrowid is None:
+                raise RuntimeError(f'No job id for the job of {s2_tile_id} in {self._db_filepath}')
+            return cursor.lastrowid
+
+    def _requeue_dead_jobs(self, connection: sqlite3.Connection)-> None:
+        for row in connection.execute('SELECT job_id, pid, attempts FROM jobs WHERE status = ?',
+                                      (EWOC_S1_JOB_RUNNING,)).fetchall():
+            if psutil.pid_exists(row['pid']):
+                continue
+            if row['attempts'] >= self._max_attempts:
+                logger.error('Job %s failed: its worker %s died %s times', row['job_id'],
+                             row['pid'], row['attempts'])
+                connection.execute(
+                    'UPDATE jobs SET status = ?, ended = ?, exit_code = ?, message = ? '
+                    'WHERE job_id = ?', (EWOC_S1_JOB_FAILED, datetime.now().isoformat(),
+                                         EWOC_S1_UNEXPECTED_ERROR, 'Worker died',
+                                         row['job_id']))
+            else:
+                logger.warning('Job %s of the dead worker %s is pending again', row['job_id'],
+                               row['pid'])
+                connection.execute('UPDATE jobs SET status = ? WHERE job_id = ?',
+                                   (EWOC_S1_JOB_PENDING, row['job_id']))
+
+    def claim(self)-> Optional[Job]:
+        """ Claim the oldest pending job for the current process, None if there is no job """
+        with closing(self._connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._requeue_dead_jobs(connection)
+                row = connection.execute(
+                    'SELECT job_id, s2_tile_id, s1_prd_ids, production_id FROM jobs '
+                    'WHERE status = ? ORDER BY job_id LIMIT 1', (EWOC_S1_JOB_PENDING,)).fetchone()
+                if row is not None:
+                    connection.execute(
+                        'UPDATE jobs SET status = ?, pid = ?, started = ?, attempts = attempts + 1 '
+                        'WHERE job_id = ?', (EWOC_S1_JOB_RUNNING, os.getpid(),
+                                             datetime.now().isoformat(), row['job_id']))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return Job(row['job_id'], row['s2_tile_id'], json.loads(row['s1_prd_ids']),
+                   row['production_id'])
+
+    def complete(self, job_id: int, result: JobResult)-> None:
+        """ Record the result of a job """
+        with closing(self._connect()) as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, ended = ?, exit_code = ?, message = ?, '
+                'nb_s1_ard_files = ?, s1_ard_s3path = ? WHERE job_id = ?',
+                (EWOC_S1_JOB_DONE if result.succeeded else EWOC_S1_JOB_FAILED,
+                 datetime.now().isoformat(), result.exit_code, result.message,
+                 result.nb_s1_ard_files, result.s1_ard_s3path, job_id))
+
+    def release(self, job_id: int)-> None:
+        """ Put back a claimed job in the queue, e.g. when its worker is interrupted """
+        with closing(self._connect()) as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, pid = NULL, attempts = attempts - 1 '
+                'WHERE job_id = ?', (EWOC_S1_JOB_PENDING, job_id))
+
+    def get_job_status(self, job_id: int)-> Optional[Dict]:
+        """ Status and result of a job, None if the job does not exist """
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE job_id = ?',
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        job_status = dict(row)
+        job_status['s1_prd_ids'] = json.loads(job_status['s1_prd_ids'])
+        return job_status
+
+    def count(self)-> Dict[str, int]:
+        """ Number of jobs by status """
+        with closing(self._connect()) as connection:
+            return dict(connection.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+def run_jobs(job_queue: JobQueue, job_fn: JobFn, idle_timeout: Optional[float]=None,
+             max_jobs: Optional[int]=None,
+             poll_interval: float=EWOC_S1_WORKER_POLL_INTERVAL)-> Tuple[int, int]:
+    """ Process the jobs of the queue one after another with job_fn in the current process
+
+    The process stays resident, so the libraries loaded and the caches filled by a job are
+    reused by the next ones. It returns when the queue has been empty for idle_timeout seconds
+    (never if None) or when max_jobs jobs have been processed. The results of the jobs are
+    only recorded in the queue, so a long running worker does not accumulate them.
+
+    Returns:
+        Tuple[int, int]: the number of jobs processed and the number of jobs failed
+    """
+    nb_jobs = 0
+    nb_failed = 0
+    idle_start = time.monotonic()
+    while max_jobs is None or nb_jobs < max_jobs:
+        job = job_queue.claim()
+        if job is None:
+            if idle_timeout is not None and time.monotonic() - idle_start >= idle_timeout:
+                logger.info('No job since %s s, the worker stops', idle_timeout)
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logger.info('Job %s: %s products over %s', job.job_id, len(job.s1_prd_ids),
+                    job.s2_tile_id)
+        start = time.monotonic()
+        try:
+            result = job_fn(job)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception('Job %s failed', job.job_id)
+            result = JobResult(EWOC_S1_UNEXPECTED_ERROR, repr(exc))
+        except BaseException:
+            job_queue.release(job.job_id)
+            raise
+        job_queue.complete(job.job_id, result)
+        nb_jobs += 1
+        nb_failed += not result.succeeded
+        if result.succeeded:
+            logger.info('Job %s: OK in %.1f s (%s S1 ARD files uploaded to %s)', job.job_id,
+                        time.monotonic() - start, result.nb_s1_ard_files, result.s1_ard_s3path)
+        else:
+            logger.error('Job %s: FAILED in %.1f s with exit code %s (%s)', job.job_id,
+                         time.monotonic() - start, result.exit_code, result.message)
+        idle_start = time.monotonic()
+    return nb_jobs, nb_failed
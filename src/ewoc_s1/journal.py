@@ -0,0 +1,78 @@
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from ewoc_s1.utils import WpUnit
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+class WpJournal():
+    """ Append-only journal of the work plan units processed successfully
+
+    Each completed unit is recorded as one JSON line with its output files and their sha256
+    checksums. A line is written and synced to the disk only once the unit is completed, so a
+    journal interrupted during a write is still readable (the incomplete line is ignored).
+    """
+
+    def __init__(self, journal_filepath: Path) -> None:
+        self._journal_filepath = journal_filepath
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._incomplete_line = False
+
+        if journal_filepath.exists():
+            with open(journal_filepath, encoding='utf8') as journal_file:
+                line = ''
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning('Ignore incomplete line of the journal %s', journal_filepath)
+                        continue
+                    self._entries[entry['unit_id']] = entry
+                self._incomplete_line = line != '' and not line.endswith('\n')
+            logger.info('%s units already completed in the journal %s', len(self._entries),
+                        journal_filepath)
+
+    @property
+    def journal_filepath(self)-> Path:
+        return self._journal_filepath
+
+    def is_completed(self, unit: WpUnit)-> bool:
+        return self.get_entry(unit) is not None
+
+    def get_entry(self, unit: WpUnit)-> Optional[Dict[str, Any]]:
+        entry = self._entries.get(unit.unit_id)
+        if entry is None:
+            # The units of the journals written before the relative orbit was part of the unit
+            # id are identified by their date and their products
+            entry = self._entries.get(f'{unit.s2_tile_id}_{unit.date_key}')
+            if entry is not None and set(entry['s1_prd_ids']) != set(unit.s1_prd_ids):
+                entry = None
+        return entry
+
+    def record(self, unit: WpUnit, outputs: Dict[str, str], s1_ard_s3path: str='')-> None:
+        """ Record a completed unit with its output files (relative path -> sha256) """
+        entry = {'unit_id': unit.unit_id,
+                 's2_tile_id': unit.s2_tile_id,
+                 'date_key': unit.date_key,
+                 'relative_orbit': unit.relative_orbit,
+                 's1_prd_ids': list(unit.s1_prd_ids),
+                 'outputs': outputs,
+                 's1_ard_s3path': s1_ard_s3path,
+                 'completed': datetime.now().isoformat()}
+        self._journal_filepath.parent.mkdir(exist_ok=True, parents=True)
+        with open(self._journal_filepath, 'a', encoding='utf8') as journal_file:
+            if self._incomplete_line:
+                journal_file.write('\n')
+                self._incomplete_line = False
+            journal_file.write(json.dumps(entry) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self._entries[unit.unit_id] = entry
@@ -0,0 +1,174 @@
+import csv
+from datetime import datetime
+import heapq
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple
+
+from ewoc_s1.ewoc_s1_ard import EWOC_S1_POLARISATIONS
+from ewoc_s1.s1_prd_id import S1PrdIdInfo
+from ewoc_s1.utils import WpTile, WpUnit, iter_work_plan_tiles
+from ewoc_s1.workspace import (EWOC_S1_GRD_SIZE_ESTIMATE, EWOC_S1_NB_S1TILING_PASSES,
+                               EWOC_S1_S2_TILE_SIZE, estimate_unit_footprint)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+# Costs used without calibration reports, measured on a 8 cores node
+EWOC_S1_PLAN_DOWNLOAD_TIME = 120.
+EWOC_S1_PLAN_S1PROCESS_TIME = 300.
+EWOC_S1_PLAN_S1PROCESS_CPU_TIME = 1200.
+EWOC_S1_PLAN_FORMAT_TIME = 30.
+# Uncompressed uint16 tile at 20m
+EWOC_S1_PLAN_ARD_FILE_SIZE = 2 * (EWOC_S1_S2_TILE_SIZE // 20) ** 2
+
+class PlanCalibration(NamedTuple):
+    """ Costs of the stages of a unit, the S1Tiling costs are per product and per pass """
+    download_bytes_per_product: float = EWOC_S1_GRD_SIZE_ESTIMATE
+    download_time_per_product: float = EWOC_S1_PLAN_DOWNLOAD_TIME
+    s1_process_time_per_product: float = EWOC_S1_PLAN_S1PROCESS_TIME
+    s1_process_cpu_time_per_product: float = EWOC_S1_PLAN_S1PROCESS_CPU_TIME
+    format_time_per_unit: float = EWOC_S1_PLAN_FORMAT_TIME
+    ard_file_size: float = EWOC_S1_PLAN_ARD_FILE_SIZE
+    nb_reports: int = 0
+
+    @classmethod
+    def from_reports(cls, report_filepaths: List[Path])-> 'PlanCalibration':
+        """ Calibrate the costs with the stage reports of past runs (see StageRecorder)
+
+        The costs are averaged over the succeeded stages of the reports, the default cost is kept
+        when there is no stage to calibrate it. The downloads which did not write anything (the
+        products were in the cache or prefetched) are ignored. The CPU time of the S1Tiling
+        stages is the one of the process and its children, which includes the S1Tiling and OTB
+        workers (see StageRecord).
+        """
+        totals: Dict[str, List[float]] = {}
+
+        def add(cost_name: str, value: float, weight: float)-> None:
+            total = totals.setdefault(cost_name, [0., 0.])
+            total[0] += value
+            total[1] += weight
+
+        for report_filepath in report_filepaths:
+            with open(report_filepath, encoding='utf8') as report_file:
+                report = json.load(report_file)
+            for record in report['stages']:
+                if not record['succeeded']:
+                    continue
+                nb_products = int(record['labels'].get('nb_products', 0))
+                if record['name'] == 'download' and nb_products and record['write_bytes']:
+                    add('download_bytes_per_product', record['write_bytes'], nb_products)
+                    add('download_time_per_product', record['wall_time'], nb_products)
+                elif record['name'] in ['s1_process', 's1_process_noized'] and nb_products:
+                    add('s1_process_time_per_product', record['wall_time'], nb_products)
+                    add('s1_process_cpu_time_per_product', record['cpu_time'], nb_products)
+                elif record['name'] == 'ard_format':
+                    add('format_time_per_unit', record['wall_time'], 1)
+                    add('ard_file_size', record['write_bytes'], len(EWOC_S1_POLARISATIONS))
+
+        costs = {cost_name: value / weight for cost_name, (value, weight) in totals.items()}
+        logger.info('Costs calibrated from %s reports: %s', len(report_filepaths), costs)
+        return cls(**costs, nb_reports=len(report_filepaths))
+
+class UnitEstimate(NamedTuple):
+    """ Estimated costs of a work plan unit and its planned start and end in seconds """
+    unit_id: str
+    s2_tile_id: str
+    date_key: str
+    nb_products: int
+    invalid_s1_prd_ids: List[str]
+    download_bytes: int
+    output_bytes: int
+    workspace_bytes: int
+    cpu_time: float
+    duration: float
+    start: float = 0.
+    end: float = 0.
+
+def estimate_units(work_plan_filepath: Path, calibration: PlanCalibration=PlanCalibration(),
+                   nb_parallel_units: int=1)-> List[UnitEstimate]:
+    """ Validate the S1 product ids of a work plan and estimate the costs of its units
+
+    The units are scheduled in the work plan order over nb_parallel_units slots, each unit
+    starts on the first slot available. The work plan is streamed tile by tile.
+    """
+    slot_ends = [0.] * nb_parallel_units
+    unit_estimates = []
+    for wp_tile in iter_work_plan_tiles(work_plan_filepath):
+        valid_s1_prd_ids_groups = []
+        invalid_s1_prd_ids_by_unit: Dict[str, List[str]] = {}
+        for s1_prd_ids in wp_tile.s1_prd_ids:
+            valid_s1_prd_ids, errors = S1PrdIdInfo.validate_many(s1_prd_ids)
+            invalid_s1_prd_ids = list(errors)
+            for s1_prd_id, error in errors.items():
+                logger.error('Invalid S1 product id %s for %s: %s', s1_prd_id, wp_tile.tile_id,
+                             error)
+            # The invalid products are reported with the unit of the group
+            unit = WpUnit(wp_tile.tile_id, '', [])
+            if valid_s1_prd_ids:
+                valid_s1_prd_ids_groups.append(valid_s1_prd_ids)
+                unit = WpTile(wp_tile.tile_id, [valid_s1_prd_ids]).get_units()[0]
+            invalid_s1_prd_ids_by_unit.setdefault(unit.unit_id, []).extend(invalid_s1_prd_ids)
+
+        units = WpTile(wp_tile.tile_id, valid_s1_prd_ids_groups).get_units()
+        if f'{wp_tile.tile_id}_' in invalid_s1_prd_ids_by_unit:
+            units.append(WpUnit(wp_tile.tile_id, '', []))
+        for unit in units:
+            nb_products = len(unit.s1_prd_ids)
+            duration = 0.
+            if nb_products:
+                duration = nb_products * (calibration.download_time_per_product +
+                                          EWOC_S1_NB_S1TILING_PASSES *
+                                          calibration.s1_process_time_per_product) + \
+                    calibration.format_time_per_unit
+            start = heapq.heappop(slot_ends)
+            heapq.heappush(slot_ends, start + duration)
+            unit_estimates.append(UnitEstimate(
+                unit.unit_id, unit.s2_tile_id, unit.date_key, nb_products,
+                invalid_s1_prd_ids_by_unit.get(unit.unit_id, []),
+                int(nb_products * calibration.download_bytes_per_product),
+                int(bool(nb_products) * len(EWOC_S1_POLARISATIONS) * calibration.ard_file_size),
+                estimate_unit_footprint(nb_products) if nb_products else 0,
+                nb_products * EWOC_S1_NB_S1TILING_PASSES *
+                calibration.s1_process_cpu_time_per_product,
+                duration, start, start + duration))
+    return unit_estimates
+
+def summarize_units(unit_estimates: List[UnitEstimate],
+                    calibration: PlanCalibration=PlanCalibration())-> Dict[str, Any]:
+    """ Totals of the unit estimates, the duration is the end of the last unit """
+    return {
+        'nb_tiles': len({unit.s2_tile_id for unit in unit_estimates}),
+        'nb_units': len(unit_estimates),
+        'nb_products': sum(unit.nb_products for unit in unit_estimates),
+        'nb_invalid_products': sum(len(unit.invalid_s1_prd_ids) for unit in unit_estimates),
+        'download_bytes': sum(unit.download_bytes for unit in unit_estimates),
+        'output_bytes': sum(unit.output_bytes for unit in unit_estimates),
+        'max_workspace_bytes': max((unit.workspace_bytes for unit in unit_estimates), default=0),
+        'cpu_hours': sum(unit.cpu_time for unit in unit_estimates) / 3600,
+        'duration_hours': max((unit.end for unit in unit_estimates), default=0.) / 3600,
+        'calibration': calibration._asdict()}
+
+def write_plan(unit_estimates: List[UnitEstimate], plan_filepath: Path,
+               calibration: PlanCalibration=PlanCalibration())-> None:
+    """ Write the unit estimates as a CSV file (.csv) or with their summary as a JSON file """
+    plan_filepath.parent.mkdir(exist_ok=True, parents=True)
+    if plan_filepath.suffix == '.csv':
+        with open(plan_filepath, 'w', encoding='utf8', newline='') as plan_file:
+            writer = csv.writer(plan_file)
+            writer.writerow(UnitEstimate._fields)
+            for unit in unit_estimates:
+                # The invalid products of a unit are written in one cell
+                writer.writerow(' '.join(value) if field == 'invalid_s1_prd_ids' else value
+                                for field, value in unit._asdict().items())
+    else:
+        with open(plan_filepath, 'w', encoding='utf8') as plan_file:
+            json.dump({'created': datetime.now().isoformat(),
+                       'summary': summarize_units(unit_estimates, calibration),
+                       'units': [unit._asdict() for unit in unit_estimates]},
+                      plan_file, indent=2)
+    logger.info('Plan of %s units written to %s', len(unit_estimates), plan_filepath)
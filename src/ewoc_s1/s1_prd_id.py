@@ -1,180 +1,175 @@
 from datetime import datetime
+from functools import lru_cache
+import re
+from typing import Dict, List, Tuple
+
+# Number of parsed product ids kept in the cache of S1PrdIdInfo.parse
+EWOC_S1_PRD_ID_CACHE_SIZE = 2**16
+
+# Pattern and description of each element of the product id separated by '_'
+_S1_PRD_ID_ELEMENTS = [
+    (r'(?P<mission_id>S1A|S1B)', 'mission ID (S1A, S1B)'),
+    (r'(?P<beam_mode>IW|EW|WV)', 'beam mode (IW, EW, WV)'),
+    (r'(?P<product_type>SLC|GRD|OCN)(?P<resolution_class>[FHM])',
+     'product type (SLC, GRD, OCN) and resolution class (F, H, M)'),
+    (r'(?P<processing_level>[12])(?P<product_class>[SA])(?P<polarisation>SH|SV|DH|DV)',
+     'processing level (1, 2), product class (S, A) and polarisation (SH, SV, DH, DV)'),
+    (r'(?P<start_time>\d{8}T\d{6})', 'start time'),
+    (r'(?P<stop_time>\d{8}T\d{6})', 'stop time'),
+    (r'(?P<absolute_orbit_number>\d{6})', 'absolute orbit number (6 digits)'),
+    (r'(?P<mission_datatake_id>[0-9A-Z]{6})', 'mission datatake id (6 characters)'),
+    (r'(?P<product_unique_id>[0-9A-Z]{4})', 'product unique id (4 characters)'),
+]
+_S1_PRD_ID_REGEX = re.compile('_'.join(pattern for pattern, __unused in _S1_PRD_ID_ELEMENTS))
+
+_S1_PRD_ID_FIELDS = sorted(_S1_PRD_ID_REGEX.groupindex,
+                           key=lambda name: _S1_PRD_ID_REGEX.groupindex[name])
+_START_TIME_IDX = _S1_PRD_ID_FIELDS.index('start_time')
+_STOP_TIME_IDX = _S1_PRD_ID_FIELDS.index('stop_time')
+
+def _to_datetime(value: str)-> datetime:
+    # fromisoformat is much faster than strptime with S1PrdIdInfo.FORMAT_DATETIME
+    return datetime.fromisoformat(f'{value[0:4]}-{value[4:6]}-{value[6:8]}T'
+                                  f'{value[9:11]}:{value[11:13]}:{value[13:15]}')
+
+def _field(name: str)-> property:
+    field_idx = _S1_PRD_ID_FIELDS.index(name)
+    return property(lambda self: self._fields[field_idx])
 
 class S1PrdIdInfo:
+    """ Immutable information of a S1 product id
+
+    The product id is parsed with one regular expression. S1PrdIdInfo.parse returns the parsed
+    ids from a cache keyed by the id without extension.
+    """
 
     FORMAT_DATETIME='%Y%m%dT%H%M%S'
+    # Offset between the absolute and the relative orbit numbers of each mission
+    RELATIVE_ORBIT_OFFSETS={'S1A': 73, 'S1B': 27}
+    NB_RELATIVE_ORBITS=175
+
+    __slots__ = ('_s1_prd_id', '_fields')
 
     def __init__(self, s1_prd_id) -> None:
         # S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979.SAFE
         # https://sentinels.copernicus.eu/web/sentinel/user-guides/sentinel-1-sar/naming-conventions
         s1_prod_id_wsafe=s1_prd_id.split('.')[0]
-        self._s1_prd_id=s1_prod_id_wsafe
-        elt_prd_id = self._s1_prd_id.split('_')
-        if len(elt_prd_id) == 9:
-            self.mission_id = elt_prd_id[0]
-            self.beam_mode = elt_prd_id[1]
-            self.product_type = elt_prd_id[2][:3]
-            self.resolution_class = elt_prd_id[2][3]
-            self.processing_level = elt_prd_id[3][0]
-            self.product_class = elt_prd_id[3][1]
-            self.polarisation = elt_prd_id[3][2:]
-            self.start_time = elt_prd_id[4]
-            self.stop_time = elt_prd_id[5]
-            self.absolute_orbit_number = elt_prd_id[6]
-            self.mission_datatake_id = elt_prd_id[7]
-            self.product_unique_id = elt_prd_id[8]
-        else:
-            raise ValueError('Sentinel 1 product id not provides the 9 keys values requested!')
-
-    @property
-    def product_unique_id(self):
-        return self._product_unique_id
-
-    @product_unique_id.setter
-    def product_unique_id(self, value):
-        if len(value) == 4:
-            self._product_unique_id = value
-        else:
-            raise ValueError("Length of Product unique id different than 4 is not possible!")
-
-    @property
-    def mission_datatake_id(self):
-        return self._mission_datatake_id
-
-    @mission_datatake_id.setter
-    def mission_datatake_id(self, value):
-        if len(value) == 6:
-            self._mission_datatake_id = value
-        else:
-            raise ValueError("Length of Mission datatake id different than 6 is not possible!")
-
-    @property
-    def absolute_orbit_number(self):
-        return self._absolute_orbit_number
-
-    @absolute_orbit_number.setter
-    def absolute_orbit_number(self, value):
-        if len(value) == 6:
-            self._absolute_orbit_number = value
-        else:
-            raise ValueError("Length of Absolute orbit number different than 6 is not possible!", value)
-
-    @property
-    def start_time(self):
-        return self._start_time
-
-    @start_time.setter
-    def start_time(self, value):
-        self._start_time = datetime.strptime(value, self.FORMAT_DATETIME)
-
-    @property
-    def stop_time(self):
-        return self._stop_time
-
-    @stop_time.setter
-    def stop_time(self, value):
-        self._stop_time = datetime.strptime(value, self.FORMAT_DATETIME)
-        
-    @property
-    def polarisation(self):
-        return self._polarisation
-
-    @polarisation.setter
-    def polarisation(self, value):
-        allowed_values= ['SH', 'SV', 'DH', 'DV']
-        if value in allowed_values:
-            self._polarisation = value
-        else:
-            raise ValueError("Polarisation different than " + ', '.join(allowed_values) + " is not possible!")
-
-    @property
-    def product_class(self):
-        return self._product_class
-
-    @product_class.setter
-    def product_class(self, value):
-        allowed_values = ['S', 'A']
-        if value in allowed_values:
-            self._product_class = value
-        else:
-            raise ValueError("Product Class different than " + ', '.join(allowed_values) + " is not possible!")
-
-    @property
-    def processing_level(self):
-        return self._processing_level
-
-    @processing_level.setter
-    def processing_level(self, value):
-        allowed_values = ['1', '2']
-        if value in allowed_values:
-            self._processing_level = value
-        else:
-            raise ValueError("Processing Level different than " + ', '.join(allowed_values) + " is not possible!")
-
-    @property
-    def resolution_class(self):
-        return self._resolution_class
-
-    @resolution_class.setter
-    def resolution_class(self, value):
-        allowed_values = ['F', 'H', 'M'] 
-        if value in allowed_values:
-            self._resolution_class = value
-        else:
-            raise ValueError("Resolution class different than " + ', '.join(allowed_values) + " is not possible!")
-
-    @property
-    def product_type(self):
-        return self._product_type
+        match = _S1_PRD_ID_REGEX.fullmatch(s1_prod_id_wsafe)
+        if match is None:
+            raise ValueError(self._get_error_reason(s1_prod_id_wsafe))
+        fields = list(match.groups())
+        try:
+            fields[_START_TIME_IDX] = _to_datetime(fields[_START_TIME_IDX])
+            fields[_STOP_TIME_IDX] = _to_datetime(fields[_STOP_TIME_IDX])
+        except ValueError as exc:
+            raise ValueError(f'Invalid start or stop time in {s1_prod_id_wsafe}: {exc}') from exc
+        object.__setattr__(self, '_s1_prd_id', s1_prod_id_wsafe)
+        object.__setattr__(self, '_fields', tuple(fields))
 
-    @product_type.setter
-    def product_type(self, value):
-        allowed_values = ['SLC', 'GRD', 'OCN'] 
-        if value in allowed_values:
-            self._product_type = value
-        else:
-            raise ValueError("Product type different than " + ', '.join(allowed_values) + " is not possible!")
+    @staticmethod
+    def _get_error_reason(s1_prd_id: str)-> str:
+        elt_prd_id = s1_prd_id.split('_')
+        if len(elt_prd_id) != len(_S1_PRD_ID_ELEMENTS):
+            return 'Sentinel 1 product id not provides the 9 keys values requested!'
+        for elt, (pattern, description) in zip(elt_prd_id, _S1_PRD_ID_ELEMENTS):
+            if re.fullmatch(pattern, elt) is None:
+                return f'Invalid {description}: {elt}'
+        return f'Invalid Sentinel 1 product id: {s1_prd_id}'
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __reduce__(self):
+        # The default reduction restores the slots with __setattr__, the id is parsed again
+        return (type(self), (self._s1_prd_id,))
+
+    def __eq__(self, other):
+        if not isinstance(other, S1PrdIdInfo):
+            return NotImplemented
+        return self._s1_prd_id == other._s1_prd_id
+
+    def __hash__(self):
+        return hash(self._s1_prd_id)
+
+    mission_id = _field('mission_id')
+    beam_mode = _field('beam_mode')
+    product_type = _field('product_type')
+    resolution_class = _field('resolution_class')
+    processing_level = _field('processing_level')
+    product_class = _field('product_class')
+    polarisation = _field('polarisation')
+    start_time = _field('start_time')
+    stop_time = _field('stop_time')
+    absolute_orbit_number = _field('absolute_orbit_number')
+    mission_datatake_id = _field('mission_datatake_id')
+    product_unique_id = _field('product_unique_id')
 
     @property
-    def mission_id(self):
-        return self._mission_id
-
-    @mission_id.setter
-    def mission_id(self, value):
-        allowed_values= ['S1A', 'S1B']
-        if value in allowed_values:
-            self._mission_id = value
-        else:
-            raise ValueError("Mission ID different than "+ ', '.join(allowed_values) + " is not possible!")
+    def s1_prd_id(self):
+        """ Product id without extension """
+        return self._s1_prd_id
 
     @property
-    def beam_mode(self):
-        return self._beam_mode
-
-    @beam_mode.setter
-    def beam_mode(self, value):
-        allowed_values = ['IW', 'EW', 'WV']
-        if value in allowed_values:
-            self._beam_mode = value
-        else:
-            raise ValueError("Beam mode different than " + ', '.join(allowed_values) + " is not possible!")
+    def relative_orbit_number(self):
+        """ Relative orbit number (from 1 to 175) derived from the absolute orbit number """
+        return (int(self.absolute_orbit_number) - self.RELATIVE_ORBIT_OFFSETS[self.mission_id]) \
+            % self.NB_RELATIVE_ORBITS + 1
 
     def __str__(self):
         return f'Info provided by the S1 product id are: mission_id={self.mission_id}, beam_mode={self.beam_mode}, \
 product_type={self.product_type}, resolution_class={self.resolution_class}, \
 processing_level={self.processing_level}, product_class={self.product_class}, \
 polarisation={self.polarisation}, start time={self.start_time}, stop time={self.stop_time}, \
-absolute_orbit_number={self.absolute_orbit_number}, mission_datatake_id={self._mission_datatake_id}, \
-product_unique_id={self._product_unique_id}'
+absolute_orbit_number={self.absolute_orbit_number}, mission_datatake_id={self.mission_datatake_id}, \
+product_unique_id={self.product_unique_id}'
 
     def __repr__(self):
-         return f'S1PrdIdInfo(s1_prd_id={self._s1_prd_id})'
+        return f'S1PrdIdInfo(s1_prd_id={self._s1_prd_id})'
+
+    @staticmethod
+    def parse(s1_prd_id) -> 'S1PrdIdInfo':
+        """ Return the parsed product id from the cache, raise ValueError if it is not valid """
+        return _parse_s1_prd_id(s1_prd_id.split('.')[0])
 
     @staticmethod
-    def is_valid(s1_prd_id): 
+    def is_valid(s1_prd_id):
         try:
-            S1PrdIdInfo(s1_prd_id)
+            S1PrdIdInfo.parse(s1_prd_id)
             return True
         except ValueError:
             return False
-      
\ No newline at end of file
+
+    @staticmethod
+    def parse_many(s1_prd_ids: List[str])-> Tuple[List['S1PrdIdInfo'], Dict[str, str]]:
+        """ Parse the product ids
+
+        Returns:
+            Tuple[List[S1PrdIdInfo], Dict[str, str]]: the valid product ids parsed (in the input
+                order) and the reason of the error of each invalid product id
+        """
+        s1_prd_infos = []
+        errors = {}
+        for s1_prd_id in s1_prd_ids:
+            try:
+                s1_prd_infos.append(S1PrdIdInfo.parse(s1_prd_id))
+            except ValueError as exc:
+                errors[s1_prd_id] = str(exc)
+        return s1_prd_infos, errors
+
+    @staticmethod
+    def validate_many(s1_prd_ids: List[str])-> Tuple[List[str], Dict[str, str]]:
+        """ Validate the product ids
+
+        Returns:
+            Tuple[List[str], Dict[str, str]]: the valid product ids (in the input order) and the
+                reason of the error of each invalid product id
+        """
+        _, errors = S1PrdIdInfo.parse_many(s1_prd_ids)
+        return [s1_prd_id for s1_prd_id in s1_prd_ids if s1_prd_id not in errors], errors
+
+@lru_cache(maxsize=EWOC_S1_PRD_ID_CACHE_SIZE)
+def _parse_s1_prd_id(s1_prd_id: str)-> S1PrdIdInfo:
+    return S1PrdIdInfo(s1_prd_id)
@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+from typing import List, Optional, Tuple
+from xml.etree import ElementTree
+import zipfile
+
+from ewoc_s1.ewoc_s1_ard import EWOC_S1_POLARISATIONS
+from ewoc_s1.s1_prd_id import S1PrdIdInfo
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_SAFE_CHUNK_SIZE = 16 * 1024**2
+EWOC_S1_NB_SAFE_READ_WORKERS = 4
+EWOC_S1_SAFE_MANIFEST = 'manifest.safe'
+
+class SafeStoreError(Exception):
+    """Exception raised when a S1 product can not be read from a SAFE store."""
+
+class SafeStore():
+    """ Read access to the files of the S1 products stored in the SAFE format
+
+    The files are identified by a key: the path of the file relative to the root of the store
+    with '/' as separator. The subclasses provide the location of the products and the ranged
+    reads of their files.
+    """
+
+    def get_safe_key(self, s1_prd_id: str)-> str:
+        """ Key of the SAFE directory of the product, raise SafeStoreError if not available """
+        raise NotImplementedError
+
+    def read(self, key: str, offset: int=0, size: Optional[int]=None)-> bytes:
+        """ Read size bytes (until the end if None) of the file from offset """
+        raise NotImplementedError
+
+class LocalSafeStore(SafeStore):
+    """ S1 products of a directory, e.g. the EO data archive mounted on the node (/eodata)
+
+    The SAFE directories and the zipped SAFE products are searched at the root of the directory
+    and with the layout of the Creodias archive (Sentinel-1/SAR/<product type>/<year>/<month>/
+    <day>/).
+    """
+
+    def __init__(self, root_dirpath: Path) -> None:
+        self._root_dirpath = root_dirpath
+
+    def _get_keys(self, s1_prd_id: str, suffixes: List[str])-> List[str]:
+        s1_prd_info = S1PrdIdInfo.parse(s1_prd_id)
+        archive_key = f'Sentinel-1/SAR/{s1_prd_info.product_type}/' \
+                      f'{s1_prd_info.start_time:%Y/%m/%d}/'
+        return [f'{prefix}{s1_prd_info.s1_prd_id}{suffix}'
+                for prefix in ['', archive_key] for suffix in suffixes]
+
+    def get_safe_key(self, s1_prd_id: str)-> str:
+        for safe_key in self._get_keys(s1_prd_id, ['.SAFE']):
+            if (self._root_dirpath / safe_key).is_dir():
+                return safe_key
+        raise SafeStoreError(f'{s1_prd_id} not available in {self._root_dirpath}')
+
+    def get_zip_filepath(self, s1_prd_id: str)-> Optional[Path]:
+        """ Path of the zipped SAFE product, None if it is not available """
+        for zip_key in self._get_keys(s1_prd_id, ['.zip', '.SAFE.zip']):
+            if (self._root_dirpath / zip_key).is_file():
+                return self._root_dirpath / zip_key
+        return None
+
+    def read(self, key: str, offset: int=0, size: Optional[int]=None)-> bytes:
+        try:
+            with open(self._root_dirpath / key, 'rb') as safe_file:
+                safe_file.seek(offset)
+                return safe_file.read(-1 if size is None else size)
+        except OSError as exc:
+            raise SafeStoreError(f'Failed to read {key} from {self._root_dirpath}: {exc}') from exc
+
+def parse_manifest(manifest: bytes)-> List[Tuple[str, int]]:
+    """ Return the path relative to the SAFE directory and the size of the files of a manifest """
+    try:
+        root = ElementTree.fromstring(manifest)
+    except ElementTree.ParseError as exc:
+        raise SafeStoreError(f'Invalid manifest: {exc}') from exc
+    safe_files = []
+    for elt in root.iter():
+        if not elt.tag.endswith('byteStream'):
+            continue
+        file_location = next((child for child in elt if child.tag.endswith('fileLocation')),
+                             None)
+        if file_location is None or 'size' not in elt.attrib:
+            continue
+        relpath = file_location.attrib['href']
+        if relpath.startswith('./'):
+            relpath = relpath[2:]
+        safe_files.append((relpath, int(elt.attrib['size'])))
+    return safe_files
+
+def is_required_safe_file(relpath: str, polarisations: List[str]=EWOC_S1_POLARISATIONS)-> bool:
+    """ True if the file of the SAFE directory is read by S1Tiling for the polarisations
+
+    S1Tiling reads the manifest, the measurements and their annotation, calibration and noise
+    files. The previews, the quicklooks, the support schemas and the RFI annotations are not read.
+    """
+    pols = '|'.join(pol.lower() for pol in polarisations)
+    return re.fullmatch(
+        rf'manifest\.safe|measurement/[^/]+-({pols})-[^/]+\.tiff|annotation/[^/]+-({pols})-[^/]+\.xml'
+        rf'|annotation/calibration/(calibration|noise)-[^/]+-({pols})-[^/]+\.xml',
+        relpath) is not None
+
+def download_safe(safe_store: SafeStore, s1_prd_id: str, safe_dirpath: Path,
+                  polarisations: List[str]=EWOC_S1_POLARISATIONS,
+                  nb_workers: int=EWOC_S1_NB_SAFE_READ_WORKERS,
+                  chunk_size: int=EWOC_S1_SAFE_CHUNK_SIZE)-> int:
+    """ Download in safe_dirpath only the files of the SAFE product read by S1Tiling
+
+    The manifest is read first to find the files of the product. The files are read by ranges
+    of chunk_size bytes with nb_workers concurrent reads.
+
+    Raises:
+        SafeStoreError: if the product or one of its files can not be read
+
+    Returns:
+        int: the number of bytes downloaded
+    """
+    safe_key = safe_store.get_safe_key(s1_prd_id)
+    manifest = safe_store.read(f'{safe_key}/{EWOC_S1_SAFE_MANIFEST}')
+    safe_files = [(relpath, size) for relpath, size in parse_manifest(manifest)
+                  if relpath != EWOC_S1_SAFE_MANIFEST and
+                  is_required_safe_file(relpath, polarisations)]
+    if not any(relpath.startswith('measurement/') for relpath, __unused in safe_files):
+        raise SafeStoreError(f'No measurement of {polarisations} in the manifest of {s1_prd_id}')
+
+    safe_dirpath.mkdir(exist_ok=True, parents=True)
+    (safe_dirpath / EWOC_S1_SAFE_MANIFEST).write_bytes(manifest)
+
+    def read_range(relpath: str, offset: int, size: int)-> None:
+        data = safe_store.read(f'{safe_key}/{relpath}', offset, size)
+        if len(data) != size:
+            raise SafeStoreError(f'Incomplete read of {relpath} of {s1_prd_id}')
+        with open(safe_dirpath / relpath, 'r+b') as safe_file:
+            os.pwrite(safe_file.fileno(), data, offset)
+
+    ranges = []
+    for relpath, size in safe_files:
+        (safe_dirpath / relpath).parent.mkdir(exist_ok=True, parents=True)
+        with open(safe_dirpath / relpath, 'wb') as safe_file:
+            safe_file.truncate(size)
+        ranges += [(relpath, offset, min(chunk_size, size - offset))
+                   for offset in range(0, size, chunk_size)]
+
+    try:
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            for future in [executor.submit(read_range, *safe_range) for safe_range in ranges]:
+                future.result()
+    except SafeStoreError:
+        shutil.rmtree(safe_dirpath, ignore_errors=True)
+        raise
+
+    nb_bytes = len(manifest) + sum(size for __unused, size in safe_files)
+    logger.info('%s files (%s MB) of %s downloaded from %s', len(safe_files) + 1,
+                nb_bytes // 1024**2, s1_prd_id, safe_key)
+    return nb_bytes
+
+def open_zipped_safe(zip_filepath: Path, safe_dirpath: Path,
+                     polarisations: List[str]=EWOC_S1_POLARISATIONS)-> int:
+    """ Create in safe_dirpath a SAFE directory which reads the measurements from the zip file
+
+    S1Tiling finds the products with the layout of their SAFE directory, so the zip file can
+    not be given to it directly. The files read by S1Tiling other than the measurements (a few
+    hundred KB) are extracted. Each measurement is a VRT file, with the name of the GeoTIFF
+    file, which reads the raster from the zip file through the GDAL /vsizip/ file system: the
+    measurements are neither extracted nor copied. The zip file must stay in place while the
+    SAFE directory is used.
+
+    Raises:
+        SafeStoreError: if the zip file is not a SAFE product
+
+    Returns:
+        int: the number of bytes written
+    """
+    # rasterio loads GDAL, it is imported only when a zipped product is used
+    from rasterio.errors import RasterioError  # pylint: disable=import-outside-toplevel
+    from rasterio.shutil import copy as rio_copy  # pylint: disable=import-outside-toplevel
+
+    try:
+        with zipfile.ZipFile(zip_filepath) as safe_zip:
+            manifest_member = next((member for member in safe_zip.namelist()
+                                    if member.split('/')[-1] == EWOC_S1_SAFE_MANIFEST), None)
+            if manifest_member is None:
+                raise SafeStoreError(f'No {EWOC_S1_SAFE_MANIFEST} in {zip_filepath}')
+            member_prefix = manifest_member[:-len(EWOC_S1_SAFE_MANIFEST)]
+            manifest = safe_zip.read(manifest_member)
+            safe_dirpath.mkdir(exist_ok=True, parents=True)
+            (safe_dirpath / EWOC_S1_SAFE_MANIFEST).write_bytes(manifest)
+            nb_bytes = len(manifest)
+            for relpath, __unused in parse_manifest(manifest):
+                if relpath == EWOC_S1_SAFE_MANIFEST or \
+                   not is_required_safe_file(relpath, polarisations):
+                    continue
+                (safe_dirpath / relpath).parent.mkdir(exist_ok=True, parents=True)
+                if relpath.startswith('measurement/'):
+                    # Raise KeyError if the measurement is not in the zip file
+                    safe_zip.getinfo(member_prefix + relpath)
+                    rio_copy(f'/vsizip/{zip_filepath.resolve()}/{member_prefix}{relpath}',
+                             str(safe_dirpath / relpath), driver='VRT')
+                else:
+                    (safe_dirpath / relpath).write_bytes(safe_zip.read(member_prefix + relpath))
+                nb_bytes += (safe_dirpath / relpath).stat().st_size
+    except SafeStoreError:
+        shutil.rmtree(safe_dirpath, ignore_errors=True)
+        raise
+    except (OSError, KeyError, zipfile.BadZipFile, RasterioError) as exc:
+        shutil.rmtree(safe_dirpath, ignore_errors=True)
+        raise SafeStoreError(f'Failed to open the SAFE product {zip_filepath}: {exc}') from exc
+
+    logger.info('SAFE directory of %s created (%s KB written)', zip_filepath, nb_bytes // 1024)
+    return nb_bytes
+
+def open_zipped_safes(s1_input_dirpath: Path)-> List[str]:
+    """ Open the zipped products of the input directory of S1Tiling (see open_zipped_safe)
+
+    The zipped product <id>/<id>.zip is opened as <id>/<id>.SAFE if it is not already available.
+
+    Returns:
+        List[str]: the products ID which could not be opened
+    """
+    s1_prd_ids_error = []
+    for zip_filepath in sorted(s1_input_dirpath.glob('*/*.zip')):
+        s1_prd_id = zip_filepath.parent.name
+        safe_dirpath = zip_filepath.parent / f'{s1_prd_id}.SAFE'
+        if safe_dirpath.exists():
+            continue
+        try:
+            open_zipped_safe(zip_filepath, safe_dirpath)
+        except SafeStoreError as exc:
+            logger.warning(exc)
+            s1_prd_ids_error.append(s1_prd_id)
+    return s1_prd_ids_error
@@ -0,0 +1,299 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+import logging
+from pathlib import Path
+import shutil
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from ewoc_s1 import EWOC_S1_UNEXPECTED_ERROR
+from ewoc_s1.cache import S1ProductCache
+from ewoc_s1.ewoc_s1_ard import get_ewoc_ard_tile_relpath
+from ewoc_s1.generate_s1_ard import (EWOC_S1_NB_DOWNLOAD_WORKERS, S1ARDProcessorBaseError,
+                                     get_s1_input_dirpath, get_s1_prds, start_s1_ard_tiles)
+from ewoc_s1.instrumentation import StageRecord, stage, stage_recorder
+from ewoc_s1.utils import WpUnit
+from ewoc_s1.workspace import EWOC_S1_GRD_SIZE_ESTIMATE, WorkspaceBudget, estimate_unit_footprint
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_PREFETCH_BUDGET = 20 * 1024**3
+
+class WpUnitResult(NamedTuple):
+    """ Result of the processing of a work plan unit, the exit code is 0 in case of success """
+    unit: WpUnit
+    exit_code: int
+    message: str = ''
+    nb_s1_ard_files: int = 0
+    s1_ard_s3path: str = ''
+    ard_checksums: Optional[Dict[str, str]] = None
+    stage_records: Optional[List[StageRecord]] = None
+
+    @property
+    def succeeded(self)-> bool:
+        return self.exit_code == 0
+
+def to_wp_unit_error(unit: WpUnit, exc: Exception,
+                     stage_records: Optional[List[StageRecord]]=None)-> WpUnitResult:
+    """ Result of a unit which failed with exc """
+    if isinstance(exc, S1ARDProcessorBaseError):
+        logger.error('%s failed: %s', unit.unit_id, exc)
+        return WpUnitResult(unit, exc.exit_code, str(exc), stage_records=stage_records)
+    logger.critical('%s failed: unexpected %s, %s', unit.unit_id, exc, type(exc))
+    return WpUnitResult(unit, EWOC_S1_UNEXPECTED_ERROR, str(exc), stage_records=stage_records)
+
+def run_wp_unit(unit: WpUnit, out_dirpath_root: Path, dem_dirpath: Path, working_dirpath: Path,
+                **kwargs)-> WpUnitResult:
+    """ Generate the S1 ARD of a work plan unit and return its result instead of raising
+
+    See run_wp_unit_group for the keyword arguments.
+    """
+    return run_wp_unit_group([unit], out_dirpath_root, dem_dirpath, working_dirpath,
+                             **kwargs)[0]
+
+def run_wp_unit_group(units: List[WpUnit], out_dirpath_root: Path, dem_dirpath: Path,
+                      working_dirpath: Path, **kwargs)-> List[WpUnitResult]:
+    """ Generate the S1 ARD of work plan units of different tiles with the same S1 products
+
+    See start_wp_unit_group, whose uploads are waited before returning.
+
+    Returns:
+        List[WpUnitResult]: the result of each unit, the stages of the group are returned with
+            the result of the first unit
+    """
+    return start_wp_unit_group(units, out_dirpath_root, dem_dirpath, working_dirpath,
+                               **kwargs)()
+
+def start_wp_unit_group(units: List[WpUnit], out_dirpath_root: Path, dem_dirpath: Path,
+                        working_dirpath: Path, clean: bool=True,
+                        workspace: Optional[WorkspaceBudget]=None,
+                        prefetch_records: Optional[List[StageRecord]]=None,
+                        **kwargs)-> Callable[[], List[WpUnitResult]]:
+    """ Generate the S1 ARD of work plan units up to the wait for the upload of their outputs
+
+    The units are of different tiles with the same S1 products: S1Tiling is run once over their
+    tiles (see start_s1_ard_tiles), dem_dirpath must cover all the tiles. The other keyword
+    arguments are forwarded to start_s1_ard_tiles.
+
+    The function returned waits for the uploads and returns the result of each unit instead of
+    raising, it can be called from another thread while the next units are processed. The
+    stages of the units are returned with the result of the first unit, to be merged by the
+    caller as the units may run in another process. They include prefetch_records, the stages
+    of the prefetch of the units (see S1InputPrefetcher).
+
+    If workspace is provided, the units wait until their estimated footprint can be reserved,
+    the reservation is released once their outputs are uploaded.
+    """
+    s2_tile_ids = [unit.s2_tile_id for unit in units]
+    logger.info('%s will be process for %s over %s!', units[0].s1_prd_ids, units[0].date_key,
+                s2_tile_ids)
+    ard_checksums: Dict[str, str] = {}
+    tile_errors: Dict[str, Exception] = {}
+    reservation = ExitStack()
+    if workspace is not None:
+        reservation.enter_context(workspace.reserve(units[0].unit_id, estimate_unit_footprint(
+            len(units[0].s1_prd_ids), nb_tiles=len(units))))
+    with stage_recorder() as recorder:
+        recorder.add(prefetch_records or [])
+        working_dirpath.mkdir(exist_ok=True, parents=True)
+        out_dirpath_root.mkdir(exist_ok=True, parents=True)
+        try:
+            with stage('unit', tile=','.join(s2_tile_ids), date=units[0].date_key):
+                join_uploads = start_s1_ard_tiles(list(units[0].s1_prd_ids), s2_tile_ids,
+                                                  out_dirpath_root, dem_dirpath,
+                                                  working_dirpath, clean=clean,
+                                                  ard_checksums=ard_checksums,
+                                                  tile_errors=tile_errors, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            reservation.close()
+            results = [to_wp_unit_error(unit, exc, recorder.records if idx == 0 else None)
+                       for idx, unit in enumerate(units)]
+            return lambda: results
+        except BaseException:
+            reservation.close()
+            raise
+        finally:
+            if clean:
+                shutil.rmtree(working_dirpath, ignore_errors=True)
+
+    def join_unit_uploads()-> List[WpUnitResult]:
+        with reservation, stage_recorder() as upload_recorder:
+            try:
+                tile_results = join_uploads()
+            except Exception as exc:  # pylint: disable=broad-except
+                tile_results = {}
+                tile_errors.update({s2_tile_id: exc for s2_tile_id in s2_tile_ids})
+        recorder.add(upload_recorder.records)
+
+        results = []
+        for idx, unit in enumerate(units):
+            stage_records = recorder.records if idx == 0 else None
+            if unit.s2_tile_id in tile_errors:
+                results.append(to_wp_unit_error(unit, tile_errors[unit.s2_tile_id],
+                                                stage_records))
+                continue
+            tile_relpath = f'{get_ewoc_ard_tile_relpath(unit.s2_tile_id)}/'
+            nb_s1_ard_files, s1_ard_s3path = tile_results[unit.s2_tile_id]
+            results.append(WpUnitResult(unit, 0, '', nb_s1_ard_files, s1_ard_s3path,
+                                        {relpath: sha256
+                                         for relpath, sha256 in ard_checksums.items()
+                                         if relpath.startswith(tile_relpath)},
+                                        stage_records))
+        return results
+
+    return join_unit_uploads
+
+class InlineExecutor(Executor):
+    """ Executor which runs the submitted function immediately in the calling thread
+
+    The exceptions of the function are set to its future, except the interrupts (e.g.
+    KeyboardInterrupt) which stop the caller.
+
+    With submit_overlapped, the function returns the function completing its work (e.g. the
+    wait for its uploads), which is run in a background thread while the next functions run.
+    """
+
+    def __init__(self) -> None:
+        self._background_executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, fn, /, *args, **kwargs):
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+        return future
+
+    def submit_overlapped(self, fn: Callable[..., Callable[[], Any]], /, *args: Any,
+                          **kwargs: Any)-> Future:
+        """ Run fn in the calling thread and the function it returns in background
+
+        Returns:
+            Future: the future of the function returned by fn
+        """
+        future = self.submit(fn, *args, **kwargs)
+        if future.exception() is not None:
+            return future
+        return self._background_executor.submit(future.result())
+
+    def shutdown(self, wait: bool=True, *, cancel_futures: bool=False)-> None:
+        self._background_executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+def get_wp_unit_executor(nb_parallel_units: int)-> Executor:
+    """ Executor of the work plan units: a pool of nb_parallel_units processes or inline """
+    if nb_parallel_units > 1:
+        return ProcessPoolExecutor(max_workers=nb_parallel_units)
+    return InlineExecutor()
+
+def submit_wp_unit_group(executor: Executor, units: List[WpUnit], *args: Any,
+                         **kwargs: Any)-> Future:
+    """ Submit the processing of units (see run_wp_unit_group) to the executor of the units
+
+    The units of the InlineExecutor are processed in the calling thread up to the upload of
+    their outputs, which is waited in background while the next units are processed (see
+    start_wp_unit_group).
+
+    Returns:
+        Future: the future of the results of the units
+    """
+    if isinstance(executor, InlineExecutor):
+        return executor.submit_overlapped(start_wp_unit_group, units, *args, **kwargs)
+    return executor.submit(run_wp_unit_group, units, *args, **kwargs)
+
+class S1InputPrefetcher():
+    """ Download in background the S1 products of the next work plan units
+
+    When the units are processed one after another, the products of the nb_units_ahead units
+    following the current unit are downloaded in the input directory of their working directory
+    while the current unit is processed. generate_s1_ard then finds them on disk.
+
+    The products prefetched and not yet consumed are bounded by disk_budget bytes (estimated
+    with EWOC_S1_GRD_SIZE_ESTIMATE per product) and by the free space of the disk.
+
+    The stages of the prefetch of a unit are recorded apart and returned by wait, to be
+    recorded with the stages of the unit.
+    """
+
+    def __init__(self, units: List[Tuple[WpUnit, Path]], data_source: str,
+                 nb_download_workers: int=EWOC_S1_NB_DOWNLOAD_WORKERS,
+                 nb_units_ahead: int=1,
+                 disk_budget: int=EWOC_S1_PREFETCH_BUDGET,
+                 s1_prd_cache: Optional[S1ProductCache]=None) -> None:
+        self._units = units
+        self._unit_idx = {unit.unit_id: idx for idx, (unit, __unused) in enumerate(units)}
+        self._data_source = data_source
+        self._nb_download_workers = nb_download_workers
+        self._nb_units_ahead = nb_units_ahead
+        self._disk_budget = disk_budget
+        self._s1_prd_cache = s1_prd_cache
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: Dict[str, Tuple[Future, int]] = {}
+        self._consumed_idx = -1
+
+    def __enter__(self)-> 'S1InputPrefetcher':
+        return self
+
+    def __exit__(self, *args)-> None:
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _estimate_size(unit: WpUnit)-> int:
+        return len(unit.s1_prd_ids) * EWOC_S1_GRD_SIZE_ESTIMATE
+
+    def _prefetch(self, unit: WpUnit, working_dirpath: Path)-> List[StageRecord]:
+        s1_input_dirpath = get_s1_input_dirpath(working_dirpath, unit.s2_tile_id)
+        s1_input_dirpath.mkdir(exist_ok=True, parents=True)
+        logger.info('Prefetch %s products of %s', len(unit.s1_prd_ids), unit.unit_id)
+        with stage_recorder() as recorder:
+            try:
+                with stage('prefetch', tile=unit.s2_tile_id, date=unit.date_key):
+                    get_s1_prds(list(unit.s1_prd_ids), s1_input_dirpath, self._data_source,
+                                nb_workers=self._nb_download_workers,
+                                s1_prd_cache=self._s1_prd_cache)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning('Prefetch of %s failed: %s', unit.unit_id, exc)
+        return recorder.records
+
+    def _schedule(self)-> None:
+        pending_size = sum(size for __unused, size in self._futures.values())
+        for unit, working_dirpath in self._units[self._consumed_idx + 1:
+                                                 self._consumed_idx + 1 + self._nb_units_ahead]:
+            if unit.unit_id in self._futures:
+                continue
+            unit_size = self._estimate_size(unit)
+            working_dirpath.mkdir(exist_ok=True, parents=True)
+            if pending_size + unit_size > self._disk_budget or \
+               unit_size > shutil.disk_usage(working_dirpath).free:
+                logger.info('No prefetch of %s: disk budget reached', unit.unit_id)
+                break
+            self._futures[unit.unit_id] = (self._executor.submit(self._prefetch, unit,
+                                                                 working_dirpath), unit_size)
+            pending_size += unit_size
+
+    def wait(self, unit: WpUnit)-> List[StageRecord]:
+        """ Wait for the prefetch of the unit before its processing and prefetch the next ones
+
+        Returns:
+            List[StageRecord]: the stages of the prefetch of the unit, empty if not prefetched
+        """
+        prefetch_records = []
+        if unit.unit_id in self._futures:
+            future, __unused = self._futures.pop(unit.unit_id)
+            prefetch_records = future.result()
+        self._consumed_idx = max(self._consumed_idx, self._unit_idx[unit.unit_id])
+        self._schedule()
+        return prefetch_records
+
+def log_wp_unit_results(results: List[WpUnitResult])-> None:
+    nb_failed = len([result for result in results if not result.succeeded])
+    logger.info('%s / %s units processed successfully!', len(results) - nb_failed, len(results))
+    for result in results:
+        if result.succeeded:
+            logger.info('%s: OK (%s S1 ARD files uploaded to %s)', result.unit.unit_id,
+                        result.nb_s1_ard_files, result.s1_ard_s3path)
+        else:
+            logger.error('%s: FAILED with exit code %s (%s)', result.unit.unit_id,
+                         result.exit_code, result.message)
@@ -0,0 +1,137 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from ewoc_s1.cache import link_path
+from ewoc_s1.instrumentation import stage, submit_in_context
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+EWOC_S1_NB_UPLOAD_WORKERS = 4
+EWOC_S1_UPLOAD_RETRIES = 3
+EWOC_S1_UPLOAD_RETRY_DELAY = 5.
+
+UploadFn = Callable[[Path, Path, Optional[str]], str]
+
+class ArdUploadError(Exception):
+    """Exception raised when EWoC ARD files are not uploaded to the bucket."""
+
+    def __init__(self, ard_filepaths):
+        self._ard_filepaths = ard_filepaths
+        self._message = "Error during EWoC ARD upload:"
+        super().__init__(self._message)
+
+    def __str__(self):
+        return f"{self._message} {[str(filepath) for filepath in self._ard_filepaths]} not uploaded!"
+
+def upload_to_ewoc_ard_bucket(ard_filepath: Path, out_dirpath: Path,
+                              production_id: Optional[str])-> str:
+    """ Upload one EWoC ARD file to the EWoC ARD bucket
+
+    The file is linked in a staging directory with its path relative to out_dirpath, so it is
+    uploaded to the same key as with the upload of the whole out_dirpath.
+
+    Returns:
+        str: the s3 path of the production
+    """
+    # The S3 client is imported only when an upload is done
+    from ewoc_dag.bucket.ewoc import EWOCARDBucket  # pylint: disable=import-outside-toplevel
+
+    staging_dirpath = Path(mkdtemp(prefix='.ewoc_s1_upload_', dir=out_dirpath.parent))
+    try:
+        link_path(ard_filepath, staging_dirpath / ard_filepath.relative_to(out_dirpath))
+        __unused, __unused, s1_ard_s3path = \
+            EWOCARDBucket().upload_ard_prd(staging_dirpath, production_id)
+    finally:
+        shutil.rmtree(staging_dirpath, ignore_errors=True)
+    return s1_ard_s3path
+
+class ArdUploadQueue():
+    """ Upload the EWoC ARD files of out_dirpath as soon as they are written
+
+    The files are uploaded concurrently by nb_workers threads, each upload is retried nb_retries
+    times with an exponential backoff. With delete_uploaded, the local copy of a file is removed
+    once its upload is confirmed.
+    """
+
+    def __init__(self, out_dirpath: Path, production_id: Optional[str],
+                 upload_fn: UploadFn=upload_to_ewoc_ard_bucket,
+                 nb_workers: int=EWOC_S1_NB_UPLOAD_WORKERS,
+                 nb_retries: int=EWOC_S1_UPLOAD_RETRIES,
+                 retry_delay: float=EWOC_S1_UPLOAD_RETRY_DELAY,
+                 delete_uploaded: bool=True) -> None:
+        self._out_dirpath = out_dirpath
+        self._production_id = production_id
+        self._upload_fn = upload_fn
+        self._nb_retries = nb_retries
+        self._retry_delay = retry_delay
+        self._delete_uploaded = delete_uploaded
+        self._executor = ThreadPoolExecutor(max_workers=nb_workers)
+        self._lock = threading.Lock()
+        self._futures: List[Tuple[Path, Future]] = []
+
+    def __enter__(self)-> 'ArdUploadQueue':
+        return self
+
+    def __exit__(self, *args)-> None:
+        self._executor.shutdown(wait=True)
+
+    def submit(self, ard_filepath: Path)-> None:
+        """ Queue the upload of a EWoC ARD file, it can be called from any thread """
+        with self._lock:
+            self._futures.append((ard_filepath, submit_in_context(self._executor, self._upload,
+                                                                  ard_filepath)))
+        logger.debug('Upload of %s queued', ard_filepath)
+
+    def _upload(self, ard_filepath: Path)-> str:
+        for attempt in range(self._nb_retries + 1):
+            try:
+                with stage('upload', filename=ard_filepath.name):
+                    s1_ard_s3path = self._upload_fn(ard_filepath, self._out_dirpath,
+                                                    self._production_id)
+                break
+            except Exception as exc:  # pylint: disable=broad-except
+                if attempt == self._nb_retries:
+                    logger.error('Upload of %s failed after %s attempts: %s', ard_filepath,
+                                 attempt + 1, exc)
+                    raise
+                delay = self._retry_delay * 2**attempt
+                logger.warning('Upload of %s failed (%s), retry in %s s', ard_filepath, exc, delay)
+                time.sleep(delay)
+
+        logger.info('%s uploaded to %s', ard_filepath.name, s1_ard_s3path)
+        if self._delete_uploaded:
+            ard_filepath.unlink()
+        return s1_ard_s3path
+
+    def join(self, dirpath: Optional[Path]=None)-> Tuple[int, str]:
+        """ Wait for the uploads queued, only the ones of the files of dirpath if provided
+
+        Raises:
+            ArdUploadError: if at least one file is not uploaded
+
+        Returns:
+            Tuple[int, str]: the number of files uploaded and the s3 path of the production
+        """
+        with self._lock:
+            futures = [(ard_filepath, future) for ard_filepath, future in self._futures
+                       if dirpath is None or dirpath in ard_filepath.parents]
+        s1_ard_s3path = ''
+        failed_filepaths = []
+        for ard_filepath, future in futures:
+            try:
+                s1_ard_s3path = future.result()
+            except Exception:  # pylint: disable=broad-except
+                failed_filepaths.append(ard_filepath)
+        if failed_filepaths:
+            raise ArdUploadError(failed_filepaths)
+        return len(futures), s1_ard_s3path
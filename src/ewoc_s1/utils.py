@@ -1,9 +1,14 @@
 import configparser
+from contextlib import contextmanager
+import fcntl
+import hashlib
 import json
 import logging
+import math
+import os
 from os import getenv
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple, Union
 
 from psutil import cpu_count, virtual_memory
 
@@ -28,12 +33,28 @@ def getenv_path(key:str, default_path:Optional[Path]=None, exists = True)->Path:
         raise ValueError(f'The environment variable {key} is set but the path does not exist: {env_val_path}!')
     return env_val_path
 
+@contextmanager
+def file_lock(lock_filepath: Path)-> Iterator[None]:
+    """ Exclusive lock shared by the processes and threads of the node through a lock file """
+    with open(lock_filepath, 'a', encoding='utf8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def compute_sha256(filepath: Path, chunk_size: int=1024*1024)-> str:
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as file_to_hash:
+        for chunk in iter(lambda: file_to_hash.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 def to_s1tiling_configfile(out_dirpath: Path,
                            s1_input_dirpath: Path,
                            dem_dirpath: Path,
                            working_dirpath: Path,
-                           s2_tile_id: str,
+                           s2_tile_id: Union[str, List[str]],
                            cluster_config,
                            calibration_method :str= 'sigma',
                            output_spatial_resolution: int=20,
@@ -64,7 +85,8 @@ def to_s1tiling_configfile(out_dirpath: Path,
                             'output_spatial_resolution' : str(output_spatial_resolution),
                             'orthorectification_gridspacing' : str(4*output_spatial_resolution),
                             'orthorectification_interpolation_method' : ortho_interpol_method,
-                            'tiles': s2_tile_id,
+                            'tiles': s2_tile_id if isinstance(s2_tile_id, str) else \
+                                ', '.join(s2_tile_id),
                             'tile_to_product_overlap_ratio' : str(0.5),
                             'nb_parallel_processes' : optimal_nb_process,
                             'ram_per_process' : optimal_ram,
@@ -84,51 +106,379 @@ def to_s1tiling_configfile(out_dirpath: Path,
 
     return config_filepath
 
+class WpUnit(NamedTuple):
+    """ Unit of a work plan: the S1 products of one acquisition (date and relative orbit) over
+    one S2 tile
+    """
+    s2_tile_id: str
+    date_key: str
+    s1_prd_ids: List[str]
+    relative_orbit: Optional[int] = None
+
+    @property
+    def acquisition_key(self)-> str:
+        """ Key of the acquisition, unique over the tile: the date and the relative orbit """
+        if self.relative_orbit is None:
+            return self.date_key
+        return f'{self.date_key}_R{self.relative_orbit:03d}'
+
+    @property
+    def unit_id(self)-> str:
+        """ Stable id of the unit, used for its working directory and in the journal """
+        return f'{self.s2_tile_id}_{self.acquisition_key}'
+
+def group_units_by_products(units: List[WpUnit])-> List[List[WpUnit]]:
+    """ Group the units (of different tiles) which have the same S1 products
+
+    The groups are in the order of their first unit and the units of a group keep their order.
+    """
+    groups: Dict[frozenset, List[WpUnit]] = {}
+    for unit in units:
+        s1_prd_ids_key = frozenset(s1_prd_id.split('.')[0] for s1_prd_id in unit.s1_prd_ids)
+        groups.setdefault(s1_prd_ids_key, []).append(unit)
+    return list(groups.values())
+
+# Size in characters of the chunks read by iter_work_plan_tiles
+EWOC_S1_WP_CHUNK_SIZE = 1024**2
+
+class WpTile(NamedTuple):
+    """ S2 tile of a work plan with its S1 products grouped by date """
+    tile_id: str
+    s1_prd_ids: List[List[str]]
+
+    def get_units(self)-> List[WpUnit]:
+        """ Return the units of the tile: its S1 products grouped by date and relative orbit
+
+        A group is keyed by its first product, so the products of a pass over midnight stay in
+        the same unit. The groups of the same pass are merged in one unit.
+        """
+        units: Dict[Tuple[str, int], WpUnit] = {}
+        for s1_prd_ids in self.s1_prd_ids:
+            s1_prd_info = S1PrdIdInfo.parse(s1_prd_ids[0])
+            acquisition = (str(s1_prd_info.start_time.date()), s1_prd_info.relative_orbit_number)
+            if acquisition in units:
+                unit = units[acquisition]
+                units[acquisition] = unit._replace(s1_prd_ids=unit.s1_prd_ids + [
+                    s1_prd_id for s1_prd_id in s1_prd_ids if s1_prd_id not in unit.s1_prd_ids])
+            else:
+                units[acquisition] = WpUnit(self.tile_id, acquisition[0], list(s1_prd_ids),
+                                            acquisition[1])
+        return list(units.values())
+
+    def get_s1_prd_ids_by_date(self)-> Dict[str, List[str]]:
+        """ Return the S1 products by acquisition key (date and relative orbit) """
+        return {unit.acquisition_key: unit.s1_prd_ids for unit in self.get_units()}
+
+class _JsonStream():
+    """ Incremental decoding of the values of a JSON document read by chunks """
+
+    def __init__(self, json_file: TextIO, chunk_size: int) -> None:
+        self._json_file = json_file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self)-> bool:
+        chunk = self._json_file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # The decoded values are dropped from the buffer
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def next_char(self)-> str:
+        """ Consume the whitespaces and return the next character, empty at the end """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, chars: str)-> str:
+        char = self.next_char()
+        if not char or char not in chars:
+            raise ValueError(f'Invalid JSON document: {chars!r} expected at {self._pos}')
+        self._pos += 1
+        return char
+
+    def decode(self)-> Any:
+        """ Decode the next value, the buffer is extended until the value is complete """
+        self.next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read()
+
+def iter_work_plan_tiles(workplan_filepath: Path,
+                         chunk_size: int=EWOC_S1_WP_CHUNK_SIZE)-> Iterator[WpTile]:
+    """ Iterate over the tiles of a work plan without loading the whole document
+
+    The work plan is read by chunks of chunk_size characters and only one tile is decoded at a
+    time, the other fields of the work plan are skipped.
+    """
+    with open(workplan_filepath, encoding="utf8") as f_wp:
+        json_stream = _JsonStream(f_wp, chunk_size)
+        json_stream.expect('{')
+        if json_stream.next_char() == '}':
+            return
+        while True:
+            key = json_stream.decode()
+            json_stream.expect(':')
+            if key != 'tiles':
+                json_stream.decode()
+            else:
+                json_stream.expect('[')
+                if json_stream.next_char() == ']':
+                    json_stream.expect(']')
+                else:
+                    while True:
+                        tile = json_stream.decode()
+                        yield WpTile(tile['tile_id'], tile['s1_ids'])
+                        if json_stream.expect(',]') == ']':
+                            break
+            if json_stream.expect(',}') == '}':
+                return
+
 class EwocWorkPlanReader():
+    """ Reader of a EWoC work plan
+
+    The tiles are indexed by tile id when the work plan is loaded. To only iterate over the tiles
+    of a large work plan, see iter_work_plan_tiles.
+    """
 
     def __init__(self, workplan_filepath: Path) -> None:
         with open(workplan_filepath, encoding="utf8") as f_wp:
             self._wp = json.load(f_wp)
 
         self._tile_ids = []
+        self._tiles: Dict[str, WpTile] = {}
         for tile in self._wp['tiles']:
             self._tile_ids.append(tile['tile_id'])
+            self._tiles.setdefault(tile['tile_id'], WpTile(tile['tile_id'], tile['s1_ids']))
 
     @property
     def tile_ids(self)-> List[str]:
         return self._tile_ids
 
+    def get_tile(self, tile_id: str)-> Optional[WpTile]:
+        return self._tiles.get(tile_id)
+
     def get_nb_s1_prd(self, tile_id:str)->int:
-        if tile_id in self._tile_ids:
-            for tile in self._wp['tiles']:
-                if tile['tile_id'] == tile_id:
-                    return len(tile['s1_ids'])
+        if tile_id in self._tiles:
+            return len(self._tiles[tile_id].s1_prd_ids)
         return 0
 
-    def get_s1_prd_ids(self, tile_id:str)-> List[str]:
-        if tile_id in self._tile_ids:
-            for tile in self._wp['tiles']:
-                if tile['tile_id'] == tile_id:
-                    return tile['s1_ids']
+    def get_s1_prd_ids(self, tile_id:str)-> List[List[str]]:
+        if tile_id in self._tiles:
+            return self._tiles[tile_id].s1_prd_ids
         return []
 
-    def get_s1_prd_ids_by_date(self, tile_id: str)-> Dict:
-        prd_ids_by_date = self.get_s1_prd_ids(tile_id)
-        out = {}
-        for prd_ids in prd_ids_by_date:
-            out[str(S1PrdIdInfo(prd_ids[0]).start_time.date())] = prd_ids
-
-        return out
+    def get_s1_prd_ids_by_date(self, tile_id: str)-> Dict[str, List[str]]:
+        if tile_id in self._tiles:
+            return self._tiles[tile_id].get_s1_prd_ids_by_date()
+        return {}
+
+    def get_units(self, tile_ids: Optional[List[str]]=None)-> List[WpUnit]:
+        """ Return the units (S2 tile, date and relative orbit) of the work plan
+
+        The units are returned in the order of tile_ids, by default the work plan order.
+        """
+        if tile_ids is None:
+            tile_ids = self._tile_ids
+        return [unit for tile_id in tile_ids if tile_id in self._tiles
+                for unit in self._tiles[tile_id].get_units()]
+
+    def get_tile_ids_by_shared_products(self)-> List[str]:
+        """ Return the tile ids ordered so that consecutive tiles share S1 products
+
+        Starting from the first tile of the work plan, the next tile is the one which shares the
+        most products with the current tile (the first one in the work plan order in case of tie
+        or if no tile shares products). It maximises the hits of a product cache.
+        """
+        s1_prd_ids_by_tile = {tile_id: {s1_prd_id.split('.')[0]
+                                        for s1_prd_ids in self.get_s1_prd_ids(tile_id)
+                                        for s1_prd_id in s1_prd_ids}
+                              for tile_id in self._tile_ids}
+        tile_ids_by_prd: Dict[str, List[str]] = {}
+        for tile_id, s1_prd_ids in s1_prd_ids_by_tile.items():
+            for s1_prd_id in s1_prd_ids:
+                tile_ids_by_prd.setdefault(s1_prd_id, []).append(tile_id)
+        tile_idx = {tile_id: idx for idx, tile_id in enumerate(self._tile_ids)}
+
+        ordered_tile_ids: List[str] = []
+        visited = set()
+        next_unvisited_idx = 0
+        tile_id = None
+        while len(ordered_tile_ids) < len(tile_idx):
+            shared_counts: Dict[str, int] = {}
+            if tile_id is not None:
+                for s1_prd_id in s1_prd_ids_by_tile[tile_id]:
+                    for other_tile_id in tile_ids_by_prd[s1_prd_id]:
+                        if other_tile_id not in visited:
+                            shared_counts[other_tile_id] = shared_counts.get(other_tile_id, 0) + 1
+            if shared_counts:
+                tile_id = min(shared_counts,
+                              key=lambda elt: (-shared_counts[elt], tile_idx[elt]))
+            else:
+                while self._tile_ids[next_unvisited_idx] in visited:
+                    next_unvisited_idx += 1
+                tile_id = self._tile_ids[next_unvisited_idx]
+            visited.add(tile_id)
+            ordered_tile_ids.append(tile_id)
+        return ordered_tile_ids
+
+    def shard_units(self, nb_shards: int)-> List[List[WpUnit]]:
+        """ Split the units of the work plan into nb_shards balanced shards
+
+        The units are weighted by their number of S1 products and assigned, from the heaviest to
+        the lightest, to the least loaded shard. The sharding is deterministic and the units of
+        each shard keep the work plan order.
+        """
+        if nb_shards < 1:
+            raise ValueError(f'The number of shards must be positive: {nb_shards}!')
+        units = self.get_units()
+        shard_loads = [0] * nb_shards
+        shard_unit_idx: List[List[int]] = [[] for _ in range(nb_shards)]
+        for unit_idx in sorted(range(len(units)),
+                               key=lambda idx: (-len(units[idx].s1_prd_ids), idx)):
+            shard_idx = min(range(nb_shards), key=lambda idx: (shard_loads[idx], idx))
+            shard_loads[shard_idx] += len(units[unit_idx].s1_prd_ids)
+            shard_unit_idx[shard_idx].append(unit_idx)
+
+        for shard_idx in range(nb_shards):
+            logger.debug('Shard %s/%s: %s units, %s products', shard_idx, nb_shards,
+                         len(shard_unit_idx[shard_idx]), shard_loads[shard_idx])
+        return [[units[unit_idx] for unit_idx in sorted(unit_idx_list)]
+                for unit_idx_list in shard_unit_idx]
+
+    def get_shard_units(self, shard_idx: int, nb_shards: int)-> List[WpUnit]:
+        """ Return the units of the shard shard_idx (from 0 to nb_shards-1) """
+        if not 0 <= shard_idx < nb_shards:
+            raise ValueError(f'The shard index must be in [0, {nb_shards-1}]: {shard_idx}!')
+        return self.shard_units(nb_shards)[shard_idx]
+
+    def to_work_plan(self, units: List[WpUnit])-> Dict[str, Any]:
+        """ Return the work plan restricted to the units, the other fields are kept """
+        s1_prd_ids_by_tile: Dict[str, set] = {}
+        for unit in units:
+            s1_prd_ids_by_tile.setdefault(unit.s2_tile_id, set()).update(unit.s1_prd_ids)
+
+        work_plan = {key: value for key, value in self._wp.items() if key != 'tiles'}
+        work_plan['tiles'] = []
+        for tile in self._wp['tiles']:
+            if tile['tile_id'] in s1_prd_ids_by_tile:
+                tile_shard = dict(tile)
+                tile_shard['s1_ids'] = [s1_ids for s1_ids in tile['s1_ids']
+                                        if s1_ids[0] in s1_prd_ids_by_tile[tile['tile_id']]]
+                work_plan['tiles'].append(tile_shard)
+        return work_plan
+
+EWOC_S1_MIN_RAM_PER_UNIT = 4 * 1024**3
+EWOC_S1_CGROUP_ROOT = Path('/sys/fs/cgroup')
+EWOC_S1_MAX_CPU_ENV = 'EWOC_S1_MAX_CPU'
+EWOC_S1_MAX_RAM_ENV = 'EWOC_S1_MAX_RAM_MB'
+# cgroup v1 reports a memory limit close to the max int64 when it is not limited
+CGROUP_V1_UNLIMITED_MEMORY = 2**60
+
+def get_cgroup_cpu_limit(cgroup_root: Path=EWOC_S1_CGROUP_ROOT)-> Optional[float]:
+    """ Return the number of cores allowed by the CPU quota of the cgroup (v2 or v1)
+
+    Returns:
+        Optional[float]: None if the CPU is not limited
+    """
+    cpu_max_filepath = cgroup_root / 'cpu.max'
+    if cpu_max_filepath.exists():
+        quota, period = cpu_max_filepath.read_text(encoding='utf8').split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+
+    for cpu_dirname in ['cpu', 'cpu,cpuacct']:
+        quota_filepath = cgroup_root / cpu_dirname / 'cpu.cfs_quota_us'
+        period_filepath = cgroup_root / cpu_dirname / 'cpu.cfs_period_us'
+        if quota_filepath.exists() and period_filepath.exists():
+            quota_us = int(quota_filepath.read_text(encoding='utf8'))
+            if quota_us <= 0:
+                return None
+            return quota_us / int(period_filepath.read_text(encoding='utf8'))
+    return None
+
+def get_cgroup_memory_limit(cgroup_root: Path=EWOC_S1_CGROUP_ROOT)-> Optional[int]:
+    """ Return the memory limit in bytes of the cgroup (v2 or v1)
+
+    Returns:
+        Optional[int]: None if the memory is not limited
+    """
+    memory_max_filepath = cgroup_root / 'memory.max'
+    if memory_max_filepath.exists():
+        memory_max = memory_max_filepath.read_text(encoding='utf8').strip()
+        if memory_max == 'max':
+            return None
+        return int(memory_max)
+
+    memory_limit_filepath = cgroup_root / 'memory' / 'memory.limit_in_bytes'
+    if memory_limit_filepath.exists():
+        memory_limit = int(memory_limit_filepath.read_text(encoding='utf8'))
+        if memory_limit >= CGROUP_V1_UNLIMITED_MEMORY:
+            return None
+        return memory_limit
+    return None
 
 class ClusterConfig():
-    def __init__(self, nb_products:int) -> None:
+    """ Resources available to process nb_products
+
+    The resources of the node are limited by the CPU affinity of the process, the CPU quota and
+    the memory limit of its cgroup (e.g. the limits of a Kubernetes pod) and by the
+    EWOC_S1_MAX_CPU and EWOC_S1_MAX_RAM_MB environment variables.
 
-        if nb_products < 1:
+    When nb_parallel_units units are processed concurrently on the node, each unit gets an
+    equal share of the cores and of the RAM.
+    """
+    def __init__(self, nb_products:int, nb_parallel_units:int=1,
+                 cgroup_root:Path=EWOC_S1_CGROUP_ROOT) -> None:
+
+        if nb_products < 1 or nb_parallel_units < 1:
             raise ValueError
         self._nb_products= nb_products
-        self._physical_core = cpu_count(logical=False)
-        self._total_core = cpu_count(logical=True)
-        self._total_ram = virtual_memory().total
+        self._nb_parallel_units = nb_parallel_units
+
+        node_total_core = cpu_count(logical=True) or os.cpu_count() or 1
+        if hasattr(os, 'sched_getaffinity'):
+            node_total_core = min(node_total_core, len(os.sched_getaffinity(0)))
+        cgroup_cpu_limit = get_cgroup_cpu_limit(cgroup_root)
+        if cgroup_cpu_limit is not None:
+            node_total_core = min(node_total_core, math.ceil(cgroup_cpu_limit))
+        max_cpu = getenv(EWOC_S1_MAX_CPU_ENV)
+        if max_cpu is not None:
+            node_total_core = min(node_total_core, int(max_cpu))
+        node_physical_core = min(cpu_count(logical=False) or node_total_core, node_total_core)
+
+        node_total_ram = virtual_memory().total
+        cgroup_memory_limit = get_cgroup_memory_limit(cgroup_root)
+        if cgroup_memory_limit is not None:
+            node_total_ram = min(node_total_ram, cgroup_memory_limit)
+        max_ram_mb = getenv(EWOC_S1_MAX_RAM_ENV)
+        if max_ram_mb is not None:
+            node_total_ram = min(node_total_ram, int(max_ram_mb) * 1024 * 1024)
+
+        logger.debug('Node resources: %s physical cores, %s cores, %s MB (cgroup: %s cores, %s B)',
+                     node_physical_core, node_total_core, node_total_ram // (1024 * 1024),
+                     cgroup_cpu_limit, cgroup_memory_limit)
+
+        self._physical_core = max(1, node_physical_core // nb_parallel_units)
+        self._total_core = max(1, node_total_core // nb_parallel_units)
+        self._total_ram = node_total_ram // nb_parallel_units
 
 
     @property
@@ -143,6 +493,34 @@ class ClusterConfig():
     def total_ram(self):
         return self._total_ram
 
+    def compute_nb_workers(self, nb_tasks:int, nb_workers:Optional[int]=None)->int:
+        """ Compute the number of workers used to run nb_tasks concurrently
+
+        The requested number of workers (by default one per task) is bounded by the number of
+        cores available.
+        """
+        if nb_workers is None:
+            nb_workers = nb_tasks
+        optimal_nb_workers = max(1, min(nb_workers, nb_tasks, self._total_core))
+        logger.info('Optimal nb workers for %s task(s) = %s / %s', nb_tasks,
+            optimal_nb_workers,
+            self._total_core)
+        return optimal_nb_workers
+
+    def compute_nb_parallel_units(self, nb_parallel_units:int,
+                                  min_ram_per_unit:int=EWOC_S1_MIN_RAM_PER_UNIT)->int:
+        """ Compute the number of units which can be processed concurrently
+
+        The requested number of units is bounded by the number of physical cores and by the
+        number of units which get at least min_ram_per_unit of RAM.
+        """
+        max_nb_parallel_units = max(1, min(self._physical_core,
+                                           self._total_ram // min_ram_per_unit))
+        optimal_nb_parallel_units = max(1, min(nb_parallel_units, max_nb_parallel_units))
+        logger.info('Optimal nb parallel units = %s / %s', optimal_nb_parallel_units,
+            nb_parallel_units)
+        return optimal_nb_parallel_units
+
     def compute_optimal_cluster_config(self, ram_scale_factor=0.95):
 
         optimal_nb_process = 2 * self._nb_products
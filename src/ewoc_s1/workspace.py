@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Iterator, Optional, TextIO
+
+from ewoc_s1.ewoc_s1_ard import EWOC_S1_POLARISATIONS
+from ewoc_s1.utils import file_lock
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+# Size on disk of a S1 GRD product (SAFE format)
+EWOC_S1_GRD_SIZE_ESTIMATE = 2 * 1024**3
+# Size of the temporary files of S1Tiling (calibrated and cut images) for one product and one pass
+EWOC_S1_S1TILING_TMP_SIZE_ESTIMATE = 4 * 1024**3
+EWOC_S1_S2_TILE_SIZE = 109800
+# Calibrations of each product by S1Tiling: with and without thermal noise removal
+EWOC_S1_NB_S1TILING_PASSES = 2
+EWOC_S1_WORKSPACE_POLL_INTERVAL = 10.
+
+def estimate_unit_footprint(nb_products: int, output_spatial_resolution: int=20,
+                            nb_tiles: int=1)-> int:
+    """ Estimate the disk space in bytes used by generate_s1_ard for nb_products over S2 tiles
+
+    It includes the SAFE products, the temporary files and the outputs of each S1Tiling pass
+    (float32 tile per polarisation and per product) and the EWoC ARD files (uint16).
+    """
+    nb_tile_pixels = nb_tiles * (EWOC_S1_S2_TILE_SIZE // output_spatial_resolution) ** 2
+    s1process_size = nb_products * (EWOC_S1_S1TILING_TMP_SIZE_ESTIMATE +
+                                    4 * nb_tile_pixels * len(EWOC_S1_POLARISATIONS))
+    ard_size = 2 * nb_tile_pixels * len(EWOC_S1_POLARISATIONS)
+    return nb_products * EWOC_S1_GRD_SIZE_ESTIMATE + EWOC_S1_NB_S1TILING_PASSES * s1process_size + ard_size
+
+class WorkspaceBudget():
+    """ Admission control of the units over a working directory shared by the jobs of a node
+
+    Each unit reserves its estimated footprint before its processing. A reservation is a file
+    of the reservation directory of the working directory, created under a lock: the units of
+    all the processes using the same working directory share the budget. Each reservation file
+    is locked by its unit until the end of its reservation: a reservation whose lock can be
+    taken belongs to a dead process and is removed, even if its pid was reused.
+    """
+
+    def __init__(self, working_dirpath: Path, budget: int,
+                 poll_interval: float=EWOC_S1_WORKSPACE_POLL_INTERVAL) -> None:
+        self._reservation_dirpath = working_dirpath / '.ewoc_s1_workspace'
+        self._lock_filepath = self._reservation_dirpath / '.lock'
+        self._budget = budget
+        self._poll_interval = poll_interval
+        self._reservation_dirpath.mkdir(exist_ok=True, parents=True)
+
+    @property
+    def budget(self)-> int:
+        return self._budget
+
+    def reserved(self)-> int:
+        """ Total size of the reservations of the living processes """
+        with file_lock(self._lock_filepath):
+            return self._reserved()
+
+    def _reserved(self)-> int:
+        reserved = 0
+        for reservation_filepath in self._reservation_dirpath.glob('*.json'):
+            try:
+                with open(reservation_filepath, 'r', encoding='utf8') as reservation_file:
+                    try:
+                        fcntl.flock(reservation_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # The reservation is locked by its living unit
+                        reservation = json.load(reservation_file)
+                        reserved += reservation['size']
+                        continue
+                    reservation_filepath.unlink()
+            except (OSError, ValueError):
+                continue
+            logger.warning('Remove the reservation %s of a dead process',
+                           reservation_filepath.stem)
+        return reserved
+
+    def _try_reserve(self, reservation_filepath: Path, unit_id: str,
+                     size: int)-> Optional[TextIO]:
+        """ Create the reservation file, locked until it is closed, if size can be reserved """
+        with file_lock(self._lock_filepath):
+            reserved = self._reserved()
+            # A unit larger than the budget is admitted alone
+            if reserved + size > self._budget and reserved > 0:
+                return None
+            if size > self._budget:
+                logger.warning('Footprint of %s (%s MB) exceeds the workspace budget (%s MB)',
+                               unit_id, size // 1024**2, self._budget // 1024**2)
+            # Closed at the end of the reservation
+            # pylint: disable-next=consider-using-with
+            reservation_file = open(reservation_filepath, 'w', encoding='utf8')
+            fcntl.flock(reservation_file, fcntl.LOCK_EX)
+            json.dump({'unit_id': unit_id, 'pid': os.getpid(), 'size': size}, reservation_file)
+            reservation_file.flush()
+            return reservation_file
+
+    @contextmanager
+    def reserve(self, unit_id: str, size: int, timeout: Optional[float]=None)-> Iterator[None]:
+        """ Wait until size bytes can be reserved and release them at the end of the context
+
+        Raises:
+            TimeoutError: if the reservation is not admitted after timeout seconds
+        """
+        reservation_filepath = self._reservation_dirpath / f'{unit_id}_{os.getpid()}.json'
+        start = time.monotonic()
+        reservation_file = self._try_reserve(reservation_filepath, unit_id, size)
+        while reservation_file is None:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'No workspace available for {unit_id} after {timeout} s')
+            logger.info('Wait for %s MB of workspace for %s', size // 1024**2, unit_id)
+            time.sleep(self._poll_interval)
+            reservation_file = self._try_reserve(reservation_filepath, unit_id, size)
+        logger.debug('%s MB of workspace reserved for %s', size // 1024**2, unit_id)
+        try:
+            yield
+        finally:
+            with file_lock(self._lock_filepath), reservation_file:
+                reservation_filepath.unlink()
@@ -0,0 +1,118 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import zarr
+
+from ewoc_s1.ard_zarr import (ArdZarrError, append_to_ewoc_s1_zarr, check_ard_sink,
+                              get_acquisitions, get_time_order)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+SHAPE = (300, 520)
+CHUNKS = (4, 128, 128)
+
+def write_ewoc_files(dirpath, date_idx, shape=SHAPE):
+    """ EWoC ARD files of a date filled with the date index (VV) and its opposite (VH) """
+    ewoc_filepaths = {}
+    for pol, value in [('VV', date_idx), ('VH', 1000 - date_idx)]:
+        ewoc_filepaths[pol] = dirpath / f'date_{date_idx}_{pol}.tif'
+        with rasterio.open(ewoc_filepaths[pol], 'w', driver='GTiff', width=shape[1],
+                           height=shape[0], count=1, dtype='uint16', nodata=65535,
+                           crs='EPSG:32631', transform=from_origin(300000, 4900020, 20, 20)) \
+                as dataset:
+            dataset.write(np.full(shape, value, dtype=np.uint16), 1)
+    return ewoc_filepaths
+
+def append_date(zarr_dirpath, date_idx):
+    ewoc_filepaths = write_ewoc_files(zarr_dirpath.parent, date_idx)
+    return append_to_ewoc_s1_zarr(zarr_dirpath, f'date_{date_idx}',
+                                  datetime(2021, 7, 1) + timedelta(days=date_idx),
+                                  ewoc_filepaths, chunks=CHUNKS)
+
+class Test_ArdZarr(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._zarr_dirpath = Path(self._tmp_dir.name) / 'ewoc_s1_ard_31TCJ.zarr'
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_append(self):
+        """The dates are appended along the time dimension, a date already appended is replaced"""
+        self.assertEqual([append_date(self._zarr_dirpath, date_idx) for date_idx in [3, 1, 3]],
+                         [0, 1, 0])
+
+        root = zarr.open_group(str(self._zarr_dirpath), mode='r')
+        self.assertEqual(root['VV'].shape, (2,) + SHAPE)
+        self.assertEqual(root['VV'].chunks, CHUNKS)
+        self.assertEqual(root['VV'].attrs['_ARRAY_DIMENSIONS'], ['time', 'y', 'x'])
+        np.testing.assert_array_equal(root['VV'][:, 0, 0], [3, 1])
+        np.testing.assert_array_equal(root['VH'][:, -1, -1], [997, 999])
+        self.assertEqual(list(root['time'][:]), [np.datetime64('2021-07-04T00:00:00'),
+                                                 np.datetime64('2021-07-02T00:00:00')])
+        self.assertEqual((root['x'][0], root['y'][0]), (300010., 4900010.))
+        self.assertEqual([acquisition['id'] for acquisition in
+                          get_acquisitions(self._zarr_dirpath)], ['date_3', 'date_1'])
+
+    def test_time_order(self):
+        """The dates appended out of order are sorted by the time_order attribute"""
+        for date_idx in [3, 1, 4, 2, 1]:
+            append_date(self._zarr_dirpath, date_idx)
+
+        time_order = get_time_order(self._zarr_dirpath)
+        self.assertEqual(time_order, [1, 3, 0, 2])
+        root = zarr.open_group(str(self._zarr_dirpath), mode='r')
+        times = root['time'][:][time_order]
+        self.assertTrue((np.diff(times) > np.timedelta64(0)).all())
+        np.testing.assert_array_equal(root['VV'][:, 0, 0][time_order], [1, 2, 3, 4])
+
+    def test_interrupted_append(self):
+        """The data of an append not committed are overwritten by the next append"""
+        append_date(self._zarr_dirpath, 1)
+        root = zarr.open_group(str(self._zarr_dirpath), mode='a')
+        for pol in ['VV', 'VH']:
+            root[pol].resize((3,) + SHAPE)
+            root[pol][1:] = 42
+        self.assertEqual(len(get_acquisitions(self._zarr_dirpath)), 1)
+
+        self.assertEqual(append_date(self._zarr_dirpath, 2), 1)
+        self.assertEqual(root['VV'].shape, (2,) + SHAPE)
+        np.testing.assert_array_equal(root['VV'][:, 10, 10], [1, 2])
+
+    def test_concurrent_appends(self):
+        """The appends of concurrent processes are serialized"""
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(append_date, [self._zarr_dirpath] * 12, range(12)))
+
+        acquisitions = get_acquisitions(self._zarr_dirpath)
+        self.assertEqual(sorted(acquisition['id'] for acquisition in acquisitions),
+                         sorted(f'date_{date_idx}' for date_idx in range(12)))
+        root = zarr.open_group(str(self._zarr_dirpath), mode='r')
+        for time_idx, acquisition in enumerate(acquisitions):
+            date_idx = int(acquisition['id'].split('_')[1])
+            self.assertTrue((root['VV'][time_idx] == date_idx).all())
+            self.assertTrue((root['VH'][time_idx] == 1000 - date_idx).all())
+
+    def test_grid_error(self):
+        append_date(self._zarr_dirpath, 1)
+        ewoc_filepaths = write_ewoc_files(Path(self._tmp_dir.name), 2, shape=(100, 100))
+        with self.assertRaises(ArdZarrError):
+            append_to_ewoc_s1_zarr(self._zarr_dirpath, 'date_2', datetime(2021, 7, 3),
+                                   ewoc_filepaths, chunks=CHUNKS)
+        self.assertEqual(len(get_acquisitions(self._zarr_dirpath)), 1)
+
+    def test_check_ard_sink(self):
+        check_ard_sink('both')
+        with self.assertRaises(ValueError):
+            check_ard_sink('netcdf')
+
+if __name__ == "__main__":
+    unittest.main()
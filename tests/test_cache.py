@@ -0,0 +1,165 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+import unittest
+from unittest.mock import patch
+
+from ewoc_s1.cache import (EWOC_S1_CACHE_NB_KEY_LOCKS, DEMCache, FileCache, S1ProductCache,
+                           get_path_size)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+DEM_CELLS = {'31TCJ': ['N43E000.tif', 'N43E001.tif', 'N44E000.tif', 'N44E001.tif'],
+             '31TDJ': ['N43E001.tif', 'N43E002.tif', 'N44E001.tif', 'N44E002.tif']}
+
+class FakeDEMDownloader():
+    """Write fake DEM cells and count the downloads"""
+    def __init__(self):
+        self.nb_downloads = 0
+
+    def __call__(self, s2_tile_id, dem_dirpath):
+        self.nb_downloads += 1
+        for cell_name in DEM_CELLS[s2_tile_id]:
+            (dem_dirpath / cell_name).write_bytes(b'\0' * 1024)
+
+class Test_FileCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        """The least recently used entries are removed when the cache is full"""
+        with TemporaryDirectory() as tmp_dirpath:
+            cache = FileCache(Path(tmp_dirpath) / 'cache', max_size=3 * 1024)
+            view_dirpath = Path(tmp_dirpath) / 'view'
+            for idx, key in enumerate(['a', 'b', 'c']):
+                with cache.tmp_dirpath() as entry_dirpath:
+                    (entry_dirpath / key).write_bytes(b'\0' * 1024)
+                    cache.put(key, entry_dirpath / key, view_dirpath / key)
+                os.utime(cache.cache_dirpath / 'data' / key, (idx, idx))
+            self.assertTrue(cache.get('a', view_dirpath / 'a2'))
+
+            with cache.tmp_dirpath() as entry_dirpath:
+                (entry_dirpath / 'd').write_bytes(b'\0' * 1024)
+                cache.put('d', entry_dirpath / 'd')
+
+            self.assertFalse(cache.get('b', view_dirpath / 'b2'))
+            self.assertTrue(cache.get('c', view_dirpath / 'c2'))
+            self.assertLessEqual(cache.size(), cache.max_size)
+            # The links of the view are still valid after the eviction
+            self.assertEqual((view_dirpath / 'b').stat().st_size, 1024)
+
+    def test_size_index(self):
+        """The size of the cache is read from its index, only the new entries are walked"""
+        with TemporaryDirectory() as tmp_dirpath:
+            cache = FileCache(Path(tmp_dirpath) / 'cache', max_size=3 * 1024)
+            with patch('ewoc_s1.cache.get_path_size', wraps=get_path_size) as mock_get_path_size:
+                for idx, key in enumerate(['a', 'b', 'c', 'd']):
+                    with cache.tmp_dirpath() as entry_dirpath:
+                        (entry_dirpath / key).mkdir()
+                        (entry_dirpath / key / 'cell.tif').write_bytes(b'\0' * 1024)
+                        cache.put(key, entry_dirpath / key)
+                    os.utime(cache.cache_dirpath / 'data' / key, (idx, idx))
+                self.assertEqual(mock_get_path_size.call_count, 4)
+
+            self.assertEqual(cache.size(), 3 * 1024)
+            self.assertEqual(sorted(path.name for path in (cache.cache_dirpath / 'data').iterdir()),
+                             ['b', 'c', 'd'])
+            # The index of a cache of a previous version is created from its entries
+            (cache.cache_dirpath / 'sizes.json').unlink()
+            self.assertEqual(FileCache(cache.cache_dirpath, max_size=3 * 1024).size(), 3 * 1024)
+
+    def test_link_fallback(self):
+        """The entries are copied when they can not be hard linked, so they survive eviction"""
+        with TemporaryDirectory() as tmp_dirpath:
+            cache = FileCache(Path(tmp_dirpath) / 'cache', max_size=1024)
+            view_dirpath = Path(tmp_dirpath) / 'view'
+            with patch('ewoc_s1.cache.os.link', side_effect=OSError('Cross-device link')):
+                for key in ['a', 'b']:
+                    with cache.tmp_dirpath() as entry_dirpath:
+                        (entry_dirpath / key).write_bytes(b'\0' * 1024)
+                        cache.put(key, entry_dirpath / key, view_dirpath / key)
+
+            self.assertFalse(cache.get('a', view_dirpath / 'a2'))
+            self.assertFalse((view_dirpath / 'a').is_symlink())
+            self.assertEqual((view_dirpath / 'a').stat().st_size, 1024)
+
+class Test_DEMCache(unittest.TestCase):
+    def test_get_dem(self):
+        """The DEM cells are downloaded once and shared between the tiles"""
+        with TemporaryDirectory() as tmp_dirpath:
+            dem_cache = DEMCache(Path(tmp_dirpath) / 'cache')
+            downloader = FakeDEMDownloader()
+
+            for run in range(2):
+                for s2_tile_id in DEM_CELLS:
+                    dem_dirpath = Path(tmp_dirpath) / str(run) / s2_tile_id
+                    dem_cache.get_dem(s2_tile_id, 'copdem', 'aws', downloader, dem_dirpath)
+                    self.assertEqual(sorted(path.name for path in dem_dirpath.iterdir()),
+                                     DEM_CELLS[s2_tile_id])
+
+            self.assertEqual(downloader.nb_downloads, 2)
+            self.assertEqual(len(list((dem_cache.cache_dirpath / 'data').iterdir())), 6)
+
+    def test_get_dem_concurrent(self):
+        """Concurrent jobs on the same node share the cache"""
+        with TemporaryDirectory() as tmp_dirpath:
+            downloader = FakeDEMDownloader()
+            threads = [Thread(target=DEMCache(Path(tmp_dirpath) / 'cache').get_dem,
+                              args=('31TCJ', 'srtm', 'esa', downloader,
+                                    Path(tmp_dirpath) / f'job_{idx}'))
+                       for idx in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for idx in range(4):
+                self.assertEqual(len(list((Path(tmp_dirpath) / f'job_{idx}').iterdir())), 4)
+            self.assertEqual(len(list((Path(tmp_dirpath) / 'cache' / 'data').iterdir())), 4)
+            # The other jobs wait for the download of the first one
+            self.assertEqual(downloader.nb_downloads, 1)
+
+S1_PRD_ID = 'S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178'
+
+class Test_S1ProductCache(unittest.TestCase):
+    def test_get_s1_prd(self):
+        """A product requested by several tiles is downloaded once"""
+        nb_downloads = []
+
+        def fake_get_s1_prd(s1_prd_id, s1_input_dirpath):
+            nb_downloads.append(s1_prd_id)
+            s1_prd_dirpath = s1_input_dirpath / S1_PRD_ID / f'{S1_PRD_ID}.SAFE' / 'measurement'
+            s1_prd_dirpath.mkdir(parents=True)
+            (s1_prd_dirpath / 'iw-vv.tiff').write_bytes(b'\0' * 1024)
+            return True
+
+        with TemporaryDirectory() as tmp_dirpath:
+            cache = S1ProductCache(Path(tmp_dirpath) / 'cache')
+            input_dirpaths = [Path(tmp_dirpath) / 'input' / tile_id
+                              for tile_id in ['31TCJ', '31TDJ', '31TCK']]
+            threads = [Thread(target=cache.get_s1_prd,
+                              args=(S1_PRD_ID + '.SAFE' if idx else S1_PRD_ID, input_dirpath,
+                                    fake_get_s1_prd))
+                       for idx, input_dirpath in enumerate(input_dirpaths)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(nb_downloads), 1)
+            for input_dirpath in input_dirpaths:
+                self.assertTrue((input_dirpath / S1_PRD_ID / f'{S1_PRD_ID}.SAFE' / 'measurement' /
+                                 'iw-vv.tiff').is_file())
+            self.assertFalse(cache.get_s1_prd('S1B_NOT_AVAILABLE', input_dirpaths[0],
+                                              lambda s1_prd_id, dirpath: False))
+            # The lock files are shared by the products
+            self.assertTrue(all(lock_filepath.name.startswith('key_') for lock_filepath in
+                                (cache.cache_dirpath / 'tmp').glob('*.lock')))
+            for idx in range(2 * EWOC_S1_CACHE_NB_KEY_LOCKS):
+                cache.get_s1_prd(f'S1B_NOT_AVAILABLE_{idx}', input_dirpaths[0],
+                                 lambda s1_prd_id, dirpath: False)
+            self.assertLessEqual(len(list((cache.cache_dirpath / 'tmp').glob('*.lock'))),
+                                 EWOC_S1_CACHE_NB_KEY_LOCKS)
+
+if __name__ == "__main__":
+    unittest.main()
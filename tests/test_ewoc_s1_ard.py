@@ -0,0 +1,148 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from ewoc_s1.ewoc_s1_ard import (get_overview_factors, to_ewoc_dn, to_ewoc_s1_ard,
+                                 to_ewoc_s1_raster, to_overview)
+from ewoc_s1.s1_prd_id import S1PrdIdInfo
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+def write_s1process_raster(filepath, values):
+    profile = {'driver': 'GTiff',
+               'width': values.shape[1],
+               'height': values.shape[0],
+               'count': 1,
+               'dtype': 'float32',
+               'crs': 'EPSG:32631',
+               'transform': from_origin(300000, 4900020, 20, 20)}
+    with rasterio.open(filepath, 'w', **profile) as dataset:
+        dataset.write(values.astype(np.float32), 1)
+        dataset.update_tags(ACQUISITION_DATETIME='2021:07:08 06:01:05',
+                            ORBIT_DIRECTION='DES')
+
+class Test_EwocS1Ard(unittest.TestCase):
+    def test_to_ewoc_dn(self):
+        """Masking and scaling of the sigma0 values"""
+        sigma0 = np.array([[0., 1e-7, 0.01, 0.1]])
+        sigma0_noized = np.array([[0., 0.02, 0.011, 0.11]])
+
+        dn_values = to_ewoc_dn(sigma0, sigma0_noized, nodata_out=65535)
+        self.assertEqual(dn_values.dtype, np.uint16)
+        self.assertEqual(dn_values[0, 0], 65535)
+        self.assertEqual(dn_values[0, 1], int(10 ** ((10 * np.log10(0.02) + 83) / 20)))
+        self.assertEqual(dn_values[0, 2], int(10 ** ((10 * np.log10(0.01) + 83) / 20)))
+
+        dn_values = to_ewoc_dn(sigma0, nodata_out=65535)
+        self.assertEqual(dn_values[0, 0], 65535)
+        self.assertEqual(dn_values[0, 1], int(10 ** ((10 * np.log10(1e-7) + 83) / 20)))
+
+    def test_to_ewoc_s1_raster(self):
+        """Single pass formatting of a S1Tiling output"""
+        rng = np.random.default_rng(42)
+        sigma0_noized = rng.uniform(1e-3, 0.5, (700, 600))
+        sigma0_noized[:, :50] = 0.
+        sigma0 = sigma0_noized - 1e-3
+
+        with TemporaryDirectory() as tmp_dirpath:
+            s1process_filepath = Path(tmp_dirpath) / 's1a_31TCJ_vv_DES_037_20210708t060105.tif'
+            s1process_noized_filepath = Path(tmp_dirpath) / 'noized.tif'
+            ewoc_filepath = Path(tmp_dirpath) / 'ewoc.tif'
+            write_s1process_raster(s1process_filepath, sigma0)
+            write_s1process_raster(s1process_noized_filepath, sigma0_noized)
+
+            to_ewoc_s1_raster(s1process_filepath, ewoc_filepath,
+                              nodata_in=65535, nodata_out=65535,
+                              s1_process_noized_filepath=s1process_noized_filepath)
+
+            with rasterio.open(ewoc_filepath) as dataset:
+                self.assertEqual(dataset.dtypes[0], 'uint16')
+                self.assertEqual(dataset.nodata, 65535)
+                self.assertEqual(dataset.block_shapes[0], (512, 512))
+                self.assertEqual(dataset.compression.name.lower(), 'deflate')
+                self.assertEqual(dataset.get_tag_item('ACQUISITION_DATETIME'), '2021:07:08')
+                self.assertEqual(dataset.get_tag_item('ORBIT_DIRECTION'), 'DES')
+                self.assertEqual(dataset.get_tag_item('TIFFTAG_IMAGEDESCRIPTION'),
+                                 'EWoC Sentinel-1 ARD')
+                np.testing.assert_array_equal(dataset.read(1),
+                    to_ewoc_dn(sigma0.astype(np.float32), sigma0_noized.astype(np.float32),
+                               nodata_out=65535))
+
+    def test_to_overview(self):
+        """The overviews average the valid values"""
+        dn_values = np.array([[1, 3, 5], [65535, 65535, 7], [2, 65535, 65535]], dtype=np.uint16)
+        np.testing.assert_array_equal(to_overview(dn_values, 2, 65535), [[2, 6], [2, 65535]])
+        self.assertEqual(get_overview_factors(5490, 5490, 512), [2, 4, 8, 16])
+        self.assertEqual(get_overview_factors(500, 300, 512), [])
+
+    def test_to_ewoc_s1_raster_cog(self):
+        """COG output with overviews and statistics computed in the formatting pass"""
+        rng = np.random.default_rng(42)
+        sigma0 = rng.uniform(1e-3, 0.5, (1100, 1000))
+        sigma0[:, :50] = 0.
+
+        with TemporaryDirectory() as tmp_dirpath:
+            s1process_filepath = Path(tmp_dirpath) / 's1a_31TCJ_vv_DES_037_20210708t060105.tif'
+            write_s1process_raster(s1process_filepath, sigma0)
+            ewoc_filepath = Path(tmp_dirpath) / 'ewoc.tif'
+            to_ewoc_s1_raster(s1process_filepath, ewoc_filepath, blocksize=256,
+                              nodata_in=65535, nodata_out=65535, cog=True)
+            self.assertEqual([path.name for path in Path(tmp_dirpath).iterdir()
+                              if path.name.startswith('.')], [])
+
+            dn_values = to_ewoc_dn(sigma0.astype(np.float32), nodata_out=65535)
+            valid_values = dn_values[dn_values != 65535].astype(np.float64)
+            with rasterio.open(ewoc_filepath) as dataset:
+                self.assertEqual(dataset.tags(ns='IMAGE_STRUCTURE')['LAYOUT'], 'COG')
+                self.assertEqual(dataset.compression.name.lower(), 'deflate')
+                self.assertEqual(dataset.block_shapes[0], (256, 256))
+                self.assertEqual(dataset.overviews(1), [2, 4, 8])
+                self.assertEqual(dataset.get_tag_item('TIFFTAG_IMAGEDESCRIPTION'),
+                                 'EWoC Sentinel-1 ARD')
+                np.testing.assert_array_equal(dataset.read(1), dn_values)
+                np.testing.assert_array_equal(dataset.read(1, out_shape=(550, 500)),
+                                              to_overview(dn_values, 2, 65535))
+
+                band_tags = dataset.tags(1)
+                self.assertEqual(int(band_tags['STATISTICS_MINIMUM']), valid_values.min())
+                self.assertEqual(int(band_tags['STATISTICS_MAXIMUM']), valid_values.max())
+                self.assertAlmostEqual(float(band_tags['STATISTICS_MEAN']), valid_values.mean())
+                self.assertAlmostEqual(float(band_tags['STATISTICS_STDDEV']), valid_values.std())
+                self.assertAlmostEqual(float(band_tags['STATISTICS_VALID_PERCENT']), 95.)
+                histogram = [int(count) for count in band_tags['STATISTICS_HISTOBINVALUES'].split('|')]
+                self.assertEqual(len(histogram), int(band_tags['STATISTICS_HISTONUMBINS']))
+                self.assertEqual(sum(histogram), valid_values.size)
+
+    def test_to_ewoc_s1_ard(self):
+        """Concurrent formatting of the VV and VH outputs"""
+        sigma0 = np.full((300, 200), 0.05)
+
+        with TemporaryDirectory() as tmp_dirpath:
+            s1process_dirpath = Path(tmp_dirpath) / 's1process' / '31TCJ'
+            s1process_noized_dirpath = Path(tmp_dirpath) / 's1process_noized' / '31TCJ'
+            for dirpath in [s1process_dirpath, s1process_noized_dirpath]:
+                dirpath.mkdir(parents=True)
+                for pol in ['vv', 'vh']:
+                    write_s1process_raster(
+                        dirpath / f's1a_31TCJ_{pol}_DES_037_20210708t060105.tif', sigma0)
+
+            to_ewoc_s1_ard(s1process_dirpath, Path(tmp_dirpath) / 'ard',
+                S1PrdIdInfo('S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979'),
+                '31TCJ', clean_input_file=True,
+                s1_process_noized_output_dirpath=s1process_noized_dirpath, nb_workers=2)
+
+            ewoc_filepaths = sorted((Path(tmp_dirpath) / 'ard').rglob('*.tif'))
+            self.assertEqual([ewoc_filepath.name for ewoc_filepath in ewoc_filepaths],
+                ['S1A_20210708T060105_DES_TODO_03868204908E8979_31TCJ_SIGMA0_VH.tif',
+                 'S1A_20210708T060105_DES_TODO_03868204908E8979_31TCJ_SIGMA0_VV.tif'])
+            self.assertFalse(any(s1process_dirpath.iterdir()))
+            self.assertFalse(any(s1process_noized_dirpath.iterdir()))
+
+if __name__ == "__main__":
+    unittest.main()
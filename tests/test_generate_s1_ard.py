@@ -0,0 +1,238 @@
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+from unittest.mock import patch
+
+from ewoc_dag.s1_dag import S1DagError
+
+from ewoc_s1.ard_zarr import ArdZarrError
+from ewoc_s1.ewoc_s1_ard import get_ewoc_ard_tile_relpath
+from ewoc_s1.generate_s1_ard import (S1ARDFormatError, _to_ewoc_s1_ard_tile,
+                                     generate_s1_ard_tiles, get_s1_prds)
+from ewoc_s1.upload import ArdUploadQueue
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+S1_PRD_IDS = ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178',
+              'S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979',
+              'S1A_IW_GRDH_1SDV_20210708T060130_20210708T060155_038682_04908E_A2A5']
+S1_PRD_ID_MISSING = 'S1B_IW_GRDH_1SDV_20180325T153530_20180325T153557_010190_012836_4840'
+DOWNLOAD_LATENCY = 0.5
+
+def fake_get_s1_product(s1_prd_id, out_root_dirpath, source, safe_format):
+    """Local stand-in of ewoc_dag get_s1_product which simulates the transfer latency"""
+    time.sleep(DOWNLOAD_LATENCY)
+    if s1_prd_id.split('.')[0] == S1_PRD_ID_MISSING:
+        raise S1DagError(f'{s1_prd_id} not available on {source}')
+    (out_root_dirpath / s1_prd_id / 'measurement').mkdir(parents=True)
+
+def fake_get_s1_prds(s1_prd_ids, s1_input_dir, data_source, nb_workers, s1_prd_cache):
+    for s1_prd_id in s1_prd_ids:
+        (s1_input_dir / s1_prd_id / f'{s1_prd_id}.SAFE').mkdir(parents=True)
+    return []
+
+def write_safe(safe_dirpath, relpaths):
+    """Minimal SAFE product with its manifest"""
+    byte_streams = ''
+    for relpath in relpaths:
+        (safe_dirpath / relpath).parent.mkdir(exist_ok=True, parents=True)
+        (safe_dirpath / relpath).write_bytes(relpath.encode())
+        byte_streams += (f'<byteStream size="{len(relpath)}">'
+                         f'<fileLocation href="./{relpath}"/></byteStream>')
+    (safe_dirpath / 'manifest.safe').write_text(f'<XFDU>{byte_streams}</XFDU>', encoding='utf8')
+
+def fake_to_ewoc_s1_ard(s1_process_output_dirpath, out_dirpath, s1_prd_info, s2_tile_id,
+                        on_written=None, fail_pol=None, **kwargs):
+    """Local stand-in of to_ewoc_s1_ard which writes empty files and fails on fail_pol"""
+    ewoc_filepaths = []
+    for pol in ['VV', 'VH']:
+        if pol == fail_pol:
+            raise RuntimeError(f'Formatting of {pol} failed')
+        ewoc_filepath = out_dirpath / 'SAR' / s2_tile_id[:2] / 'ewoc_date' / f'ewoc_{pol}.tif'
+        ewoc_filepath.parent.mkdir(parents=True, exist_ok=True)
+        ewoc_filepath.write_bytes(pol.encode())
+        if on_written is not None:
+            on_written(ewoc_filepath)
+        ewoc_filepaths.append(ewoc_filepath)
+    return ewoc_filepaths
+
+class Test_GenerateS1Ard(unittest.TestCase):
+    @patch('ewoc_s1.generate_s1_ard.get_s1_product', side_effect=fake_get_s1_product)
+    def test_get_s1_prds(self, mock_get_s1_product):
+        """Concurrent download of the input products"""
+        with TemporaryDirectory() as tmp_dirpath:
+            s1_input_dir = Path(tmp_dirpath)
+            start = time.perf_counter()
+            s1_prd_ids_error = get_s1_prds(S1_PRD_IDS + [S1_PRD_ID_MISSING, 'S1A_NOT_VALID'],
+                                           s1_input_dir, 'aws', nb_workers=4)
+            elapsed = time.perf_counter() - start
+
+            self.assertEqual(s1_prd_ids_error, [S1_PRD_ID_MISSING, 'S1A_NOT_VALID'])
+            self.assertEqual(mock_get_s1_product.call_count, 4)
+            self.assertLess(elapsed, 2 * DOWNLOAD_LATENCY)
+            for s1_prd_id in S1_PRD_IDS:
+                self.assertTrue((s1_input_dir / s1_prd_id / f'{s1_prd_id}.SAFE').is_dir())
+            self.assertFalse((s1_input_dir / S1_PRD_ID_MISSING).exists())
+
+    def test_get_s1_prds_zipped(self):
+        """The zip files delivered by the sources are kept to be opened, not extracted"""
+        def fake_get_zipped_s1_product(s1_prd_id, out_root_dirpath, source, safe_format):
+            (out_root_dirpath / f'{s1_prd_id.split(".")[0]}.zip').write_bytes(b'zip')
+
+        with TemporaryDirectory() as tmp_dirpath:
+            s1_input_dir = Path(tmp_dirpath)
+            with patch('ewoc_s1.generate_s1_ard.get_s1_product',
+                       side_effect=fake_get_zipped_s1_product):
+                self.assertEqual(get_s1_prds(S1_PRD_IDS[:2], s1_input_dir, 'creodias'), [])
+            for s1_prd_id in S1_PRD_IDS[:2]:
+                self.assertEqual(list((s1_input_dir / s1_prd_id).iterdir()),
+                                 [s1_input_dir / s1_prd_id / f'{s1_prd_id}.zip'])
+
+    @patch('ewoc_s1.generate_s1_ard.get_s1_product', side_effect=fake_get_s1_product)
+    def test_get_s1_prds_serial(self, mock_get_s1_product):
+        """The pool is bounded by the number of workers"""
+        with TemporaryDirectory() as tmp_dirpath:
+            start = time.perf_counter()
+            get_s1_prds(S1_PRD_IDS, Path(tmp_dirpath), 'aws', nb_workers=1)
+            self.assertGreaterEqual(time.perf_counter() - start, 3 * DOWNLOAD_LATENCY)
+
+    @patch('ewoc_s1.generate_s1_ard.get_s1_product', side_effect=fake_get_s1_product)
+    def test_get_s1_prds_archive(self, mock_get_s1_product):
+        """Only the files read by S1Tiling are copied from an archive directory, the zipped
+        products are linked"""
+        with TemporaryDirectory() as tmp_dirpath:
+            archive_dirpath = Path(tmp_dirpath) / 'eodata'
+            write_safe(archive_dirpath / f'{S1_PRD_IDS[0]}.SAFE',
+                       ['measurement/s1a-iw-grd-vv-20210708t060040-001.tiff',
+                        'preview/quick-look.png'])
+            (archive_dirpath / f'{S1_PRD_IDS[2]}.SAFE.zip').write_bytes(b'zip')
+            s1_input_dir = Path(tmp_dirpath) / 'input'
+            s1_input_dir.mkdir()
+            s1_prd_ids_error = get_s1_prds(S1_PRD_IDS, s1_input_dir, str(archive_dirpath))
+
+            self.assertEqual(s1_prd_ids_error, [S1_PRD_IDS[1]])
+            mock_get_s1_product.assert_not_called()
+            safe_dirpath = s1_input_dir / S1_PRD_IDS[0] / f'{S1_PRD_IDS[0]}.SAFE'
+            self.assertEqual(sorted(str(path.relative_to(safe_dirpath))
+                                    for path in safe_dirpath.rglob('*.*')),
+                             ['manifest.safe', 'measurement/s1a-iw-grd-vv-20210708t060040-001.tiff'])
+            self.assertEqual((s1_input_dir / S1_PRD_IDS[2] / f'{S1_PRD_IDS[2]}.zip').read_bytes(),
+                             b'zip')
+            self.assertEqual(sorted(path.name for path in s1_input_dir.iterdir()),
+                             [S1_PRD_IDS[0], S1_PRD_IDS[2]])
+
+    @patch.object(ArdUploadQueue, 'join')
+    @patch.object(ArdUploadQueue, 'submit')
+    def test_upload_once_written(self, mock_submit, mock_join):
+        """Each file is queued for upload once written, before the next one is formatted"""
+        calls = []
+        mock_submit.side_effect = lambda ewoc_filepath: calls.append(('upload', ewoc_filepath.name))
+
+        def fake_to_ewoc_s1_ard_calls(*args, on_written=None, **kwargs):
+            def on_written_call(ewoc_filepath):
+                calls.append(('written', ewoc_filepath.name))
+                on_written(ewoc_filepath)
+            return fake_to_ewoc_s1_ard(*args, on_written=on_written_call, **kwargs)
+
+        with TemporaryDirectory() as tmp_dirpath:
+            out_dirpath = Path(tmp_dirpath) / 'ewoc_s1_ard'
+            with patch('ewoc_s1.generate_s1_ard.to_ewoc_s1_ard',
+                       side_effect=fake_to_ewoc_s1_ard_calls):
+                _to_ewoc_s1_ard_tile(S1_PRD_IDS[1:2], '31TCJ', Path(tmp_dirpath),
+                                     Path(tmp_dirpath), out_dirpath, clean=True, nb_workers=2,
+                                     ard_checksums={}, upload_queue=ArdUploadQueue(out_dirpath,
+                                                                                   '0000_000'))
+            self.assertEqual(calls, [('written', 'ewoc_VV.tif'), ('upload', 'ewoc_VV.tif'),
+                                     ('written', 'ewoc_VH.tif'), ('upload', 'ewoc_VH.tif')])
+            # The uploads are waited by the caller
+            mock_join.assert_not_called()
+
+    @patch('ewoc_s1.generate_s1_ard.append_to_ewoc_s1_zarr')
+    def test_zarr_sink_clean(self, mock_append):
+        """With the zarr sink only, the files are removed once appended if clean"""
+        with TemporaryDirectory() as tmp_dirpath:
+            out_dirpath = Path(tmp_dirpath) / 'ewoc_s1_ard'
+            ewoc_dirpath = out_dirpath / 'SAR' / '31' / 'ewoc_date'
+            for clean in [False, True]:
+                with patch('ewoc_s1.generate_s1_ard.to_ewoc_s1_ard',
+                           side_effect=fake_to_ewoc_s1_ard):
+                    _to_ewoc_s1_ard_tile(S1_PRD_IDS[1:2], '31TCJ', Path(tmp_dirpath),
+                                         Path(tmp_dirpath), out_dirpath, clean=clean,
+                                         nb_workers=2, ard_checksums={}, ard_sink='zarr',
+                                         zarr_dirpath=Path(tmp_dirpath) / 'zarr')
+                self.assertEqual(sorted(path.name for path in ewoc_dirpath.iterdir()),
+                                 [] if clean else ['ewoc_VH.tif', 'ewoc_VV.tif'])
+
+            self.assertEqual(mock_append.call_count, 2)
+            self.assertEqual([filepath.name for filepath in mock_append.call_args.args[3].values()],
+                             ['ewoc_VV.tif', 'ewoc_VH.tif'])
+
+    @patch.object(ArdUploadQueue, 'submit')
+    def test_both_sinks_upload(self, mock_submit):
+        """With both sinks, the files are uploaded after their append, even if it fails"""
+        calls = []
+        mock_submit.side_effect = lambda ewoc_filepath: calls.append(('upload', ewoc_filepath.name))
+
+        def fake_append(zarr_dirpath, acquisition_id, acquisition_time, ewoc_filepaths):
+            calls.append(('append', acquisition_id))
+            if len(calls) > 1:
+                raise ArdZarrError(f'{acquisition_id} is not on the grid of {zarr_dirpath}')
+
+        with TemporaryDirectory() as tmp_dirpath:
+            out_dirpath = Path(tmp_dirpath) / 'ewoc_s1_ard'
+            with patch('ewoc_s1.generate_s1_ard.to_ewoc_s1_ard', side_effect=fake_to_ewoc_s1_ard), \
+                 patch('ewoc_s1.generate_s1_ard.append_to_ewoc_s1_zarr', side_effect=fake_append):
+                tile_args = (S1_PRD_IDS[1:2], '31TCJ', Path(tmp_dirpath), Path(tmp_dirpath),
+                             out_dirpath)
+                tile_kwargs = {'clean': True, 'nb_workers': 2, 'ard_checksums': {},
+                               'upload_queue': ArdUploadQueue(out_dirpath, '0000_000'),
+                               'ard_sink': 'both', 'zarr_dirpath': Path(tmp_dirpath) / 'zarr'}
+                _to_ewoc_s1_ard_tile(*tile_args, **tile_kwargs)
+                self.assertEqual(calls, [('append', 'ewoc_date'), ('upload', 'ewoc_VV.tif'),
+                                         ('upload', 'ewoc_VH.tif')])
+
+                with self.assertRaises(S1ARDFormatError):
+                    _to_ewoc_s1_ard_tile(*tile_args, **tile_kwargs)
+                self.assertEqual(calls[3:], [('append', 'ewoc_date'), ('upload', 'ewoc_VV.tif'),
+                                             ('upload', 'ewoc_VH.tif')])
+
+    @patch('ewoc_s1.generate_s1_ard.get_s1_prds', side_effect=fake_get_s1_prds)
+    @patch('ewoc_s1.generate_s1_ard.to_s1tiling_configfile', return_value='S1Processor.cfg')
+    @patch('s1tiling.S1Processor.s1_process')
+    def test_tile_error_cleanup(self, mock_s1_process, mock_to_s1tiling_configfile,
+                                mock_get_s1_prds):
+        """The partial outputs of a failed tile are removed, the other tiles are processed"""
+        def fake_to_ewoc_s1_ard_tile(s1_prd_ids, s2_tile_id, output_s1process_dirpath,
+                                     output_s1process_noized_dirpath, out_dirpath, **kwargs):
+            tile_dirpath = out_dirpath / get_ewoc_ard_tile_relpath(s2_tile_id) / '2021' / \
+                '20210708'
+            tile_dirpath.mkdir(parents=True)
+            (tile_dirpath / 'ewoc_VV.tif').write_bytes(b'VV')
+            if s2_tile_id == '31TDJ':
+                raise S1ARDFormatError(s1_prd_ids)
+
+        with TemporaryDirectory() as tmp_dirpath:
+            out_dirpath = Path(tmp_dirpath) / 'out'
+            out_dirpath.mkdir()
+            tile_errors = {}
+            with patch('ewoc_s1.generate_s1_ard._to_ewoc_s1_ard_tile',
+                       side_effect=fake_to_ewoc_s1_ard_tile):
+                tile_results = generate_s1_ard_tiles(S1_PRD_IDS[:1], ['31TCJ', '31TDJ', '31TEJ'],
+                                                     out_dirpath, Path(tmp_dirpath) / 'dem',
+                                                     Path(tmp_dirpath) / 'wd',
+                                                     tile_errors=tile_errors)
+
+            self.assertEqual(sorted(tile_results), ['31TCJ', '31TEJ'])
+            self.assertEqual(list(tile_errors), ['31TDJ'])
+            ard_dirpath = out_dirpath / 'ewoc_s1_ard'
+            self.assertFalse((ard_dirpath / get_ewoc_ard_tile_relpath('31TDJ')).exists())
+            # The outputs of the other tiles are left to their upload
+            self.assertTrue((ard_dirpath / get_ewoc_ard_tile_relpath('31TCJ')).is_dir())
+            self.assertTrue((ard_dirpath / get_ewoc_ard_tile_relpath('31TEJ')).is_dir())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+from ewoc_s1.instrumentation import (get_stage_recorder, stage, stage_recorder,
+                                     submit_in_context)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+class Test_Instrumentation(unittest.TestCase):
+    def test_stage(self):
+        """The stages are recorded in the recorder of the context, even if they fail"""
+        with stage_recorder() as recorder:
+            with TemporaryDirectory() as tmp_dirpath:
+                with stage('write', tile='31TCJ'):
+                    (Path(tmp_dirpath) / 'data.bin').write_bytes(b'0' * 1024**2)
+            with self.assertRaises(RuntimeError):
+                with stage('compute', tile='31TCJ'):
+                    sum(i * i for i in range(10**6))
+                    raise RuntimeError
+        self.assertNotIn(recorder.records[0], get_stage_recorder().records)
+
+        write_record, compute_record = recorder.records
+        self.assertEqual(write_record.name, 'write')
+        self.assertEqual(write_record.labels, {'tile': '31TCJ'})
+        self.assertTrue(write_record.succeeded)
+        self.assertFalse(compute_record.succeeded)
+        self.assertGreater(compute_record.cpu_time, 0)
+        self.assertGreaterEqual(compute_record.wall_time, 0)
+        self.assertGreater(compute_record.peak_rss, 0)
+
+    def test_stage_threads(self):
+        """The CPU time of a stage includes the threads of the process"""
+        def compute():
+            thread_time_start = time.thread_time()
+            sum(i * i for i in range(3 * 10**6))
+            return time.thread_time() - thread_time_start
+
+        with stage_recorder() as recorder:
+            with stage('compute'):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    thread_times = [future.result() for future in
+                                    [executor.submit(compute) for _ in range(2)]]
+        self.assertGreaterEqual(recorder.records[0].cpu_time, 0.9 * sum(thread_times))
+
+    def test_stage_recorder_context(self):
+        """The units run concurrently in threads record their stages in their own recorder,
+        the stages submitted with submit_in_context are recorded in the recorder of the caller"""
+        def run_unit(unit_idx):
+            with stage_recorder() as recorder:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    for future in [submit_in_context(executor, self._run_stage, unit_idx, pol)
+                                   for pol in ['VV', 'VH']]:
+                        future.result()
+            return recorder.records
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            unit_records = list(executor.map(run_unit, range(4)))
+        for unit_idx, records in enumerate(unit_records):
+            self.assertEqual(sorted((record.labels['unit'], record.labels['polarisation'])
+                                    for record in records),
+                             [(str(unit_idx), 'VH'), (str(unit_idx), 'VV')])
+
+    @staticmethod
+    def _run_stage(unit_idx, pol):
+        with stage('format', unit=str(unit_idx), polarisation=pol):
+            time.sleep(0.05)
+
+    def test_reports(self):
+        with stage_recorder() as recorder:
+            for pol in ['VV', 'VH']:
+                with stage('format', polarisation=pol):
+                    pass
+
+        with TemporaryDirectory() as tmp_dirpath:
+            report_filepath = Path(tmp_dirpath) / 'report.json'
+            recorder.write_report(report_filepath)
+            with open(report_filepath, encoding='utf8') as report_file:
+                report = json.load(report_file)
+            self.assertEqual([elt['labels']['polarisation'] for elt in report['stages']],
+                             ['VV', 'VH'])
+
+            prometheus_filepath = Path(tmp_dirpath) / 'ewoc_s1.prom'
+            recorder.write_prometheus_textfile(prometheus_filepath)
+            metrics = prometheus_filepath.read_text(encoding='utf8').splitlines()
+            self.assertIn('ewoc_s1_stage_count{stage="format"} 2', metrics)
+            self.assertIn('# TYPE ewoc_s1_stage_wall_seconds gauge', metrics)
+            self.assertEqual([elt.name for elt in Path(tmp_dirpath).iterdir()
+                              if elt.name.startswith('.')], [])
+
+if __name__ == "__main__":
+    unittest.main()
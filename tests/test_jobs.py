@@ -0,0 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+from ewoc_s1 import (EWOC_S1_DEM_DOWNLOAD_ERROR, EWOC_S1_PROCESSOR_ERROR,
+                     EWOC_S1_UNEXPECTED_ERROR)
+from ewoc_s1.cli import S1ARDProcessorError, S1DEMProcessorError, generate_s1_ard_worker
+from ewoc_s1.instrumentation import stage
+from ewoc_s1.jobs import EWOC_S1_JOB_REPORT_FILENAME, JobQueue, JobResult, run_jobs
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+S1_PRD_IDS = ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178',
+              'S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979']
+
+def claim_all(db_filepath):
+    """ Claim the jobs of the queue until it is empty """
+    job_queue = JobQueue(db_filepath)
+    job_ids = []
+    job = job_queue.claim()
+    while job is not None:
+        job_ids.append(job.job_id)
+        job = job_queue.claim()
+    return job_ids
+
+class Test_JobQueue(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._db_filepath = Path(self._tmp_dir.name) / 'queue' / 'jobs.sqlite'
+        self._job_queue = JobQueue(self._db_filepath)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_submit_claim(self):
+        first_job_id = self._job_queue.submit('31TCJ', S1_PRD_IDS, '0000_000')
+        self._job_queue.submit('31TDJ', S1_PRD_IDS[:1])
+
+        job = self._job_queue.claim()
+        self.assertEqual(job.job_id, first_job_id)
+        self.assertEqual((job.s2_tile_id, job.s1_prd_ids, job.production_id),
+                         ('31TCJ', S1_PRD_IDS, '0000_000'))
+        self._job_queue.complete(job.job_id, JobResult(0, '', 4, 's3://ewoc/31TCJ'))
+        self.assertEqual(self._job_queue.count(), {'done': 1, 'pending': 1})
+        job_status = self._job_queue.get_job_status(job.job_id)
+        self.assertEqual((job_status['status'], job_status['nb_s1_ard_files']), ('done', 4))
+        self.assertIsNone(self._job_queue.get_job_status(42))
+
+        job = self._job_queue.claim()
+        self.assertEqual(job.production_id, None)
+        self.assertEqual(self._job_queue.count(), {'done': 1, 'running': 1})
+        self.assertIsNone(self._job_queue.claim())
+
+    def test_dead_worker(self):
+        """The jobs of the dead workers are pending again up to the max number of attempts"""
+        job_queue = JobQueue(self._db_filepath, max_attempts=2)
+        job_id = job_queue.submit('31TCJ', S1_PRD_IDS)
+        job_queue.claim()
+        with patch('ewoc_s1.jobs.psutil.pid_exists', return_value=False):
+            self.assertEqual(job_queue.claim().job_id, job_id)
+            self.assertIsNone(job_queue.claim())
+        job_status = job_queue.get_job_status(job_id)
+        self.assertEqual((job_status['status'], job_status['attempts'], job_status['exit_code']),
+                         ('failed', 2, EWOC_S1_UNEXPECTED_ERROR))
+
+    def test_concurrent_claims(self):
+        """Each job is claimed by only one worker"""
+        job_ids = [self._job_queue.submit(f'{idx:05d}', S1_PRD_IDS) for idx in range(40)]
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            claimed_job_ids = [job_id for worker_job_ids in
+                               executor.map(claim_all, [self._db_filepath] * 4)
+                               for job_id in worker_job_ids]
+        self.assertEqual(sorted(claimed_job_ids), job_ids)
+
+class Test_RunJobs(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._job_queue = JobQueue(Path(self._tmp_dir.name) / 'jobs.sqlite')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_run_jobs(self):
+        """The jobs are processed in the same process and their results recorded"""
+        def job_fn(job):
+            if job.s2_tile_id == '31TDJ':
+                return JobResult(EWOC_S1_PROCESSOR_ERROR, 'S1Tiling failed')
+            if job.s2_tile_id == '31TEJ':
+                raise ValueError('Unexpected')
+            return JobResult(0, '', len(job.s1_prd_ids), f's3://ewoc/{job.s2_tile_id}')
+
+        for s2_tile_id in ['31TCJ', '31TDJ', '31TEJ']:
+            self._job_queue.submit(s2_tile_id, S1_PRD_IDS)
+        self.assertEqual(run_jobs(self._job_queue, job_fn, idle_timeout=0.2, poll_interval=0.05),
+                         (3, 2))
+
+        self.assertEqual([self._job_queue.get_job_status(job_id)['exit_code']
+                          for job_id in [1, 2, 3]],
+                         [0, EWOC_S1_PROCESSOR_ERROR, EWOC_S1_UNEXPECTED_ERROR])
+        self.assertEqual(self._job_queue.count(), {'done': 1, 'failed': 2})
+        self.assertEqual(self._job_queue.get_job_status(1)['s1_ard_s3path'], 's3://ewoc/31TCJ')
+        self.assertIn('Unexpected', self._job_queue.get_job_status(3)['message'])
+
+    def test_max_jobs_and_interruption(self):
+        self._job_queue.submit('31TCJ', S1_PRD_IDS)
+        self._job_queue.submit('31TDJ', S1_PRD_IDS)
+        self.assertEqual(run_jobs(self._job_queue, lambda job: JobResult(0), max_jobs=1), (1, 0))
+
+        def interrupted_job_fn(job):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            run_jobs(self._job_queue, interrupted_job_fn)
+        self.assertEqual(self._job_queue.count(), {'done': 1, 'pending': 1})
+        self.assertEqual(self._job_queue.get_job_status(2)['attempts'], 0)
+
+def fake_generate_s1_ard_from_pids(s1_prd_ids, s2_tile_id, out_dirpath_root,
+                                   working_dirpath_root, **kwargs):
+    """ Outcome of the job chosen by its S2 tile id """
+    with stage('s1_process', tile=s2_tile_id):
+        (working_dirpath_root / 'tmp.tif').touch()
+        (out_dirpath_root / 'SAR').mkdir()
+    if s2_tile_id == '31TDJ':
+        raise S1DEMProcessorError('No DEM')
+    if s2_tile_id == '31TEJ':
+        (out_dirpath_root / 'SAR' / 'not_uploaded.tif').touch()
+        raise S1ARDProcessorError(s2_tile_id, s1_prd_ids, 'aws', EWOC_S1_PROCESSOR_ERROR)
+    if s2_tile_id == '31TFJ':
+        raise BaseException() from ValueError('Unexpected')
+    if s2_tile_id == '31TGJ':
+        raise BaseException('Interrupted')
+    return len(s1_prd_ids), f's3://ewoc/{s2_tile_id}'
+
+class Test_Worker(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._out_dirpath = Path(self._tmp_dir.name) / 'out'
+        self._working_dirpath = Path(self._tmp_dir.name) / 'wd'
+        self._job_queue = JobQueue(Path(self._tmp_dir.name) / 'jobs.sqlite')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _run_worker(self):
+        with patch('ewoc_s1.cli.generate_s1_ard_from_pids', fake_generate_s1_ard_from_pids):
+            return generate_s1_ard_worker(self._job_queue, self._out_dirpath,
+                                          self._working_dirpath, idle_timeout=0)
+
+    def test_exit_codes(self):
+        """The errors of generate_s1_ard_from_pids are mapped to the result of the job"""
+        for s2_tile_id in ['31TCJ', '31TDJ', '31TEJ', '31TFJ']:
+            self._job_queue.submit(s2_tile_id, S1_PRD_IDS)
+        self.assertEqual(self._run_worker(), (4, 3))
+
+        job_statuses = [self._job_queue.get_job_status(job_id) for job_id in [1, 2, 3, 4]]
+        self.assertEqual([job_status['exit_code'] for job_status in job_statuses],
+                         [0, EWOC_S1_DEM_DOWNLOAD_ERROR, EWOC_S1_PROCESSOR_ERROR,
+                          EWOC_S1_UNEXPECTED_ERROR])
+        self.assertEqual((job_statuses[0]['nb_s1_ard_files'], job_statuses[0]['s1_ard_s3path']),
+                         (2, 's3://ewoc/31TCJ'))
+        self.assertIn('No DEM', job_statuses[1]['message'])
+        self.assertIn('Unexpected', job_statuses[3]['message'])
+
+        # A BaseException which does not wrap an error stops the worker
+        self._job_queue.submit('31TGJ', S1_PRD_IDS)
+        with self.assertRaises(BaseException):
+            self._run_worker()
+        self.assertEqual(self._job_queue.get_job_status(5)['status'], 'pending')
+
+    def test_job_dirs(self):
+        """The job directories are removed except the files not uploaded and the job report"""
+        for s2_tile_id in ['31TCJ', '31TEJ']:
+            self._job_queue.submit(s2_tile_id, S1_PRD_IDS)
+        self._run_worker()
+
+        self.assertEqual(list(self._working_dirpath.iterdir()), [])
+        job_out_dirpaths = [self._out_dirpath / f'ewoc_s1_job_{job_id}' for job_id in [1, 2]]
+        self.assertEqual(list(job_out_dirpaths[0].iterdir()),
+                         [job_out_dirpaths[0] / EWOC_S1_JOB_REPORT_FILENAME])
+        self.assertTrue((job_out_dirpaths[1] / 'SAR' / 'not_uploaded.tif').exists())
+
+        # One report by job with only the stages of the job
+        for job_out_dirpath, s2_tile_id in zip(job_out_dirpaths, ['31TCJ', '31TEJ']):
+            with open(job_out_dirpath / EWOC_S1_JOB_REPORT_FILENAME, encoding='utf8') as report_file:
+                report = json.load(report_file)
+            self.assertEqual(sorted(record['name'] for record in report['stages']),
+                             ['job', 's1_process'])
+            self.assertTrue(all(record['labels']['tile'] == s2_tile_id
+                                for record in report['stages']))
+
+if __name__ == "__main__":
+    unittest.main()
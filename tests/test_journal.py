@@ -0,0 +1,63 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+from ewoc_s1.journal import WpJournal
+from ewoc_s1.utils import WpUnit
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+WP_UNITS = [WpUnit('31TCJ', '2021-07-08',
+                   ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178']),
+            WpUnit('31TCJ', '2021-07-20',
+                   ['S1A_IW_GRDH_1SDV_20210720T060041_20210720T060106_038857_0495B3_0AB5']),
+            WpUnit('31TDJ', '2021-07-08',
+                   ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178'])]
+
+class Test_WpJournal(unittest.TestCase):
+    def test_resume(self):
+        """The completed units are read back from the journal"""
+        with TemporaryDirectory() as tmp_dirpath:
+            journal_filepath = Path(tmp_dirpath) / 'journal.jsonl'
+            wp_journal = WpJournal(journal_filepath)
+            wp_journal.record(WP_UNITS[0], {'SAR/31/T/CJ/2021/20210708/a_VV.tif': '0' * 64},
+                              's3://ewoc-ard/0000_000/')
+            wp_journal.record(WP_UNITS[2], {})
+
+            wp_journal = WpJournal(journal_filepath)
+            self.assertEqual([wp_journal.is_completed(unit) for unit in WP_UNITS],
+                             [True, False, True])
+            self.assertEqual(wp_journal.get_entry(WP_UNITS[0])['s1_ard_s3path'],
+                             's3://ewoc-ard/0000_000/')
+
+    def test_legacy_unit_id(self):
+        """The units recorded without their relative orbit are found by their products"""
+        with TemporaryDirectory() as tmp_dirpath:
+            journal_filepath = Path(tmp_dirpath) / 'journal.jsonl'
+            WpJournal(journal_filepath).record(WP_UNITS[0], {})
+            wp_journal = WpJournal(journal_filepath)
+            self.assertTrue(wp_journal.is_completed(WP_UNITS[0]._replace(relative_orbit=110)))
+            self.assertFalse(wp_journal.is_completed(WP_UNITS[2]._replace(s2_tile_id='31TCJ',
+                                                                          relative_orbit=110,
+                                                                          s1_prd_ids=[])))
+
+    def test_incomplete_line(self):
+        """A line interrupted during the write is ignored"""
+        with TemporaryDirectory() as tmp_dirpath:
+            journal_filepath = Path(tmp_dirpath) / 'journal.jsonl'
+            WpJournal(journal_filepath).record(WP_UNITS[0], {})
+            with open(journal_filepath, 'a', encoding='utf8') as journal_file:
+                journal_file.write('{"unit_id": "31TCJ_2021-07-20", "outp')
+
+            wp_journal = WpJournal(journal_filepath)
+            self.assertFalse(wp_journal.is_completed(WP_UNITS[1]))
+            wp_journal.record(WP_UNITS[1], {})
+
+            wp_journal = WpJournal(journal_filepath)
+            self.assertTrue(wp_journal.is_completed(WP_UNITS[0]))
+            self.assertTrue(wp_journal.is_completed(WP_UNITS[1]))
+
+if __name__ == "__main__":
+    unittest.main()
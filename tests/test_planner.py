@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+from ewoc_s1.instrumentation import stage, stage_recorder
+from ewoc_s1.planner import PlanCalibration, estimate_units, summarize_units, write_plan
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+S1_PRD_IDS = [['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178',
+               'S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979'],
+              ['S1A_IW_GRDH_1SDV_20210720T060041_20210720T060106_038857_0495B3_0AB5',
+               'S1A_IW_GRDH_1SDV_20210720T060106']]
+
+def stage_record(name, wall_time, cpu_time=0., write_bytes=0, succeeded=True, **labels):
+    return {'name': name, 'labels': labels, 'start': '2021-07-08T06:00:00',
+            'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_rss': 0, 'read_bytes': 0,
+            'write_bytes': write_bytes, 'succeeded': succeeded}
+
+class Test_Planner(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._wp_filepath = Path(self._tmp_dir.name) / 'wp.json'
+        with open(self._wp_filepath, 'w', encoding='utf8') as wp_file:
+            json.dump({'version': '1.0',
+                       'tiles': [{'tile_id': '31TCJ', 's1_ids': S1_PRD_IDS},
+                                 {'tile_id': '31TDJ', 's1_ids': S1_PRD_IDS[:1]}]}, wp_file)
+        self._report_filepath = Path(self._tmp_dir.name) / 'report.json'
+        with open(self._report_filepath, 'w', encoding='utf8') as report_file:
+            json.dump({'stages': [
+                stage_record('download', 20., write_bytes=2000, nb_products='2'),
+                stage_record('download', 1., nb_products='2'),
+                stage_record('s1_process', 100., cpu_time=400., nb_products='2'),
+                stage_record('s1_process_noized', 60., cpu_time=200., nb_products='1'),
+                stage_record('s1_process', 120., cpu_time=800., nb_products='2'),
+                stage_record('s1_process', 1000., succeeded=False, nb_products='1'),
+                stage_record('ard_format', 10., write_bytes=300)]}, report_file)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_calibration(self):
+        """The costs are averaged over the succeeded stages, per product and per pass"""
+        calibration = PlanCalibration.from_reports([self._report_filepath])
+        self.assertEqual(calibration.download_bytes_per_product, 1000)
+        self.assertEqual(calibration.download_time_per_product, 10.)
+        self.assertEqual(calibration.s1_process_time_per_product, 280. / 5)
+        self.assertEqual(calibration.s1_process_cpu_time_per_product, 280.)
+        self.assertEqual(calibration.ard_file_size, 150)
+        self.assertEqual(calibration.nb_reports, 1)
+
+    def test_calibration_threads(self):
+        """The CPU time of a S1Tiling stage includes its worker threads"""
+        def compute():
+            thread_time_start = time.thread_time()
+            sum(i * i for i in range(3 * 10**6))
+            return time.thread_time() - thread_time_start
+
+        with stage_recorder() as recorder:
+            with stage('s1_process', nb_products='2'):
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    thread_time = sum(future.result() for future in
+                                      [executor.submit(compute) for _ in range(4)])
+        recorder.write_report(self._report_filepath)
+
+        calibration = PlanCalibration.from_reports([self._report_filepath])
+        self.assertGreaterEqual(calibration.s1_process_cpu_time_per_product,
+                                0.9 * thread_time / 2)
+
+    def test_estimate_units(self):
+        """The invalid product ids are reported and the units scheduled on the parallel slots"""
+        calibration = PlanCalibration(download_bytes_per_product=1000,
+                                      download_time_per_product=10.,
+                                      s1_process_time_per_product=50.,
+                                      s1_process_cpu_time_per_product=200.,
+                                      format_time_per_unit=5., ard_file_size=150)
+        unit_estimates = estimate_units(self._wp_filepath, calibration, nb_parallel_units=2)
+
+        self.assertEqual([unit.unit_id for unit in unit_estimates],
+                         ['31TCJ_2021-07-08_R110', '31TCJ_2021-07-20_R110',
+                          '31TDJ_2021-07-08_R110'])
+        self.assertEqual(unit_estimates[1].invalid_s1_prd_ids, S1_PRD_IDS[1][1:])
+        self.assertEqual(unit_estimates[0].download_bytes, 2000)
+        self.assertEqual(unit_estimates[0].output_bytes, 300)
+        self.assertEqual(unit_estimates[0].cpu_time, 800.)
+        self.assertEqual([(unit.start, unit.end) for unit in unit_estimates],
+                         [(0., 225.), (0., 115.), (115., 340.)])
+
+        plan_summary = summarize_units(unit_estimates, calibration)
+        self.assertEqual(plan_summary['nb_products'], 5)
+        self.assertEqual(plan_summary['nb_invalid_products'], 1)
+        self.assertEqual(plan_summary['duration_hours'], 340. / 3600)
+
+    def test_write_plan(self):
+        unit_estimates = estimate_units(self._wp_filepath)
+        for plan_filename in ['plan.json', 'plan.csv']:
+            write_plan(unit_estimates, Path(self._tmp_dir.name) / plan_filename)
+        with open(Path(self._tmp_dir.name) / 'plan.json', encoding='utf8') as plan_file:
+            plan = json.load(plan_file)
+        self.assertEqual(plan['summary']['nb_units'], 3)
+        self.assertEqual(len(plan['units']), 3)
+        with open(Path(self._tmp_dir.name) / 'plan.csv', encoding='utf8', newline='') as plan_file:
+            rows = list(csv.DictReader(plan_file))
+        self.assertEqual(rows[1]['invalid_s1_prd_ids'], S1_PRD_IDS[1][1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
+import copy
 from datetime import datetime
+import pickle
+import time
 import unittest
 
 
@@ -8,6 +11,22 @@ __author__ = "Mickael Savinaud"
 __copyright__ = "Mickael Savinaud"
 __license__ = "MIT"
 
+# Number of product ids of the synthetic work plan and the time budget in seconds to validate them
+NB_BENCHMARK_PRD_IDS = 100000
+PRD_ID_BENCHMARK_BUDGET = 5.
+
+def synthetic_s1_prd_ids(nb_s1_prd_ids):
+    """ Product ids of a work plan where each product is shared by two adjacent tiles """
+    s1_prd_ids = []
+    tile_idx = 0
+    while len(s1_prd_ids) < nb_s1_prd_ids:
+        for prd_idx in [tile_idx, tile_idx + 1]:
+            date = f'2021{1 + prd_idx % 12:02d}{1 + prd_idx % 28:02d}T{prd_idx % 24:02d}'
+            s1_prd_ids.append(f'S1A_IW_GRDH_1SDV_{date}0040_{date}0105_{prd_idx % 999999:06d}_'
+                              f'{prd_idx % 0xFFFFFF:06X}_{prd_idx % 0xFFFF:04X}')
+        tile_idx += 1
+    return s1_prd_ids
+
 class Test_S1PrdIdInfo(unittest.TestCase):
     def test_s1_prd_info(self):
         """API Tests"""
@@ -27,6 +46,61 @@ class Test_S1PrdIdInfo(unittest.TestCase):
         self.assertEqual(s1_prd_info.absolute_orbit_number , '038682')
         self.assertEqual(s1_prd_info.mission_datatake_id , '04908E')
         self.assertEqual(s1_prd_info.product_unique_id , '8979')
+        self.assertEqual(s1_prd_info.relative_orbit_number, 110)
+
+    def test_relative_orbit_number(self):
+        s1_prd_info = S1PrdIdInfo('S1B_IW_GRDH_1SDV_20210703T172453_20210703T172518_027624_034C1F_B0C2')
+        self.assertEqual(s1_prd_info.relative_orbit_number, 123)
+
+    def test_immutable(self):
+        s1_prd_info = S1PrdIdInfo('S1B_IW_GRDH_1SDV_20210703T172453_20210703T172518_027624_034C1F_B0C2')
+        with self.assertRaises(AttributeError):
+            s1_prd_info.mission_id = 'S1A'
+        with self.assertRaises(AttributeError):
+            s1_prd_info.other = 'S1A'
+
+    def test_pickle(self):
+        """The product ids are sent to the worker processes and copied"""
+        s1_prd_info = S1PrdIdInfo('S1B_IW_GRDH_1SDV_20210703T172453_20210703T172518_027624_034C1F_B0C2')
+        for s1_prd_info_copy in [pickle.loads(pickle.dumps(s1_prd_info)),
+                                 copy.deepcopy(s1_prd_info), copy.copy(s1_prd_info)]:
+            self.assertEqual(s1_prd_info_copy, s1_prd_info)
+            self.assertEqual(s1_prd_info_copy.start_time, s1_prd_info.start_time)
+            self.assertEqual(s1_prd_info_copy.relative_orbit_number, 123)
+            with self.assertRaises(AttributeError):
+                s1_prd_info_copy.mission_id = 'S1A'
+
+    def test_parse(self):
+        """The parsed ids are cached by id without extension"""
+        s1_prd_id = 'S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979'
+        s1_prd_info = S1PrdIdInfo.parse(s1_prd_id)
+        self.assertIs(S1PrdIdInfo.parse(f'{s1_prd_id}.SAFE'), s1_prd_info)
+        self.assertEqual(s1_prd_info, S1PrdIdInfo(s1_prd_id))
+        self.assertEqual(s1_prd_info.s1_prd_id, s1_prd_id)
+
+    def test_validate_many(self):
+        valid_s1_prd_ids = ['S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979',
+                            'S1B_IW_GRDH_1SDV_20210703T172453_20210703T172518_027624_034C1F_B0C2']
+        invalid_s1_prd_ids = ['S1A_IW_GRDH_1SDV_20210708T060105',
+                              'S1C_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979',
+                              'S1A_IW_GRDH_1SDV_20211308T060105_20211308T060130_038682_04908E_8979']
+        s1_prd_ids, errors = S1PrdIdInfo.validate_many(invalid_s1_prd_ids[:2] + valid_s1_prd_ids +
+                                                       invalid_s1_prd_ids[2:])
+        self.assertEqual(s1_prd_ids, valid_s1_prd_ids)
+        self.assertEqual(list(errors), invalid_s1_prd_ids)
+        self.assertIn('9 keys', errors[invalid_s1_prd_ids[0]])
+        self.assertIn('Invalid mission ID', errors[invalid_s1_prd_ids[1]])
+        self.assertIn('Invalid start or stop time', errors[invalid_s1_prd_ids[2]])
+        self.assertFalse(S1PrdIdInfo.is_valid(invalid_s1_prd_ids[2]))
+
+class Test_S1PrdIdInfoBenchmark(unittest.TestCase):
+    def test_validate_work_plan(self):
+        """The product ids of a large work plan are validated within the budget"""
+        s1_prd_ids = synthetic_s1_prd_ids(NB_BENCHMARK_PRD_IDS)
+        start = time.perf_counter()
+        valid_s1_prd_ids, errors = S1PrdIdInfo.validate_many(s1_prd_ids)
+        self.assertLess(time.perf_counter() - start, PRD_ID_BENCHMARK_BUDGET)
+        self.assertEqual((len(valid_s1_prd_ids), errors), (NB_BENCHMARK_PRD_IDS, {}))
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,226 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+import zipfile
+
+import numpy as np
+import rasterio
+from rasterio.control import GroundControlPoint
+
+from ewoc_s1.safe import (LocalSafeStore, SafeStore, SafeStoreError, download_safe,
+                          is_required_safe_file, open_zipped_safe, open_zipped_safes)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+S1_PRD_ID = 'S1A_IW_GRDH_1SDV_20210708T060105_20210708T060130_038682_04908E_8979'
+SAFE_NAME = 's1a-iw-grd-{pol}-20210708t060105-20210708t060130-038682-04908e-001'
+READ_LATENCY = 0.1
+# Size in pixels of the measurements of the synthetic zipped SAFE of the benchmark
+ZIP_BENCHMARK_SIZE = 4096
+
+def safe_files(measurement_size=100):
+    """ Files of a SAFE product, the measurements are filled with their offset modulo 256 """
+    files = {}
+    for pol in ['vv', 'vh']:
+        name = SAFE_NAME.format(pol=pol)
+        files[f'measurement/{name}.tiff'] = bytes(idx % 256 for idx in range(measurement_size))
+        files[f'annotation/{name}.xml'] = b'<product/>'
+        files[f'annotation/calibration/calibration-{name}.xml'] = b'<calibration/>'
+        files[f'annotation/calibration/noise-{name}.xml'] = b'<noise/>'
+        files[f'annotation/rfi/rfi-{name}.xml'] = b'<rfi/>'
+    files['preview/quick-look.png'] = b'png'
+    files['preview/map-overlay.kml'] = b'<kml/>'
+    files['support/s1-level-1-product.xsd'] = b'<xsd/>'
+    byte_streams = ''.join(
+        f'<dataObject><byteStream size="{len(content)}"><fileLocation locatorType="URL" '
+        f'href="./{relpath}"/></byteStream></dataObject>' for relpath, content in files.items())
+    files['manifest.safe'] = ('<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">'
+                              f'<dataObjectSection>{byte_streams}</dataObjectSection>'
+                              '</xfdu:XFDU>').encode()
+    return files
+
+def write_zipped_safe(zip_filepath, measurement_size):
+    """ Zipped SAFE product, deflated as the distributed ones, whose measurements are GeoTIFF
+    files with GCPs
+    """
+    files = safe_files()
+    tmp_filepath = zip_filepath.with_suffix('.tiff')
+    values = np.arange(measurement_size**2, dtype=np.uint16).reshape(measurement_size, -1)
+    gcps = [GroundControlPoint(0, 0, 0.5, 43.2, 0.), GroundControlPoint(
+        measurement_size, measurement_size, 1.9, 44.1, 0.)]
+    with rasterio.open(tmp_filepath, 'w', driver='GTiff', width=measurement_size,
+                       height=measurement_size, count=1, dtype='uint16', gcps=gcps,
+                       crs='EPSG:4326') as dataset:
+        dataset.write(values, 1)
+    with zipfile.ZipFile(zip_filepath, 'w', compression=zipfile.ZIP_DEFLATED) as safe_zip:
+        for relpath, content in files.items():
+            if relpath.startswith('measurement/'):
+                safe_zip.write(tmp_filepath, f'{S1_PRD_ID}.SAFE/{relpath}')
+            else:
+                safe_zip.writestr(f'{S1_PRD_ID}.SAFE/{relpath}', content)
+    tmp_filepath.unlink()
+    return values
+
+def get_dir_size(dirpath):
+    return sum(filepath.stat().st_size for filepath in dirpath.rglob('*') if filepath.is_file())
+
+class FakeObjectStore(SafeStore):
+    """ Object store of one SAFE product which records the ranged reads """
+
+    def __init__(self, files):
+        self._objects = {f'{S1_PRD_ID}.SAFE/{relpath}': content for relpath, content in files.items()}
+        self.reads = []
+        self.max_concurrent_reads = 0
+        self._nb_reads = 0
+        self._lock = threading.Lock()
+
+    def get_safe_key(self, s1_prd_id):
+        if s1_prd_id.split('.')[0] != S1_PRD_ID:
+            raise SafeStoreError(f'{s1_prd_id} not available')
+        return f'{S1_PRD_ID}.SAFE'
+
+    def read(self, key, offset=0, size=None):
+        with self._lock:
+            self.reads.append((key.split('/', 1)[1], offset, size))
+            self._nb_reads += 1
+            self.max_concurrent_reads = max(self.max_concurrent_reads, self._nb_reads)
+        time.sleep(READ_LATENCY)
+        with self._lock:
+            self._nb_reads -= 1
+        if key not in self._objects:
+            raise SafeStoreError(f'{key} not available')
+        content = self._objects[key]
+        return content[offset:] if size is None else content[offset:offset + size]
+
+class Test_Safe(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._tmp_dirpath = Path(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_is_required_safe_file(self):
+        name = SAFE_NAME.format(pol='vh')
+        self.assertTrue(is_required_safe_file(f'measurement/{name}.tiff'))
+        self.assertTrue(is_required_safe_file(f'annotation/calibration/noise-{name}.xml'))
+        self.assertFalse(is_required_safe_file(f'measurement/{name}.tiff', ['VV']))
+        self.assertFalse(is_required_safe_file(f'annotation/rfi/rfi-{name}.xml'))
+        self.assertFalse(is_required_safe_file('preview/quick-look.png'))
+
+    def test_download_safe(self):
+        """Only the files read by S1Tiling are downloaded with concurrent ranged reads"""
+        files = safe_files()
+        safe_store = FakeObjectStore(files)
+        safe_dirpath = self._tmp_dirpath / f'{S1_PRD_ID}.SAFE'
+        nb_bytes = download_safe(safe_store, S1_PRD_ID, safe_dirpath, nb_workers=4, chunk_size=30)
+
+        downloaded = {str(filepath.relative_to(safe_dirpath)): filepath.read_bytes()
+                      for filepath in safe_dirpath.rglob('*') if filepath.is_file()}
+        self.assertEqual(len(downloaded), 9)
+        self.assertEqual(downloaded, {relpath: files[relpath] for relpath in downloaded})
+        self.assertEqual(nb_bytes, sum(len(content) for content in downloaded.values()))
+        self.assertFalse({'preview', 'support'} & {relpath.split('/')[0] for relpath, __unused,
+                                                   __unused in safe_store.reads})
+        measurement_relpath = f'measurement/{SAFE_NAME.format(pol="vv")}.tiff'
+        self.assertEqual([(offset, size) for relpath, offset, size in safe_store.reads
+                          if relpath == measurement_relpath], [(0, 30), (30, 30), (60, 30), (90, 10)])
+        self.assertEqual(safe_store.max_concurrent_reads, 4)
+
+    def test_download_safe_error(self):
+        """The product is removed if one of its files is not read"""
+        safe_store = FakeObjectStore({'manifest.safe': safe_files()['manifest.safe']})
+        safe_dirpath = self._tmp_dirpath / f'{S1_PRD_ID}.SAFE'
+        with self.assertRaises(SafeStoreError):
+            download_safe(safe_store, S1_PRD_ID, safe_dirpath)
+        self.assertFalse(safe_dirpath.exists())
+        with self.assertRaises(SafeStoreError):
+            download_safe(safe_store, S1_PRD_ID.replace('8979', '0000'), safe_dirpath)
+
+    def test_local_safe_store(self):
+        """The products are found with the layout of the Creodias archive"""
+        safe_dirpath = self._tmp_dirpath / 'Sentinel-1/SAR/GRD/2021/07/08' / f'{S1_PRD_ID}.SAFE'
+        for relpath, content in safe_files().items():
+            (safe_dirpath / relpath).parent.mkdir(exist_ok=True, parents=True)
+            (safe_dirpath / relpath).write_bytes(content)
+        safe_store = LocalSafeStore(self._tmp_dirpath)
+
+        self.assertEqual(safe_store.get_safe_key(f'{S1_PRD_ID}.SAFE'),
+                         f'Sentinel-1/SAR/GRD/2021/07/08/{S1_PRD_ID}.SAFE')
+        out_safe_dirpath = self._tmp_dirpath / 'input' / f'{S1_PRD_ID}.SAFE'
+        download_safe(safe_store, S1_PRD_ID, out_safe_dirpath)
+        self.assertEqual(len(list(out_safe_dirpath.glob('measurement/*.tiff'))), 2)
+        self.assertFalse((out_safe_dirpath / 'preview').exists())
+        with self.assertRaises(SafeStoreError):
+            safe_store.get_safe_key(S1_PRD_ID.replace('8979', '0000'))
+
+class Test_ZippedSafe(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._tmp_dirpath = Path(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_open_zipped_safe(self):
+        """The measurements are read from the zip file through the SAFE directory"""
+        zip_filepath = self._tmp_dirpath / f'{S1_PRD_ID}.zip'
+        values = write_zipped_safe(zip_filepath, 64)
+        safe_dirpath = self._tmp_dirpath / 'input' / f'{S1_PRD_ID}.SAFE'
+        open_zipped_safe(zip_filepath, safe_dirpath)
+
+        self.assertEqual(len(list(safe_dirpath.rglob('*.xml'))), 6)
+        self.assertFalse((safe_dirpath / 'preview').exists())
+        for measurement_filepath in safe_dirpath.glob('measurement/*.tiff'):
+            with rasterio.open(measurement_filepath) as dataset:
+                self.assertEqual(dataset.driver, 'VRT')
+                self.assertEqual(len(dataset.gcps[0]), 2)
+                np.testing.assert_array_equal(dataset.read(1), values)
+
+    def test_open_zipped_safes(self):
+        """The products which are not SAFE zip files are reported"""
+        s1_input_dirpath = self._tmp_dirpath / 'input'
+        (s1_input_dirpath / S1_PRD_ID).mkdir(parents=True)
+        write_zipped_safe(s1_input_dirpath / S1_PRD_ID / f'{S1_PRD_ID}.zip', 16)
+        s1_prd_id_error = S1_PRD_ID.replace('8979', '0000')
+        (s1_input_dirpath / s1_prd_id_error).mkdir()
+        (s1_input_dirpath / s1_prd_id_error / f'{s1_prd_id_error}.zip').write_bytes(b'not a zip')
+
+        self.assertEqual(open_zipped_safes(s1_input_dirpath), [s1_prd_id_error])
+        self.assertTrue((s1_input_dirpath / S1_PRD_ID / f'{S1_PRD_ID}.SAFE' / 'manifest.safe').is_file())
+        self.assertFalse((s1_input_dirpath / s1_prd_id_error / f'{s1_prd_id_error}.SAFE').exists())
+
+    def test_zipped_safe_benchmark(self):
+        """The SAFE directory of a zipped product is much smaller than its extraction and its
+        measurements are read through /vsizip/ about as fast as the extracted ones"""
+        zip_filepath = self._tmp_dirpath / f'{S1_PRD_ID}.zip'
+        values = write_zipped_safe(zip_filepath, ZIP_BENCHMARK_SIZE)
+
+        def read_measurements(safe_dirpath):
+            for measurement_filepath in safe_dirpath.glob('measurement/*.tiff'):
+                with rasterio.open(measurement_filepath) as dataset:
+                    np.testing.assert_array_equal(dataset.read(1), values)
+
+        start = time.perf_counter()
+        with zipfile.ZipFile(zip_filepath) as safe_zip:
+            safe_zip.extractall(self._tmp_dirpath / 'extracted')
+        read_measurements(self._tmp_dirpath / 'extracted' / f'{S1_PRD_ID}.SAFE')
+        extract_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        safe_dirpath = self._tmp_dirpath / 'opened' / f'{S1_PRD_ID}.SAFE'
+        nb_bytes = open_zipped_safe(zip_filepath, safe_dirpath)
+        read_measurements(safe_dirpath)
+        open_time = time.perf_counter() - start
+
+        self.assertEqual(nb_bytes, get_dir_size(self._tmp_dirpath / 'opened'))
+        self.assertLess(nb_bytes, get_dir_size(self._tmp_dirpath / 'extracted') / 100)
+        # The deflated measurements are decompressed by both, the extraction writes them
+        self.assertLess(open_time, 2 * extract_time)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,297 @@
+from functools import partial
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+from unittest.mock import patch
+
+from ewoc_s1 import (EWOC_S1_ARD_FORMAT_ERROR, EWOC_S1_PROCESSOR_ERROR,
+                     EWOC_S1_UNEXPECTED_ERROR)
+from ewoc_s1.cli import generate_s1_ard_wp
+from ewoc_s1.generate_s1_ard import S1ARDFormatError
+from ewoc_s1.instrumentation import stage, stage_recorder
+from ewoc_s1.scheduler import (S1InputPrefetcher, WpUnitResult, get_wp_unit_executor,
+                               run_wp_unit, run_wp_unit_group)
+from ewoc_s1.utils import ClusterConfig, WpUnit
+from ewoc_s1.workspace import EWOC_S1_GRD_SIZE_ESTIMATE
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+WP_UNITS = [WpUnit('31TCJ', '2021-07-08',
+                   ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178']),
+            WpUnit('31TCJ', '2021-07-20',
+                   ['S1A_IW_GRDH_1SDV_20210720T060041_20210720T060106_038857_0495B3_0AB5']),
+            WpUnit('31TDJ', '2021-07-08',
+                   ['S1A_IW_GRDH_1SDV_20210708T060040_20210708T060105_038682_04908E_3178'])]
+
+def fake_generate_s1_ard(s1_prd_ids, s2_tile_id, out_dirpath_root, dem_dirpath, working_dirpath,
+                         **kwargs):
+    if s2_tile_id == '31TDJ':
+        raise S1ARDFormatError(s1_prd_ids)
+    if '20210720' in s1_prd_ids[0]:
+        raise RuntimeError('Generate S1 ARD failed during the upload of ARD data to bucket')
+    return 2, f's3://ewoc-ard/{s2_tile_id}'
+
+def fake_start_s1_ard_tiles(s1_prd_ids, s2_tile_ids, out_dirpath_root, dem_dirpath,
+                            working_dirpath, **kwargs):
+    """ The upload of 2021-07-20 fails once waited """
+    if '20210720' in s1_prd_ids[0]:
+        return partial(fake_generate_s1_ard, s1_prd_ids, s2_tile_ids[0], out_dirpath_root,
+                       dem_dirpath, working_dirpath)
+    tile_result = fake_generate_s1_ard(s1_prd_ids, s2_tile_ids[0], out_dirpath_root,
+                                       dem_dirpath, working_dirpath)
+    return lambda: {s2_tile_ids[0]: tile_result}
+
+def fake_start_s1_ard_tiles_group(s1_prd_ids, s2_tile_ids, out_dirpath_root, dem_dirpath,
+                                  working_dirpath, ard_checksums, tile_errors, **kwargs):
+    for s2_tile_id in s2_tile_ids:
+        ard_checksums[f'SAR/{s2_tile_id[:2]}/{s2_tile_id[2]}/{s2_tile_id[3:]}/ard_VV.tif'] = \
+            s2_tile_id
+    tile_errors['31TDJ'] = S1ARDFormatError(s1_prd_ids)
+    return lambda: {'31TCJ': (2, 's3://ewoc-ard/31TCJ')}
+
+def fake_run_wp_unit_group(units, out_dirpath_root, dem_dirpath, working_dirpath, **kwargs):
+    """ The units of 31TCJ fail, the later ones first """
+    unit = units[0]
+    if unit.s2_tile_id != '31TCJ':
+        return [WpUnitResult(unit, 0, '', 2, f's3://ewoc-ard/{unit.s2_tile_id}')]
+    if unit.date_key == '2021-07-08':
+        time.sleep(1.)
+        return [WpUnitResult(unit, EWOC_S1_PROCESSOR_ERROR, 'S1Tiling failed')]
+    return [WpUnitResult(unit, EWOC_S1_ARD_FORMAT_ERROR, 'Formatting failed')]
+
+def fake_start_wp_unit_group(units, out_dirpath_root, dem_dirpath, working_dirpath, **kwargs):
+    return partial(fake_run_wp_unit_group, units, out_dirpath_root, dem_dirpath, working_dirpath)
+
+def fake_join_uploads(units, upload_latency):
+    time.sleep(upload_latency)
+    return [WpUnitResult(unit, 0, '', 2, f's3://ewoc-ard/{unit.s2_tile_id}') for unit in units]
+
+def fake_start_wp_unit_group_interrupted(units, out_dirpath_root, dem_dirpath, working_dirpath,
+                                         **kwargs):
+    """ The work plan is interrupted during the unit of 2021-07-20 """
+    if units[0].date_key == '2021-07-20':
+        raise KeyboardInterrupt
+    return partial(fake_join_uploads, units, 0.5)
+
+def fake_run_wp_unit_group_killed(units, out_dirpath_root, dem_dirpath, working_dirpath,
+                                  **kwargs):
+    """ The process of the unit of 2021-07-20 is killed """
+    if units[0].date_key == '2021-07-20':
+        os._exit(1)
+    return [WpUnitResult(unit, 0, '', 2, f's3://ewoc-ard/{unit.s2_tile_id}') for unit in units]
+
+def raise_interrupt():
+    raise KeyboardInterrupt
+
+DOWNLOAD_LATENCY = 0.3
+COMPUTE_LATENCY = 0.3
+UPLOAD_LATENCY = 0.3
+
+def fake_get_s1_prds(s1_prd_ids, s1_input_dir, data_source, nb_workers, s1_prd_cache):
+    time.sleep(DOWNLOAD_LATENCY)
+    for s1_prd_id in s1_prd_ids:
+        (s1_input_dir / s1_prd_id).mkdir()
+    return []
+
+def write_wp(dirpath):
+    wp_filepath = dirpath / 'wp.json'
+    with open(wp_filepath, 'w', encoding='utf8') as wp_file:
+        json.dump({'version': '1.0', 'tiles': [
+            {'tile_id': s2_tile_id, 'l8_enable_sr': False,
+             's1_ids': [[unit.s1_prd_ids[0]] for unit in WP_UNITS
+                        if unit.s2_tile_id == s2_tile_id]}
+            for s2_tile_id in ['31TCJ', '31TDJ']]}, wp_file)
+    return wp_filepath
+
+class Test_Scheduler(unittest.TestCase):
+    @patch.object(ClusterConfig, 'compute_nb_parallel_units', return_value=3)
+    @patch('ewoc_s1.scheduler.run_wp_unit_group', fake_run_wp_unit_group)
+    def test_wp_results_order(self, mock_compute_nb_parallel_units):
+        """The results of the concurrent units are in the order of the work plan"""
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = write_wp(Path(tmp_dirpath))
+            (Path(tmp_dirpath) / 'dem').mkdir()
+
+            results = generate_s1_ard_wp(wp_filepath, Path(tmp_dirpath) / 'out',
+                                         Path(tmp_dirpath),
+                                         dem_source=str(Path(tmp_dirpath) / 'dem'),
+                                         production_id='0000_000', nb_parallel_units=3)
+
+        self.assertEqual([(result.unit.s2_tile_id, result.unit.date_key) for result in results],
+                         [(unit.s2_tile_id, unit.date_key) for unit in WP_UNITS])
+        self.assertEqual([result.exit_code for result in results],
+                         [EWOC_S1_PROCESSOR_ERROR, EWOC_S1_ARD_FORMAT_ERROR, 0])
+
+    @patch.object(ClusterConfig, 'compute_nb_parallel_units', return_value=1)
+    def test_wp_interrupted_journal(self, mock_compute_nb_parallel_units):
+        """The units completed before an interruption are in the journal and are resumed"""
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = write_wp(Path(tmp_dirpath))
+            (Path(tmp_dirpath) / 'dem').mkdir()
+            journal_filepath = Path(tmp_dirpath) / 'journal.jsonl'
+            wp_kwargs = {'dem_source': str(Path(tmp_dirpath) / 'dem'), 'production_id': '0000_000',
+                         'journal_filepath': journal_filepath, 'nb_prefetch_units': 0}
+
+            with patch('ewoc_s1.scheduler.start_wp_unit_group',
+                       fake_start_wp_unit_group_interrupted), \
+                 self.assertRaises(KeyboardInterrupt):
+                generate_s1_ard_wp(wp_filepath, Path(tmp_dirpath) / 'out', Path(tmp_dirpath),
+                                   **wp_kwargs)
+
+            with open(journal_filepath, encoding='utf8') as journal_file:
+                self.assertEqual([(entry['s2_tile_id'], entry['date_key'])
+                                  for entry in map(json.loads, journal_file)],
+                                 [('31TCJ', '2021-07-08')])
+
+            with patch('ewoc_s1.scheduler.start_wp_unit_group',
+                       side_effect=fake_start_wp_unit_group) as mock_start_wp_unit_group:
+                results = generate_s1_ard_wp(wp_filepath, Path(tmp_dirpath) / 'out',
+                                             Path(tmp_dirpath), resume=True, **wp_kwargs)
+            self.assertEqual(mock_start_wp_unit_group.call_count, 2)
+            self.assertEqual([(result.unit.s2_tile_id, result.unit.date_key)
+                              for result in results],
+                             [(unit.s2_tile_id, unit.date_key) for unit in WP_UNITS[1:]])
+
+    @patch.object(ClusterConfig, 'compute_nb_parallel_units', return_value=1)
+    def test_wp_upload_overlap(self, mock_compute_nb_parallel_units):
+        """The uploads of a unit are waited while the next unit is processed"""
+        intervals = {}
+
+        def fake_start_s1_ard_tiles_latency(s1_prd_ids, s2_tile_ids, out_dirpath_root,
+                                            dem_dirpath, working_dirpath, **kwargs):
+            start = time.perf_counter()
+            time.sleep(COMPUTE_LATENCY)
+            intervals[('compute', s1_prd_ids[0], s2_tile_ids[0])] = (start, time.perf_counter())
+
+            def join_uploads():
+                start = time.perf_counter()
+                time.sleep(UPLOAD_LATENCY)
+                intervals[('upload', s1_prd_ids[0], s2_tile_ids[0])] = (start,
+                                                                        time.perf_counter())
+                return {s2_tile_ids[0]: (2, f's3://ewoc-ard/{s2_tile_ids[0]}')}
+            return join_uploads
+
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = write_wp(Path(tmp_dirpath))
+            (Path(tmp_dirpath) / 'dem').mkdir()
+            with patch('ewoc_s1.scheduler.start_s1_ard_tiles',
+                       side_effect=fake_start_s1_ard_tiles_latency):
+                results = generate_s1_ard_wp(wp_filepath, Path(tmp_dirpath) / 'out',
+                                             Path(tmp_dirpath),
+                                             dem_source=str(Path(tmp_dirpath) / 'dem'),
+                                             production_id='0000_000', nb_prefetch_units=0)
+
+        self.assertEqual([result.exit_code for result in results], [0, 0, 0])
+        unit_keys = [(unit.s1_prd_ids[0], unit.s2_tile_id) for unit in WP_UNITS]
+        for unit_key, next_unit_key in zip(unit_keys[:-1], unit_keys[1:]):
+            upload_start, upload_end = intervals[('upload', *unit_key)]
+            next_compute_start, next_compute_end = intervals[('compute', *next_unit_key)]
+            self.assertLess(upload_start, next_compute_end)
+            self.assertLess(next_compute_start, upload_end)
+
+    @patch.object(ClusterConfig, 'compute_nb_parallel_units', return_value=3)
+    @patch('ewoc_s1.scheduler.run_wp_unit_group', fake_run_wp_unit_group_killed)
+    def test_wp_unit_process_killed(self, mock_compute_nb_parallel_units):
+        """The units of a killed process are reported as failed with the other units"""
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = write_wp(Path(tmp_dirpath))
+            (Path(tmp_dirpath) / 'dem').mkdir()
+            results = generate_s1_ard_wp(wp_filepath, Path(tmp_dirpath) / 'out',
+                                         Path(tmp_dirpath),
+                                         dem_source=str(Path(tmp_dirpath) / 'dem'),
+                                         production_id='0000_000', nb_parallel_units=3)
+
+        self.assertEqual([(result.unit.s2_tile_id, result.unit.date_key) for result in results],
+                         [(unit.s2_tile_id, unit.date_key) for unit in WP_UNITS])
+        self.assertEqual(results[1].exit_code, EWOC_S1_UNEXPECTED_ERROR)
+
+    def test_inline_executor_interrupt(self):
+        """The errors of a unit run inline are set to its future but not the interrupts"""
+        executor = get_wp_unit_executor(1)
+        future = executor.submit(fake_generate_s1_ard, WP_UNITS[2].s1_prd_ids, '31TDJ', None,
+                                 None, None)
+        self.assertIsInstance(future.exception(), S1ARDFormatError)
+        with self.assertRaises(KeyboardInterrupt):
+            executor.submit(raise_interrupt)
+
+    @patch('ewoc_s1.scheduler.start_s1_ard_tiles', side_effect=fake_start_s1_ard_tiles)
+    def test_run_wp_units(self, mock_start_s1_ard_tiles):
+        """The failure of a unit is reported without stopping the other units"""
+        with TemporaryDirectory() as tmp_dirpath:
+            with get_wp_unit_executor(1) as executor:
+                futures = [executor.submit(run_wp_unit, unit, Path(tmp_dirpath) / 'out',
+                                           Path(tmp_dirpath) / 'dem',
+                                           Path(tmp_dirpath) / unit.unit_id)
+                           for unit in WP_UNITS]
+            results = [future.result() for future in futures]
+
+            self.assertEqual(mock_start_s1_ard_tiles.call_count, 3)
+            self.assertEqual([result.exit_code for result in results],
+                             [0, EWOC_S1_UNEXPECTED_ERROR, EWOC_S1_ARD_FORMAT_ERROR])
+            self.assertEqual(results[0].nb_s1_ard_files, 2)
+            self.assertEqual(results[0].unit.unit_id, '31TCJ_2021-07-08')
+            # The working directories are cleaned
+            self.assertFalse(any((Path(tmp_dirpath) / unit.unit_id).exists()
+                                 for unit in WP_UNITS))
+
+    @patch('ewoc_s1.scheduler.start_s1_ard_tiles', side_effect=fake_start_s1_ard_tiles_group)
+    def test_run_wp_unit_group(self, mock_start_s1_ard_tiles):
+        """The units of a group are processed with one call and their results are split"""
+        with stage_recorder() as prefetch_recorder:
+            with stage('prefetch', tile='31TCJ', date='2021-07-08'):
+                pass
+        with TemporaryDirectory() as tmp_dirpath:
+            results = run_wp_unit_group([WP_UNITS[0], WP_UNITS[2]], Path(tmp_dirpath) / 'out',
+                                        Path(tmp_dirpath) / 'dem', Path(tmp_dirpath) / 'group',
+                                        prefetch_records=prefetch_recorder.records)
+            self.assertEqual(mock_start_s1_ard_tiles.call_count, 1)
+            self.assertEqual([result.exit_code for result in results],
+                             [0, EWOC_S1_ARD_FORMAT_ERROR])
+            self.assertEqual(results[0].ard_checksums, {'SAR/31/T/CJ/ard_VV.tif': '31TCJ'})
+            self.assertEqual(results[0].s1_ard_s3path, 's3://ewoc-ard/31TCJ')
+            self.assertEqual([record.name for record in results[0].stage_records],
+                             ['prefetch', 'unit'])
+            self.assertIsNone(results[1].stage_records)
+            self.assertFalse((Path(tmp_dirpath) / 'group').exists())
+
+    @patch('ewoc_s1.scheduler.get_s1_prds', side_effect=fake_get_s1_prds)
+    def test_prefetch(self, mock_get_s1_prds):
+        """The products of the next unit are downloaded during the processing of a unit"""
+        with TemporaryDirectory() as tmp_dirpath:
+            units = [(unit, Path(tmp_dirpath) / unit.unit_id) for unit in WP_UNITS]
+            start = time.perf_counter()
+            with S1InputPrefetcher(units, 'aws') as prefetcher:
+                for unit, working_dirpath in units:
+                    prefetch_records = prefetcher.wait(unit)
+                    if unit != WP_UNITS[0]:
+                        self.assertTrue((working_dirpath / 'input' / unit.s2_tile_id /
+                                         unit.s1_prd_ids[0]).is_dir())
+                    # The prefetch is recorded for the unit it serves
+                    self.assertEqual([(record.name, record.labels) for record in prefetch_records],
+                                     [] if unit == WP_UNITS[0] else
+                                     [('prefetch', {'tile': unit.s2_tile_id,
+                                                    'date': unit.date_key})])
+                    # Processing of the unit, during the prefetch of the next one
+                    with stage_recorder() as recorder:
+                        time.sleep(DOWNLOAD_LATENCY)
+                    self.assertEqual(recorder.records, [])
+            self.assertLess(time.perf_counter() - start, 4.5 * DOWNLOAD_LATENCY)
+            self.assertEqual(mock_get_s1_prds.call_count, 2)
+
+    @patch('ewoc_s1.scheduler.get_s1_prds', side_effect=fake_get_s1_prds)
+    def test_prefetch_budget(self, mock_get_s1_prds):
+        """The products are not prefetched beyond the disk budget"""
+        with TemporaryDirectory() as tmp_dirpath:
+            units = [(unit, Path(tmp_dirpath) / unit.unit_id) for unit in WP_UNITS]
+            with S1InputPrefetcher(units, 'aws', nb_units_ahead=2,
+                                   disk_budget=EWOC_S1_GRD_SIZE_ESTIMATE) as prefetcher:
+                prefetcher.wait(WP_UNITS[0])
+            self.assertEqual(mock_get_s1_prds.call_count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
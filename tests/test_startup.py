@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+import unittest
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+# Import time budget of the CLI in seconds, it is far below the time to load the OTB stack
+CLI_IMPORT_BUDGET = 1.5
+
+def import_modules(module_names, nb_runs=3):
+    """ Import the modules in a new interpreter
+
+    Returns the best import time over nb_runs and the modules loaded by the imports
+    """
+    code = ('import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            f'for module_name in {module_names!r}:\n'
+            '    __import__(module_name)\n'
+            'print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n')
+    import_times = []
+    for __unused in range(nb_runs):
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                                text=True).stdout
+        import_time, loaded_modules = json.loads(output)
+        import_times.append(import_time)
+    return min(import_times), set(loaded_modules)
+
+class Test_Startup(unittest.TestCase):
+    def test_cli_import(self):
+        """The CLI starts without loading S1Tiling, OTB and ewoc_dag"""
+        import_time, loaded_modules = import_modules(['ewoc_s1.cli'])
+        self.assertLess(import_time, CLI_IMPORT_BUDGET)
+        self.assertFalse({'s1tiling', 'otbApplication', 'ewoc_dag'} & loaded_modules)
+
+    def test_ard_import(self):
+        """The constants of the ARD format are available without loading GDAL"""
+        __unused, loaded_modules = import_modules(['ewoc_s1.ewoc_s1_ard', 'ewoc_s1.workspace'])
+        self.assertFalse({'numpy', 'rasterio'} & loaded_modules)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+from pathlib import Path
+import shutil
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+
+from ewoc_s1.upload import ArdUploadError, ArdUploadQueue
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+UPLOAD_LATENCY = 0.3
+
+class FakeBucket():
+    """Filesystem-backed stand-in of the EWoC ARD bucket which fails the first attempts"""
+
+    def __init__(self, bucket_dirpath, nb_failures=0):
+        self._bucket_dirpath = bucket_dirpath
+        self._nb_failures = nb_failures
+        self._lock = threading.Lock()
+        self.nb_attempts = 0
+
+    def upload(self, ard_filepath, out_dirpath, production_id):
+        with self._lock:
+            self.nb_attempts += 1
+            if self.nb_failures_left():
+                raise ConnectionError('Connection reset by peer')
+        time.sleep(UPLOAD_LATENCY)
+        key_path = self._bucket_dirpath / production_id / ard_filepath.relative_to(out_dirpath)
+        key_path.parent.mkdir(exist_ok=True, parents=True)
+        shutil.copy(ard_filepath, key_path)
+        return f's3://ewoc-ard/{production_id}'
+
+    def nb_failures_left(self):
+        self._nb_failures -= 1
+        return self._nb_failures >= 0
+
+class Test_ArdUploadQueue(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._out_dirpath = Path(self._tmp_dir.name) / 'ewoc_s1_ard'
+        self._bucket_dirpath = Path(self._tmp_dir.name) / 'bucket'
+        self._ard_filepaths = []
+        for pol in ['VV', 'VH']:
+            ard_filepath = self._out_dirpath / 'SAR' / '31' / 'T' / 'CJ' / f'ard_{pol}.tif'
+            ard_filepath.parent.mkdir(exist_ok=True, parents=True)
+            ard_filepath.write_bytes(pol.encode())
+            self._ard_filepaths.append(ard_filepath)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_upload(self):
+        """The files are uploaded concurrently, retried and removed once uploaded"""
+        fake_bucket = FakeBucket(self._bucket_dirpath, nb_failures=1)
+        start = time.perf_counter()
+        with ArdUploadQueue(self._out_dirpath, '0000_000', upload_fn=fake_bucket.upload,
+                            nb_workers=2, retry_delay=0.) as upload_queue:
+            for ard_filepath in self._ard_filepaths:
+                upload_queue.submit(ard_filepath)
+            nb_files, s3path = upload_queue.join()
+        self.assertLess(time.perf_counter() - start, 2 * UPLOAD_LATENCY)
+
+        self.assertEqual((nb_files, s3path), (2, 's3://ewoc-ard/0000_000'))
+        self.assertEqual(fake_bucket.nb_attempts, 3)
+        self.assertFalse(any(ard_filepath.exists() for ard_filepath in self._ard_filepaths))
+        self.assertEqual((self._bucket_dirpath / '0000_000' / 'SAR' / '31' / 'T' / 'CJ' /
+                          'ard_VH.tif').read_bytes(), b'VH')
+
+    def test_upload_error(self):
+        """The local copy is kept when the upload fails after the retries"""
+        fake_bucket = FakeBucket(self._bucket_dirpath, nb_failures=10)
+        with ArdUploadQueue(self._out_dirpath, '0000_000', upload_fn=fake_bucket.upload,
+                            nb_retries=2, retry_delay=0.) as upload_queue:
+            upload_queue.submit(self._ard_filepaths[0])
+            with self.assertRaises(ArdUploadError):
+                upload_queue.join()
+        self.assertEqual(fake_bucket.nb_attempts, 3)
+        self.assertTrue(self._ard_filepaths[0].exists())
+
+    def test_join_dirpath(self):
+        """Only the uploads of the files of a directory are waited"""
+        fake_bucket = FakeBucket(self._bucket_dirpath)
+        other_filepath = self._out_dirpath / 'SAR' / '31' / 'T' / 'DJ' / 'ard_VV.tif'
+        other_filepath.parent.mkdir(parents=True)
+        other_filepath.write_bytes(b'VV')
+        with ArdUploadQueue(self._out_dirpath, '0000_000', upload_fn=fake_bucket.upload,
+                            delete_uploaded=False) as upload_queue:
+            for ard_filepath in self._ard_filepaths + [other_filepath]:
+                upload_queue.submit(ard_filepath)
+            self.assertEqual(upload_queue.join(other_filepath.parent),
+                             (1, 's3://ewoc-ard/0000_000'))
+            self.assertEqual(upload_queue.join(self._ard_filepaths[0].parent)[0], 2)
+
+if __name__ == "__main__":
+    unittest.main()
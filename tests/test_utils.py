@@ -0,0 +1,239 @@
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+from unittest.mock import patch
+
+from ewoc_s1.utils import (ClusterConfig, EwocWorkPlanReader, WpTile, get_cgroup_cpu_limit,
+                           get_cgroup_memory_limit, group_units_by_products,
+                           iter_work_plan_tiles)
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+def s1_prd_id(date, idx):
+    return f'S1A_IW_GRDH_1SDV_{date}T0601{idx:02d}_{date}T0602{idx:02d}_038682_04908E_{idx:04d}'
+
+def write_work_plan(filepath, nb_prd_by_tile_date, **fields):
+    work_plan = {'version': '1.0', 'tiles': [], **fields}
+    for tile_id, nb_prd_by_date in nb_prd_by_tile_date.items():
+        work_plan['tiles'].append({
+            'tile_id': tile_id,
+            'l8_enable_sr': False,
+            's1_ids': [[s1_prd_id(date, idx) for idx in range(nb_prd)]
+                       for date, nb_prd in nb_prd_by_date.items()]})
+    with open(filepath, 'w', encoding='utf8') as wp_file:
+        json.dump(work_plan, wp_file, indent=2)
+
+# Sizes of the synthetic continent-scale work plans and the time budget in seconds to read the
+# largest one (about 0.6 s, 2.5 s with the coverage of the tests)
+NB_BENCHMARK_TILES = [10000, 40000]
+WP_BENCHMARK_BUDGET = 5.
+
+NB_PRD_BY_TILE_DATE = {'31TCJ': {'20210708': 3, '20210720': 1, '20210801': 2},
+                       '31TDJ': {'20210708': 3, '20210720': 1},
+                       '36TWR': {'20210703': 2, '20210715': 2, '20210727': 1}}
+
+class Test_EwocWorkPlanReader(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._wp_filepath = Path(self._tmp_dir.name) / 'wp.json'
+        write_work_plan(self._wp_filepath, NB_PRD_BY_TILE_DATE)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_get_units(self):
+        wp_reader = EwocWorkPlanReader(self._wp_filepath)
+        units = wp_reader.get_units()
+        self.assertEqual(len(units), 8)
+        self.assertEqual(units[0].unit_id, '31TCJ_2021-07-08_R110')
+        self.assertEqual(len(units[0].s1_prd_ids), 3)
+
+    def test_get_units_by_acquisition(self):
+        """The groups of the same date and different orbits are different units"""
+        ascending_prd_ids = ['S1A_IW_GRDH_1SDV_20210708T174510_20210708T174535_038687_0490B3_1A2B']
+        descending_prd_ids = [s1_prd_id('20210708', 0), s1_prd_id('20210708', 1)]
+        wp_tile = WpTile('31TCJ', [descending_prd_ids[:1], ascending_prd_ids,
+                                   descending_prd_ids[1:]])
+        units = wp_tile.get_units()
+        self.assertEqual([unit.unit_id for unit in units],
+                         ['31TCJ_2021-07-08_R110', '31TCJ_2021-07-08_R115'])
+        self.assertEqual(units[0].s1_prd_ids, descending_prd_ids)
+        self.assertEqual(units[1].s1_prd_ids, ascending_prd_ids)
+
+    def test_shard_units(self):
+        """The shards are balanced by number of products and cover the work plan"""
+        wp_reader = EwocWorkPlanReader(self._wp_filepath)
+        shards = wp_reader.shard_units(3)
+        self.assertEqual([sum(len(unit.s1_prd_ids) for unit in shard) for shard in shards],
+                         [5, 5, 5])
+        self.assertEqual(sorted(unit.unit_id for shard in shards for unit in shard),
+                         sorted(unit.unit_id for unit in wp_reader.get_units()))
+        self.assertEqual(wp_reader.get_shard_units(1, 3), shards[1])
+        self.assertEqual(EwocWorkPlanReader(self._wp_filepath).shard_units(3), shards)
+        with self.assertRaises(ValueError):
+            wp_reader.get_shard_units(3, 3)
+
+    def test_get_tile_ids_by_shared_products(self):
+        """The tiles which share products are consecutive"""
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = Path(tmp_dirpath) / 'wp.json'
+            write_work_plan(wp_filepath, {'31TCJ': {'20210708': 2},
+                                          '36TWR': {'20210703': 2},
+                                          '31TDJ': {'20210708': 1},
+                                          '36TWS': {'20210703': 1}})
+            wp_reader = EwocWorkPlanReader(wp_filepath)
+            tile_ids = wp_reader.get_tile_ids_by_shared_products()
+            self.assertEqual(tile_ids, ['31TCJ', '31TDJ', '36TWR', '36TWS'])
+            self.assertEqual([unit.s2_tile_id for unit in wp_reader.get_units(tile_ids)],
+                             tile_ids)
+
+    def test_group_units_by_products(self):
+        """The units of different tiles with the same products are grouped"""
+        with TemporaryDirectory() as tmp_dirpath:
+            wp_filepath = Path(tmp_dirpath) / 'wp.json'
+            write_work_plan(wp_filepath, {'31TCJ': {'20210708': 2, '20210720': 1},
+                                          '31TDJ': {'20210708': 2}})
+            units = EwocWorkPlanReader(wp_filepath).get_units()
+            unit_groups = group_units_by_products(units)
+            self.assertEqual([[unit.unit_id for unit in group] for group in unit_groups],
+                             [[units[0].unit_id, units[2].unit_id], [units[1].unit_id]])
+
+    def test_to_work_plan(self):
+        """The work plan of a shard can be read back"""
+        wp_reader = EwocWorkPlanReader(self._wp_filepath)
+        for shard_idx, shard_units in enumerate(wp_reader.shard_units(2)):
+            shard_wp_filepath = Path(self._tmp_dir.name) / f'shard_{shard_idx}.json'
+            shard_wp = wp_reader.to_work_plan(shard_units)
+            self.assertEqual(shard_wp['version'], '1.0')
+            self.assertTrue(all('l8_enable_sr' in tile for tile in shard_wp['tiles']))
+            with open(shard_wp_filepath, 'w', encoding='utf8') as wp_file:
+                json.dump(shard_wp, wp_file)
+            self.assertEqual(EwocWorkPlanReader(shard_wp_filepath).get_units(), shard_units)
+
+    def test_get_tile(self):
+        wp_reader = EwocWorkPlanReader(self._wp_filepath)
+        wp_tile = wp_reader.get_tile('31TDJ')
+        self.assertEqual(wp_tile.tile_id, '31TDJ')
+        self.assertEqual(wp_tile.get_units(), wp_reader.get_units(['31TDJ']))
+        self.assertEqual(wp_reader.get_nb_s1_prd('31TDJ'), 2)
+        self.assertIsNone(wp_reader.get_tile('36TWS'))
+        self.assertEqual(wp_reader.get_s1_prd_ids('36TWS'), [])
+
+    def test_iter_work_plan_tiles(self):
+        """The tiles are streamed whatever the chunks and the other fields of the work plan"""
+        write_work_plan(self._wp_filepath, NB_PRD_BY_TILE_DATE, start_date=20210701,
+                        config={'s1_provider': 'creodias', 'tiles': [1.5, None]})
+        wp_reader = EwocWorkPlanReader(self._wp_filepath)
+        for chunk_size in [1, 7, 1024]:
+            self.assertEqual(list(iter_work_plan_tiles(self._wp_filepath, chunk_size)),
+                             [wp_reader.get_tile(tile_id) for tile_id in wp_reader.tile_ids])
+
+        self._wp_filepath.write_text('{"version": "1.0", "tiles": []}', encoding='utf8')
+        self.assertEqual(list(iter_work_plan_tiles(self._wp_filepath)), [])
+        self._wp_filepath.write_text('{"tiles": [{"tile_id": "31TCJ", "s1_ids": []}',
+                                     encoding='utf8')
+        with self.assertRaises(ValueError):
+            list(iter_work_plan_tiles(self._wp_filepath))
+
+class Test_EwocWorkPlanReaderBenchmark(unittest.TestCase):
+    def _read_work_plan(self, wp_filepath, nb_tiles):
+        """ Index and stream the work plan, return the time spent """
+        start = time.perf_counter()
+        wp_reader = EwocWorkPlanReader(wp_filepath)
+        nb_s1_prd = sum(wp_reader.get_nb_s1_prd(tile_id) for tile_id in wp_reader.tile_ids)
+        nb_units = len(wp_reader.get_units())
+        nb_wp_tiles = sum(isinstance(wp_tile, WpTile)
+                          for wp_tile in iter_work_plan_tiles(wp_filepath))
+        elapsed = time.perf_counter() - start
+        self.assertEqual((nb_s1_prd, nb_units, nb_wp_tiles), (2 * nb_tiles, 2 * nb_tiles, nb_tiles))
+        return elapsed
+
+    def test_large_work_plan(self):
+        """A work plan of 40k tiles is indexed and streamed within the budget, in a time linear
+        in the number of tiles"""
+        elapsed = []
+        with TemporaryDirectory() as tmp_dirpath:
+            for nb_tiles in NB_BENCHMARK_TILES:
+                wp_filepath = Path(tmp_dirpath) / f'wp_{nb_tiles}.json'
+                write_work_plan(wp_filepath, {f'{idx:05d}': {'20210708': 2, '20210720': 1}
+                                              for idx in range(nb_tiles)})
+                elapsed.append(self._read_work_plan(wp_filepath, nb_tiles))
+
+        self.assertLess(elapsed[1], WP_BENCHMARK_BUDGET)
+        # 4 times more tiles: a quadratic reader would take 16 times longer
+        self.assertLess(elapsed[1], 8 * elapsed[0])
+
+def write_cgroup_files(cgroup_dirpath, files):
+    for relpath, content in files.items():
+        (cgroup_dirpath / relpath).parent.mkdir(exist_ok=True, parents=True)
+        (cgroup_dirpath / relpath).write_text(content, encoding='utf8')
+
+class Test_ClusterConfig(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._cgroup_dirpath = Path(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_cgroup_v2(self):
+        write_cgroup_files(self._cgroup_dirpath, {'cpu.max': '250000 100000\n',
+                                                  'memory.max': f'{2 * 1024**3}\n'})
+        self.assertEqual(get_cgroup_cpu_limit(self._cgroup_dirpath), 2.5)
+        self.assertEqual(get_cgroup_memory_limit(self._cgroup_dirpath), 2 * 1024**3)
+
+        write_cgroup_files(self._cgroup_dirpath, {'cpu.max': 'max 100000\n',
+                                                  'memory.max': 'max\n'})
+        self.assertIsNone(get_cgroup_cpu_limit(self._cgroup_dirpath))
+        self.assertIsNone(get_cgroup_memory_limit(self._cgroup_dirpath))
+
+    def test_cgroup_v1(self):
+        write_cgroup_files(self._cgroup_dirpath, {'cpu,cpuacct/cpu.cfs_quota_us': '100000\n',
+                                                  'cpu,cpuacct/cpu.cfs_period_us': '100000\n',
+                                                  'memory/memory.limit_in_bytes': '1073741824\n'})
+        self.assertEqual(get_cgroup_cpu_limit(self._cgroup_dirpath), 1)
+        self.assertEqual(get_cgroup_memory_limit(self._cgroup_dirpath), 1024**3)
+
+        write_cgroup_files(self._cgroup_dirpath, {'cpu,cpuacct/cpu.cfs_quota_us': '-1\n',
+                                                  'memory/memory.limit_in_bytes':
+                                                  '9223372036854771712\n'})
+        self.assertIsNone(get_cgroup_cpu_limit(self._cgroup_dirpath))
+        self.assertIsNone(get_cgroup_memory_limit(self._cgroup_dirpath))
+
+    @patch.dict(os.environ)
+    def test_limits(self):
+        """The S1Tiling configuration is sized from the limits of the cgroup"""
+        os.environ.pop('EWOC_S1_MAX_CPU', None)
+        os.environ.pop('EWOC_S1_MAX_RAM_MB', None)
+        write_cgroup_files(self._cgroup_dirpath, {'cpu.max': '100000 100000\n',
+                                                  'memory.max': f'{2 * 1024**3}\n'})
+        cluster_config = ClusterConfig(4, cgroup_root=self._cgroup_dirpath)
+        self.assertEqual(cluster_config.total_core, 1)
+        self.assertEqual(cluster_config.physical_core, 1)
+        self.assertEqual(cluster_config.total_ram, 2 * 1024**3)
+        self.assertEqual(cluster_config.compute_optimal_cluster_config(),
+                         (int(0.95 * 2 * 1024), 1, 1))
+
+    @patch.dict(os.environ, {'EWOC_S1_MAX_CPU': '1', 'EWOC_S1_MAX_RAM_MB': '512'})
+    def test_env_overrides(self):
+        cluster_config = ClusterConfig(4, nb_parallel_units=2, cgroup_root=self._cgroup_dirpath)
+        self.assertEqual(cluster_config.total_core, 1)
+        self.assertEqual(cluster_config.total_ram, 256 * 1024**2)
+
+    @patch.dict(os.environ)
+    @patch('ewoc_s1.utils.cpu_count', return_value=None)
+    @patch('os.cpu_count', return_value=None)
+    def test_unknown_cpu_count(self, mock_os_cpu_count, mock_cpu_count):
+        """The cores are counted from the CPU affinity or default to one"""
+        os.environ.pop('EWOC_S1_MAX_CPU', None)
+        cluster_config = ClusterConfig(4, cgroup_root=self._cgroup_dirpath)
+        self.assertGreaterEqual(cluster_config.total_core, 1)
+        self.assertGreaterEqual(cluster_config.physical_core, 1)
+
+if __name__ == "__main__":
+    unittest.main()
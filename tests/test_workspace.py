@@ -0,0 +1,72 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+
+from ewoc_s1.workspace import WorkspaceBudget, estimate_unit_footprint
+
+__author__ = "Mickael Savinaud"
+__copyright__ = "Mickael Savinaud"
+__license__ = "MIT"
+
+class Test_WorkspaceBudget(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = TemporaryDirectory()
+        self._workspace = WorkspaceBudget(Path(self._tmp_dir.name),
+                                          estimate_unit_footprint(3), poll_interval=0.05)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_estimate_unit_footprint(self):
+        self.assertLess(estimate_unit_footprint(1), estimate_unit_footprint(2))
+
+    def test_admission(self):
+        """A unit waits until the units already admitted release their workspace"""
+        admitted = threading.Event()
+
+        def run_second_unit():
+            with self._workspace.reserve('31TDJ_2021-07-08', estimate_unit_footprint(2)):
+                admitted.set()
+
+        with self._workspace.reserve('31TCJ_2021-07-08', estimate_unit_footprint(2)):
+            self.assertEqual(self._workspace.reserved(), estimate_unit_footprint(2))
+            second_unit = threading.Thread(target=run_second_unit)
+            second_unit.start()
+            time.sleep(0.2)
+            self.assertFalse(admitted.is_set())
+        second_unit.join(timeout=5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(self._workspace.reserved(), 0)
+
+        with self.assertRaises(TimeoutError):
+            with self._workspace.reserve('31TCJ_2021-07-08', estimate_unit_footprint(2)):
+                with self._workspace.reserve('31TDJ_2021-07-08', estimate_unit_footprint(2),
+                                             timeout=0.1):
+                    pass
+
+    def test_oversized_unit(self):
+        """A unit larger than the budget is admitted alone"""
+        with self._workspace.reserve('31TCJ_2021-07-08', estimate_unit_footprint(10)):
+            self.assertEqual(self._workspace.reserved(), estimate_unit_footprint(10))
+
+    def test_dead_process(self):
+        """The reservations of the dead processes are removed"""
+        (Path(self._tmp_dir.name) / '.ewoc_s1_workspace' / '31TCJ_2021-07-08_0.json').write_text(
+            '{"unit_id": "31TCJ_2021-07-08", "pid": 999999999, "size": 1}', encoding='utf8')
+        self.assertEqual(self._workspace.reserved(), 0)
+
+    def test_reused_pid(self):
+        """The reservation of a dead process is removed even if its pid is used again"""
+        reservation_filepath = (Path(self._tmp_dir.name) / '.ewoc_s1_workspace' /
+                                f'31TCJ_2021-07-08_{os.getpid()}.json')
+        reservation_filepath.write_text('{"unit_id": "31TCJ_2021-07-08", "pid": '
+                                        f'{os.getpid()}, "size": 1}}', encoding='utf8')
+        with self._workspace.reserve('31TDJ_2021-07-08', estimate_unit_footprint(2)):
+            self.assertEqual(self._workspace.reserved(), estimate_unit_footprint(2))
+        self.assertFalse(reservation_filepath.exists())
+
+if __name__ == "__main__":
+    unittest.main()